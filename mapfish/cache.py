@@ -0,0 +1,237 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+""" Caching of the results of the MapFish protocol.
+
+The cache is made of a backend, storing values by key, and of a
+``ProtocolCache`` that builds the keys from the mapped class and the
+request params, and invalidates the entries of a mapped class when its
+table is modified through the protocol.
+
+Example::
+
+    from mapfish.cache import LRUCache
+
+    protocol = Protocol(Session, Spot, cache=LRUCache(maxsize=500, ttl=300))
+
+The ``LRUCache`` backend lives in the process memory, entries modified by
+other processes are therefore only refreshed when they expire. Use a shared
+backend (for example built on memcached) to avoid this.
+"""
+
+import time
+import threading
+from uuid import uuid4
+from hashlib import sha1
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python < 2.7
+    OrderedDict = None
+
+
+class CacheBackend(object):
+    """ Interface of the cache backends. Backends for shared stores (e.g.
+    memcached or redis) implement these three methods, the values passed to
+    ``set`` are picklable. """
+
+    def get(self, key):
+        """ Return the value stored for ``key``, or None. """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ Store ``value`` for ``key``. """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Remove the value stored for ``key``, if any. """
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """ An in-process cache backend holding at most ``maxsize`` entries,
+    the least recently used entries are evicted first. If ``ttl`` is
+    given entries expire ``ttl`` seconds after they are stored. """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict() if OrderedDict is not None else {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                return None
+            # re-insert the entry to mark it as the most recently used
+            self._entries[key] = entry
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.pop(iter(self._entries).next())
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+
+def _normalize_number(value):
+    return repr(float(value))
+
+def _normalize_list(value):
+    return ','.join(sorted(value.split(',')))
+
+def _normalize_numbers(value):
+    return ','.join([_normalize_number(v) for v in value.split(',')])
+
+def _normalize_bool(value):
+    low = value.lower()
+    return str(low != 'false' and low != '0')
+
+
+class ProtocolCache(object):
+    """ Cache of the results of ``Protocol.read`` and ``Protocol.count``.
+
+    The keys are made of the mapped class, of a version of the mapped class
+    and of a normalized form of the request params. Invalidating a mapped
+    class changes its version, so that its entries are not found anymore
+    and eventually evicted by the backend. The version is stored in the
+    backend as well, for shared backends to be invalidated in all
+    processes. """
+
+    # the request params the protocol results depend on, and the function
+    # normalizing their values
+    params = {
+        'bbox': _normalize_numbers,
+        'lon': _normalize_number,
+        'lat': _normalize_number,
+        'geometry': None,
+        'tolerance': _normalize_number,
+        'epsg': int,
+        'queryable': _normalize_list,
+        'limit': int,
+        'maxfeatures': int,
+        'offset': int,
+        'sort': None,
+        'order_by': None,
+        'dir': lambda v: v.upper(),
+        'cursor': None,
+        'attrs': _normalize_list,
+        'no_geom': _normalize_bool,
+        'resolution': _normalize_number,
+        'precision': int,
+        'cluster': _normalize_bool,
+        'ids': None,
+        'estimate': _normalize_bool,
+        'quantization': int
+    }
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _name(self, mapped_class):
+        return '%s.%s' % (mapped_class.__module__, mapped_class.__name__)
+
+    def version(self, mapped_class):
+        """ Return the current version of ``mapped_class``. """
+        key = 'mapfish:version:%s' % self._name(mapped_class)
+        version = self.backend.get(key)
+        if version is None:
+            # the version is random rather than a counter, a version lost
+            # by the backend must not collide with an earlier one
+            version = uuid4().hex
+            self.backend.set(key, version)
+        return version
+
+    def invalidate(self, mapped_class):
+        """ Invalidate the entries of ``mapped_class``. """
+        key = 'mapfish:version:%s' % self._name(mapped_class)
+        self.backend.set(key, uuid4().hex)
+
+    def normalize(self, request):
+        """ Return the request params the results depend on, as a sorted
+        list of (name, value) tuples. Raise ``ValueError`` if a value
+        cannot be normalized. """
+        items = []
+        queryable = []
+        if 'queryable' in request.params:
+            queryable = request.params['queryable'].split(',')
+        for name in request.params:
+            value = request.params[name]
+            if name in self.params:
+                normalize = self.params[name]
+                if normalize is not None:
+                    value = normalize(value)
+            elif '__' in name and name.split('__')[0] in queryable:
+                # attribute filter
+                pass
+            else:
+                continue
+            items.append((name, unicode(value)))
+        items.sort()
+        return items
+
+    def key(self, mapped_class, request, kind, *args):
+        """ Return the cache key of a result of type ``kind`` (e.g.
+        ``read`` or ``count``) for the request. Additional arguments (e.g.
+        a feature id) are part of the key. """
+        data = repr((self.normalize(request), args))
+        return 'mapfish:%s:%s:%s:%s' % (kind, self._name(mapped_class),
+                                        self.version(mapped_class),
+                                        sha1(data.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        self.backend.set(key, value)
@@ -191,6 +191,17 @@ class MapFishControllerCommand(Command):
                                  "like this:\n\n") 
             resource_command += ('map.connect("/%s/count", controller="%s", '
                                  'action="count")\n' % (pluralName, pluralName))
+            resource_command += ('map.connect("/%s/{z}/{x}/{y}.pbf", '
+                                 'controller="%s", action="tile")\n' %
+                                 (pluralName, pluralName))
+            resource_command += ('map.connect("/%s", controller="%s", '
+                                 'action="bulk_update", '
+                                 'conditions=dict(method=["PUT"]))\n' %
+                                 (pluralName, pluralName))
+            resource_command += ('map.connect("/%s", controller="%s", '
+                                 'action="bulk_delete", '
+                                 'conditions=dict(method=["DELETE"]))\n' %
+                                 (pluralName, pluralName))
             resource_command += 'map.resource("%s", "%s")\n' % \
                     (singularName, pluralName)
 
@@ -36,21 +36,209 @@ import simplejson
 
 from pylons.decorators.util import get_pylons
 
+import geojson
+from geojson import Feature, FeatureCollection
 from geojson.codec import PyGFPEncoder as GeoJSONEncoder
 
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 
 log = logging.getLogger(__name__)
 
+def round_coordinates(coordinates, precision):
+    """Return a copy of ``coordinates``, a position or a nested list of
+    positions, with the numbers rounded to ``precision`` decimals."""
+    if len(coordinates) > 0 and isinstance(coordinates[0], (list, tuple)):
+        return [round_coordinates(c, precision) for c in coordinates]
+    return [round(c, precision) for c in coordinates]
+
+def ujson_dumps(data):
+    """Encode ``data``, made of dicts, lists and scalars, with ujson. The
+    floats are written with 15 decimals, ujson's maximum."""
+    return ujson.dumps(data, double_precision=15,
+                       escape_forward_slashes=False)
+
+# the types encoded natively by the JSON backends
+_NATIVE = frozenset([str, unicode, int, long, float, bool, type(None)])
+_KEYS = frozenset([str, unicode])
+
+_GEOMETRIES = (geojson.Point, geojson.MultiPoint, geojson.LineString,
+               geojson.MultiLineString, geojson.Polygon, geojson.MultiPolygon)
+
+class _Unsupported(Exception):
+    pass
+
 class MapFishEncoder(GeoJSONEncoder):
     # SQLAlchemy's Reflecting Tables mechanism uses decimal.Decimal
     # for numeric columns and datetime.date for dates. simplejson does
     # not know how to deal with objects of those types. This class provides
     # a simple encoder that can deal with these kinds of objects.
+    #
+    # If precision is given the coordinates and the bboxes of the GeoJSON
+    # objects are rounded to that number of decimals, e.g.
+    # _jsonify(cls=MapFishEncoder, precision=2) for centimetres on metric
+    # layers.
+    #
+    # Features, feature collections, geojson and Shapely geometries and
+    # dates are converted by fast paths dispatched on their type, the
+    # other objects by the geojson encoder. If backend is set, a function
+    # encoding dicts, lists and scalars, the data is converted to those
+    # types in Python and encoded by the backend, unless it holds objects
+    # the fast paths do not convert, decimals, which are kept exact by
+    # simplejson, or the encoder has formatting options. The backend is
+    # off by default, the output of a backend differs from simplejson's
+    # (float formatting and whitespace), set
+    # MapFishEncoder.backend = staticmethod(ujson_dumps) to encode with
+    # ujson.
+
+    backend = None
+
+    def __init__(self, precision=None, **kwargs):
+        GeoJSONEncoder.__init__(self, **kwargs)
+        self.precision = precision
+
+    def encode(self, o):
+        if self.backend is not None and self.indent is None and \
+           not self.sort_keys and self.ensure_ascii and \
+           type(self).default.im_func is MapFishEncoder.default.im_func:
+            try:
+                return self.backend(self._plain(o))
+            except _Unsupported:
+                pass
+        return GeoJSONEncoder.encode(self, o)
+
+    def _plain(self, o):
+        # Return o as dicts, lists and scalars, the coordinates of the
+        # geometries are left as they are. Raise _Unsupported if o holds
+        # an object the fast paths do not convert.
+        t = type(o)
+        if t in _NATIVE:
+            return o
+        if t is dict:
+            d = {}
+            for k, v in o.iteritems():
+                if type(k) not in _KEYS:
+                    raise _Unsupported()
+                d[k] = v if type(v) in _NATIVE else self._plain(v)
+            return d
+        if t is list or t is tuple:
+            return [v if type(v) in _NATIVE else self._plain(v) for v in o]
+        convert = self._converters.get(t)
+        if convert is None:
+            if not hasattr(o, '__geo_interface__'):
+                raise _Unsupported()
+            convert = MapFishEncoder._geo_interface
+        d = convert(self, o)
+        if type(d) is not dict:
+            return self._plain(d)
+        ret = {}
+        for k, v in d.iteritems():
+            if k == 'coordinates' or type(v) in _NATIVE:
+                ret[k] = v
+            else:
+                ret[k] = self._plain(v)
+        return ret
 
     def default(self, obj):
+        convert = self._converters.get(type(obj))
+        if convert is not None:
+            return convert(self, obj)
         if isinstance(obj, (decimal.Decimal, datetime.date, datetime.datetime)):
             return str(obj)
-        return GeoJSONEncoder.default(self, obj)
+        if hasattr(obj, '__geo_interface__') and \
+           not isinstance(obj, geojson.GeoJSON):
+            # a Shapely geometry
+            return self._geo_interface(obj)
+        d = GeoJSONEncoder.default(self, obj)
+        if self.precision is not None:
+            d = self._round(d)
+        return d
+
+    def _round(self, d):
+        # the mapping is copied, the coordinates of the encoded
+        # objects are left as is
+        d = dict(d)
+        if d.get('coordinates') is not None:
+            d['coordinates'] = round_coordinates(d['coordinates'],
+                                                 self.precision)
+        if d.get('bbox') is not None:
+            d['bbox'] = round_coordinates(d['bbox'], self.precision)
+        if isinstance(d.get('geometry'), dict):
+            d['geometry'] = self._round(d['geometry'])
+        return d
+
+    # The fast paths, they return the same mappings as the geojson encoder,
+    # the nested objects are converted when they are encoded.
+
+    def _feature(self, obj):
+        d = dict(**obj.extra)
+        d.update(type='Feature')
+        geometry = obj.geometry
+        if not isinstance(geometry, geojson.GeoJSON):
+            # geojson.geometry.Default
+            geometry = None
+        d.update(id=obj.id, geometry=geometry, properties=obj.properties)
+        if self.precision is not None and d.get('bbox') is not None:
+            d['bbox'] = round_coordinates(d['bbox'], self.precision)
+        return d
+
+    def _feature_collection(self, obj):
+        d = dict(**obj.extra)
+        d.update(type='FeatureCollection')
+        d.update(features=obj.features)
+        if self.precision is not None and d.get('bbox') is not None:
+            d['bbox'] = round_coordinates(d['bbox'], self.precision)
+        return d
+
+    def _geometry(self, obj):
+        if obj.extra or not isinstance(obj.crs, geojson.crs.Default):
+            d = obj.__geo_interface__
+        else:
+            d = dict(type=obj.type)
+            d.update(coordinates=obj.coordinates)
+        if self.precision is not None:
+            d = self._round(d)
+        return d
+
+    def _geo_interface(self, obj):
+        d = dict(obj.__geo_interface__)
+        if d.get('type') == 'GeometryCollection':
+            # the geometries are converted by the fast paths as well
+            d['geometries'] = [geojson.GeoJSON.to_instance(g, strict=True)
+                               for g in d['geometries']]
+        elif self.precision is not None:
+            d = self._round(d)
+        return d
+
+    def _date(self, obj):
+        return str(obj)
+
+    _converters = {
+        Feature: _feature,
+        FeatureCollection: _feature_collection,
+        geojson.GeometryCollection: _geo_interface,
+        datetime.date: _date,
+        datetime.datetime: _date,
+    }
+    for cls in _GEOMETRIES:
+        _converters[cls] = _geometry
+    del cls
+
+def _iterencode(data, cb_name=None, cls=None, **dumps_kwargs):
+    # Encode a stream object (an object providing an iterencode method,
+    # see mapfish.protocol.FeatureStream) into a sequence of strings.
+    if cls is None:
+        cls = simplejson.JSONEncoder
+    encoder = cls(**dumps_kwargs)
+    if cb_name is not None:
+        yield str(cb_name) + '('
+    for chunk in data.iterencode(encoder):
+        yield chunk
+    if cb_name is not None:
+        yield ');'
 
 # _jsonify shouldn't be part of MapFish. It should be in Pylons.
 # See <http://pylonshq.com/project/pylonshq/ticket/632>
@@ -63,6 +251,17 @@ def _jsonify(cb=None, **dumps_kwargs):
         else:
             pylons.response.headers['Content-Type'] = 'application/json'
         data = func(*args, **kwargs)
+        if hasattr(data, 'content_type'):
+            # a file, see mapfish.export.ExportStream
+            log.debug("Returning exported file")
+            pylons.response.headers['Content-Type'] = data.content_type
+            if data.filename is not None:
+                pylons.response.headers['Content-Disposition'] = \
+                        'attachment; filename="%s"' % data.filename
+            return iter(data)
+        if hasattr(data, 'iterencode'):
+            log.debug("Returning streamed JSON wrapped action output")
+            return _iterencode(data, cb_name, **dumps_kwargs)
         output = simplejson.dumps(data, **dumps_kwargs)
         if cb_name is not None:
             output = str(cb_name) + '(' + output + ');'
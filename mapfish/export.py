@@ -0,0 +1,663 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+
+""" Export of features to FlatGeobuf, GeoPackage and zipped Shapefile.
+
+The writers take the features as ``(fid, wkb, properties)`` tuples, the
+WKB being that of the geometry or ``None``, and return the file as a
+generator of strings. FlatGeobuf files are written as the features are
+read, the GeoPackage and Shapefile writers write the features to
+temporary files as they are read and return the files once complete,
+those formats need the number of features in their headers. The files
+are written by hand, this module has no dependency.
+
+Example::
+
+    from mapfish import export
+
+    fields = [('name', 'str', 80), ('height', 'float', None)]
+    writer = export.FlatGeobufWriter('spots', fields, 'Point', 4326)
+    for chunk in writer.write(features):
+        output.write(chunk)
+
+The kinds of the fields are ``'int'``, ``'float'``, ``'bool'``,
+``'str'``, ``'date'`` and ``'datetime'``, the width is the maximum
+length of the strings or ``None``. The geometry type is a GeoJSON type
+name, or ``None`` if the geometries may be of any type.
+"""
+
+import os
+import struct
+import shutil
+import sqlite3
+import zipfile
+import datetime
+import tempfile
+
+import geojson
+
+from mapfish import wkb
+
+CHUNK_SIZE = 65536
+""" The size of the chunks of the files written to temporary files. """
+
+WGS84 = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,' \
+        '298.257223563]],PRIMEM["Greenwich",0],' \
+        'UNIT["degree",0.0174532925199433]]'
+""" The WKT of EPSG:4326, the only system whose definition is written. """
+
+def _value(value, kind):
+    # The value of a field as a Python value of its kind, or None.
+    if value is None:
+        return None
+    if kind == 'int':
+        return int(value)
+    if kind == 'float':
+        return float(value)
+    if kind == 'bool':
+        return bool(value)
+    if kind in ('date', 'datetime'):
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        return unicode(value)
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+def _temporary(suffix):
+    # The path of a new temporary file.
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix='mapfish')
+    os.close(fd)
+    return path
+
+def _read_file(path):
+    # The content of a file as a generator of chunks.
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+class ExportStream(object):
+    """ A file to be sent to the client chunk by chunk. ``geojsonify``
+    recognizes objects providing ``content_type`` and returns them as the
+    response body, as an attachment named ``filename``.
+
+      chunks
+          an iterable of strings, the content of the file.
+
+      content_type
+          the media type of the file.
+
+      filename
+          the name of the file.
+    """
+
+    def __init__(self, chunks, content_type, filename=None):
+        self.chunks = chunks
+        self.content_type = content_type
+        self.filename = filename
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+class Writer(object):
+    """ The base class of the writers.
+
+      name
+          the name of the layer.
+
+      fields
+          the fields of the features, a list of ``(name, kind, width)``
+          tuples.
+
+      geometry_type
+          the GeoJSON type of the geometries, ``None`` for any type.
+
+      srid
+          the EPSG code of the system of the geometries.
+
+      has_z
+          ``True`` if the geometries have a third coordinate.
+    """
+
+    content_type = None
+    extension = None
+
+    def __init__(self, name, fields, geometry_type=None, srid=None,
+                 has_z=False):
+        self.name = name
+        self.fields = fields
+        self.geometry_type = geometry_type
+        self.srid = srid
+        self.has_z = has_z
+
+    def write(self, features):
+        """ Return the file of ``features``, an iterable of
+        ``(fid, wkb, properties)`` tuples, as a generator of strings. """
+        raise NotImplementedError
+
+
+# FlatGeobuf, see <https://flatgeobuf.org>
+
+_FGB_MAGIC = 'fgb\x03fgb\x00'
+
+# column types
+_FGB_COLUMNS = {'bool': 2, 'int': 7, 'float': 10, 'str': 11,
+                'date': 13, 'datetime': 13}
+
+_FGB_FORMATS = {2: '<B', 7: '<q', 10: '<d'}
+
+class _FlatBuffer(object):
+    """ A minimal FlatBuffers builder, the objects are written front to
+    back, each table being followed by the objects it refers to.
+
+    A table is given as a dict of values by field id. A value is a
+    ``(format, value)`` tuple, ``format`` being a ``struct`` format for a
+    scalar, ``'string'``, ``'vector'`` for a ``(format, values)`` vector
+    of scalars, ``'table'`` or ``'tables'`` for a list of tables. """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def _pad(self, n, extra=0):
+        # align the position following extra bytes on n bytes
+        self.data.extend('\x00' * ((n - (len(self.data) + extra) % n) % n))
+
+    def finish(self, root):
+        """ Return the buffer of the root table, prefixed with its size. """
+        self.data.extend('\x00' * 4)
+        struct.pack_into('<I', self.data, 0, self._table(root))
+        return struct.pack('<I', len(self.data)) + str(self.data)
+
+    def _table(self, fields):
+        count = max(fields.keys()) + 1 if len(fields) > 0 else 0
+        vtable = [4 + 2 * count, 4] + [0] * count
+        layout = []
+        # the largest values first, to reduce the padding
+        for id, (format, value) in sorted(fields.items(),
+                                           key=lambda f: -_size(f[1][0])):
+            size = _size(format)
+            offset = (vtable[1] + size - 1) // size * size
+            vtable[2 + id] = offset
+            vtable[1] = offset + size
+            layout.append((offset, format, value))
+        self._pad(2)
+        vtable_pos = len(self.data)
+        self.data.extend(struct.pack('<%dH' % len(vtable), *vtable))
+        self._pad(8)
+        pos = len(self.data)
+        self.data.extend('\x00' * vtable[1])
+        struct.pack_into('<i', self.data, pos, pos - vtable_pos)
+        children = []
+        for offset, format, value in layout:
+            if format in ('string', 'vector', 'table', 'tables'):
+                children.append((pos + offset, format, value))
+            else:
+                struct.pack_into(format, self.data, pos + offset, value)
+        for field_pos, format, value in children:
+            child = self._child(format, value)
+            struct.pack_into('<I', self.data, field_pos, child - field_pos)
+        return pos
+
+    def _child(self, format, value):
+        if format == 'table':
+            return self._table(value)
+        if format == 'string':
+            self._pad(4)
+            pos = len(self.data)
+            self.data.extend(struct.pack('<I', len(value)) + value + '\x00')
+            return pos
+        if format == 'vector':
+            format, values = value
+            self._pad(max(4, _size(format)), 4)
+            pos = len(self.data)
+            self.data.extend(struct.pack('<I', len(values)))
+            self.data.extend(struct.pack('<%d%s' % (len(values), format[1:]),
+                                         *values))
+            return pos
+        # a vector of tables
+        self._pad(4)
+        pos = len(self.data)
+        self.data.extend(struct.pack('<I', len(value)))
+        self.data.extend('\x00' * 4 * len(value))
+        for i, fields in enumerate(value):
+            slot = pos + 4 + 4 * i
+            struct.pack_into('<I', self.data, slot, self._table(fields) - slot)
+        return pos
+
+def _size(format):
+    # The size of the inline value of a field.
+    if format in ('string', 'vector', 'table', 'tables'):
+        return 4
+    return struct.calcsize(format)
+
+class FlatGeobufWriter(Writer):
+    """ A FlatGeobuf writer. The file has no spatial index and its header
+    gives no number of features, the features are written as they are
+    read. """
+
+    content_type = 'application/flatgeobuf'
+    extension = 'fgb'
+
+    def write(self, features):
+        yield _FGB_MAGIC + self._header()
+        for fid, data, properties in features:
+            yield self._feature(data, properties)
+
+    def _header(self):
+        header = {
+            0: ('string', self.name.encode('utf-8')),
+            2: ('<B', wkb.TYPES.get(self.geometry_type, 0)),
+            3: ('<?', self.has_z),
+            7: ('tables', [{0: ('string', name.encode('utf-8')),
+                            1: ('<B', _FGB_COLUMNS[kind])}
+                           for name, kind, width in self.fields]),
+            # no spatial index
+            9: ('<H', 0),
+        }
+        if self.srid is not None:
+            header[10] = ('table', {1: ('<i', self.srid)})
+        return _FlatBuffer().finish(header)
+
+    def _feature(self, data, properties):
+        feature = {}
+        if data is not None:
+            geometry = wkb.loads(data)
+            feature[0] = ('table', self._geometry(geometry))
+        values = []
+        for i, (name, kind, width) in enumerate(self.fields):
+            value = _value(properties.get(name), kind)
+            if value is None:
+                continue
+            type = _FGB_COLUMNS[kind]
+            values.append(struct.pack('<H', i))
+            if type in _FGB_FORMATS:
+                values.append(struct.pack(_FGB_FORMATS[type], value))
+            else:
+                value = value.encode('utf-8')
+                values.append(struct.pack('<I', len(value)) + value)
+        if len(values) > 0:
+            feature[1] = ('vector', ('<B', bytearray(''.join(values))))
+        return _FlatBuffer().finish(feature)
+
+    def _geometry(self, geometry):
+        type = geometry.type
+        fields = {6: ('<B', wkb.TYPES[type])}
+        if type == 'GeometryCollection':
+            fields[7] = ('tables', [self._geometry(g)
+                                    for g in geometry.geometries])
+            return fields
+        if type == 'MultiPolygon':
+            fields[7] = ('tables', [self._geometry(
+                    geojson.Polygon(c)) for c in geometry.coordinates])
+            return fields
+        coordinates = geometry.coordinates
+        if type == 'Point':
+            positions = [coordinates] if len(coordinates) > 0 else []
+        elif type in ('LineString', 'MultiPoint'):
+            positions = coordinates
+        else:
+            # the ends of the rings or lines
+            positions, ends = [], []
+            for part in coordinates:
+                positions.extend(part)
+                ends.append(len(positions))
+            if len(ends) > 1:
+                fields[0] = ('vector', ('<I', ends))
+        xy = []
+        for p in positions:
+            xy.append(p[0])
+            xy.append(p[1])
+        fields[1] = ('vector', ('<d', xy))
+        if self.has_z:
+            fields[2] = ('vector', ('<d', [p[2] if len(p) > 2 else 0.0
+                                           for p in positions]))
+        return fields
+
+
+# GeoPackage, see <https://www.geopackage.org>
+
+_GPKG_TYPES = {'int': 'INTEGER', 'float': 'REAL', 'bool': 'BOOLEAN',
+               'str': 'TEXT', 'date': 'DATE', 'datetime': 'DATETIME'}
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+class GeoPackageWriter(Writer):
+    """ A GeoPackage writer. The features are inserted into a temporary
+    database as they are read, with one statement per ``batch_size``
+    features, the geometries are stored as they are given, with no
+    envelope. """
+
+    content_type = 'application/geopackage+sqlite3'
+    extension = 'gpkg'
+    batch_size = 1000
+
+    def write(self, features):
+        path = _temporary('.gpkg')
+        try:
+            self._write(path, features)
+            for chunk in _read_file(path):
+                yield chunk
+        finally:
+            os.remove(path)
+
+    def _write(self, path, features):
+        db = sqlite3.connect(path)
+        try:
+            self._create(db)
+            columns = ['fid', 'geom'] + [name for name, kind, w in self.fields]
+            insert = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                _quote(self.name), ', '.join(_quote(c) for c in columns),
+                ', '.join('?' * len(columns)))
+            srs_id = self._srs_id()
+            header = 'GP\x00\x01' + struct.pack('<i', srs_id)
+            rows = []
+            for fid, data, properties in features:
+                row = [fid, None if data is None else
+                            buffer(header + str(data))]
+                for name, kind, width in self.fields:
+                    value = _value(properties.get(name), kind)
+                    row.append(int(value) if kind == 'bool' and
+                               value is not None else value)
+                rows.append(row)
+                if len(rows) >= self.batch_size:
+                    db.executemany(insert, rows)
+                    rows = []
+            db.executemany(insert, rows)
+            db.commit()
+        finally:
+            db.close()
+
+    def _srs_id(self):
+        return -1 if self.srid is None else self.srid
+
+    def _create(self, db):
+        srs_id = self._srs_id()
+        db.execute('PRAGMA application_id = %d' % 0x47504B47)
+        db.execute('PRAGMA user_version = 10200')
+        db.execute('CREATE TABLE gpkg_spatial_ref_sys ('
+                   'srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, '
+                   'organization TEXT NOT NULL, '
+                   'organization_coordsys_id INTEGER NOT NULL, '
+                   'definition TEXT NOT NULL, description TEXT)')
+        systems = [('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined'),
+                   ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined'),
+                   ('WGS 84', 4326, 'EPSG', 4326, WGS84)]
+        if srs_id not in (-1, 0, 4326):
+            systems.append(('EPSG:%d' % srs_id, srs_id, 'EPSG', srs_id,
+                            'undefined'))
+        db.executemany('INSERT INTO gpkg_spatial_ref_sys (srs_name, srs_id, '
+                       'organization, organization_coordsys_id, definition) '
+                       'VALUES (?, ?, ?, ?, ?)', systems)
+        db.execute('CREATE TABLE gpkg_contents ('
+                   'table_name TEXT NOT NULL PRIMARY KEY, '
+                   'data_type TEXT NOT NULL, identifier TEXT UNIQUE, '
+                   'description TEXT DEFAULT \'\', '
+                   'last_change DATETIME NOT NULL DEFAULT '
+                   '(strftime(\'%Y-%m-%dT%H:%M:%fZ\',\'now\')), '
+                   'min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, '
+                   'srs_id INTEGER, CONSTRAINT fk_gc_r_srs_id FOREIGN KEY '
+                   '(srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id))')
+        db.execute('INSERT INTO gpkg_contents (table_name, data_type, '
+                   'identifier, srs_id) VALUES (?, ?, ?, ?)',
+                   (self.name, 'features', self.name, srs_id))
+        db.execute('CREATE TABLE gpkg_geometry_columns ('
+                   'table_name TEXT NOT NULL, column_name TEXT NOT NULL, '
+                   'geometry_type_name TEXT NOT NULL, '
+                   'srs_id INTEGER NOT NULL, z TINYINT NOT NULL, '
+                   'm TINYINT NOT NULL, '
+                   'CONSTRAINT pk_geom_cols PRIMARY KEY '
+                   '(table_name, column_name))')
+        db.execute('INSERT INTO gpkg_geometry_columns VALUES '
+                   '(?, ?, ?, ?, ?, ?)',
+                   (self.name, 'geom',
+                    (self.geometry_type or 'Geometry').upper(), srs_id,
+                    1 if self.has_z else 0, 0))
+        columns = ['fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL',
+                   'geom %s' % (self.geometry_type or 'Geometry').upper()]
+        for name, kind, width in self.fields:
+            columns.append('%s %s' % (_quote(name), _GPKG_TYPES[kind]))
+        db.execute('CREATE TABLE %s (%s)' % (_quote(self.name),
+                                             ', '.join(columns)))
+
+
+# Shapefile, see the ESRI Shapefile Technical Description
+
+_SHP_TYPES = {'Point': 1, 'LineString': 3, 'MultiLineString': 3,
+              'Polygon': 5, 'MultiPolygon': 5, 'MultiPoint': 8}
+
+# the field types and widths and decimals
+_DBF_FIELDS = {'int': ('N', 18, 0), 'float': ('N', 24, 15),
+               'bool': ('L', 1, 0), 'str': ('C', 254, 0),
+               'date': ('D', 8, 0), 'datetime': ('C', 26, 0)}
+
+def _ring_area(ring):
+    # The signed area of a ring, positive if counter-clockwise.
+    area = 0.0
+    for i in range(len(ring) - 1):
+        area += ring[i][0] * ring[i + 1][1] - ring[i + 1][0] * ring[i][1]
+    return area / 2
+
+def _union(extent, bounds):
+    # The union of two extents, the first may be empty.
+    if len(extent) == 0:
+        return list(bounds[:4])
+    return [min(extent[0], bounds[0]), min(extent[1], bounds[1]),
+            max(extent[2], bounds[2]), max(extent[3], bounds[3])]
+
+class ShapefileWriter(Writer):
+    """ A Shapefile writer, the ``.shp``, ``.shx``, ``.dbf`` and ``.cpg``
+    files, and the ``.prj`` file in EPSG:4326, are returned in a zip
+    file. The features are written to temporary files as they are read.
+    The third coordinates are dropped, the strings are encoded in UTF-8,
+    and the field names are cut to 10 characters. If the geometry type is
+    not given the type of the first geometry is used, the geometries of
+    other types are written as null shapes. """
+
+    content_type = 'application/zip'
+    extension = 'zip'
+
+    def write(self, features):
+        directory = tempfile.mkdtemp(prefix='mapfish')
+        try:
+            path = os.path.join(directory, 'layer')
+            self._write(path, features)
+            zip_path = os.path.join(directory, 'layer.zip')
+            archive = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED)
+            for extension in ('shp', 'shx', 'dbf', 'cpg', 'prj'):
+                if os.path.exists('%s.%s' % (path, extension)):
+                    archive.write('%s.%s' % (path, extension),
+                                  '%s.%s' % (self.name, extension))
+            archive.close()
+            for chunk in _read_file(zip_path):
+                yield chunk
+        finally:
+            shutil.rmtree(directory)
+
+    def _dbf_fields(self):
+        # The fields of the dbf file, as (name, kind, type, width,
+        # decimals) tuples.
+        fields, names = [], set()
+        for name, kind, width in self.fields:
+            type, size, decimals = _DBF_FIELDS[kind]
+            if kind == 'str' and width is not None:
+                size = max(1, min(width, size))
+            short = name.encode('ascii', 'replace')[:10]
+            i = 1
+            while short.lower() in names:
+                suffix = '_%d' % i
+                short = short[:10 - len(suffix)] + suffix
+                i += 1
+            names.add(short.lower())
+            fields.append((short, kind, type, size, decimals))
+        return fields
+
+    def _write(self, path, features):
+        shp = open(path + '.shp', 'wb')
+        shx = open(path + '.shx', 'wb')
+        dbf = open(path + '.dbf', 'wb')
+        try:
+            fields = self._dbf_fields()
+            shape_type = _SHP_TYPES.get(self.geometry_type)
+            shp.write('\x00' * 100)
+            shx.write('\x00' * 100)
+            dbf.write(self._dbf_header(fields, 0))
+            offset, count, extent = 100, 0, []
+            for fid, data, properties in features:
+                geometry, bounds = None, None
+                if data is not None:
+                    geometry, bounds = wkb.loads_bounds(data)
+                    if shape_type is None:
+                        shape_type = _SHP_TYPES.get(geometry.type)
+                content = self._record(geometry, bounds, shape_type)
+                if len(content) > 4:
+                    extent = _union(extent, bounds)
+                count += 1
+                shp.write(struct.pack('>ii', count, len(content) // 2))
+                shp.write(content)
+                shx.write(struct.pack('>ii', offset // 2, len(content) // 2))
+                offset += 8 + len(content)
+                dbf.write(self._dbf_record(fields, properties))
+            dbf.write('\x1a')
+
+            if len(extent) == 0:
+                extent = [0.0] * 4
+            for f, length in ((shp, offset), (shx, 100 + 8 * count)):
+                f.seek(0)
+                f.write(struct.pack('>i20xi', 9994, length // 2))
+                f.write(struct.pack('<ii', 1000, shape_type or 0))
+                f.write(struct.pack('<8d', *(list(extent) + [0.0] * 4)))
+            dbf.seek(0)
+            dbf.write(self._dbf_header(fields, count))
+        finally:
+            shp.close()
+            shx.close()
+            dbf.close()
+        f = open(path + '.cpg', 'wb')
+        f.write('UTF-8')
+        f.close()
+        if self.srid == 4326:
+            f = open(path + '.prj', 'wb')
+            f.write(WGS84)
+            f.close()
+
+    def _record(self, geometry, bounds, shape_type):
+        # The content of the record of a geometry.
+        if geometry is None or bounds is None or \
+           _SHP_TYPES.get(geometry.type) != shape_type:
+            return struct.pack('<i', 0)
+        type, coordinates = geometry.type, geometry.coordinates
+        if shape_type == 1:
+            return struct.pack('<i2d', 1, coordinates[0], coordinates[1])
+        box = struct.pack('<4d', *bounds)
+        if shape_type == 8:
+            xy = [c for p in coordinates for c in p[:2]]
+            return struct.pack('<i', 8) + box + \
+                   struct.pack('<i%dd' % len(xy), len(coordinates), *xy)
+        if type == 'LineString':
+            parts = [coordinates]
+        elif type == 'MultiLineString':
+            parts = coordinates
+        else:
+            polygons = [coordinates] if type == 'Polygon' else coordinates
+            parts = []
+            for polygon in polygons:
+                for i, ring in enumerate(polygon):
+                    # the outer rings are clockwise, the holes
+                    # counter-clockwise
+                    if (_ring_area(ring) > 0) == (i == 0):
+                        ring = ring[::-1]
+                    parts.append(ring)
+        starts, xy = [], []
+        for part in parts:
+            starts.append(len(xy) // 2)
+            for p in part:
+                xy.append(p[0])
+                xy.append(p[1])
+        return struct.pack('<i', shape_type) + box + \
+               struct.pack('<ii', len(parts), len(xy) // 2) + \
+               struct.pack('<%di' % len(starts), *starts) + \
+               struct.pack('<%dd' % len(xy), *xy)
+
+    def _dbf_header(self, fields, count):
+        today = datetime.date.today()
+        size = 1 + sum(f[3] for f in fields)
+        header = [struct.pack('<BBBBIHH20x', 3, today.year - 1900,
+                              today.month, today.day, count,
+                              32 + 32 * len(fields) + 1, size)]
+        for name, kind, type, width, decimals in fields:
+            header.append(struct.pack('<11sc4xBB14x', name, type, width,
+                                      decimals))
+        header.append('\x0d')
+        return ''.join(header)
+
+    def _dbf_record(self, fields, properties):
+        record = [' ']
+        for (short, kind, type, width, decimals), (name, k, w) in \
+                zip(fields, self.fields):
+            value = properties.get(name)
+            if value is None:
+                text = '?' if type == 'L' else ''
+            elif kind == 'int':
+                text = str(int(value))
+            elif kind == 'float':
+                text = '%.15f' % float(value)
+                if len(text) > width:
+                    text = repr(float(value))
+            elif kind == 'bool':
+                text = 'T' if value else 'F'
+            elif kind == 'date':
+                text = value.strftime('%Y%m%d') \
+                       if isinstance(value, datetime.date) else str(value)
+            else:
+                text = _value(value, kind).encode('utf-8')
+                # the strings are cut on character boundaries
+                text = text[:width].decode('utf-8', 'ignore').encode('utf-8')
+            if len(text) > width:
+                text = '*' * width
+            if type == 'N':
+                record.append(text.rjust(width))
+            else:
+                record.append(text.ljust(width))
+        return ''.join(record)
+
+
+FORMATS = {
+    'fgb': FlatGeobufWriter,
+    'gpkg': GeoPackageWriter,
+    'shp': ShapefileWriter,
+}
+""" The writers by format name. """
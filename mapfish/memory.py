@@ -0,0 +1,163 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+""" In-memory copies of the tables of the MapFish protocol.
+
+Small reference layers (communes, districts, ...) that are read far more
+often than they are modified can be held in memory by the protocol, the
+requests with a box, point or geometry filter are then answered without
+querying the database.
+
+Example::
+
+    from mapfish.memory import MemoryLayer
+
+    protocol = Protocol(Session, Commune,
+                        memory=MemoryLayer(reload_interval=3600))
+
+The features are loaded on the first read, and reloaded when the table is
+modified through the protocol, which also applies to the other processes
+if the protocol has a shared ``cache`` backend, or when they are older
+than ``reload_interval`` seconds. The features are held as JSON, written
+as they are by the reads in stream mode and decoded by the other reads.
+"""
+
+import time
+import threading
+
+from shapely.geometry import box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+
+class MemoryIndex(object):
+    """ A snapshot of the features of a table, made of the encoded features
+    and of an R-tree of their geometries. ``features`` is a list of
+    (geometry, encoded feature) tuples where geometry is a Shapely geometry
+    or None, or None if the table is too large to be held in memory. """
+
+    def __init__(self, features, version):
+        self.version = version
+        self.time = time.time()
+        self.encoded = None
+        self.tree = None
+        if features is None:
+            return
+        self.encoded = [e for g, e in features]
+        # the positions of the geometries, by identity, as the tree returns
+        # the geometries; the list keeps a reference to the geometries,
+        # which the tree does not do with Shapely < 1.8
+        self._positions = {}
+        self._geometries = []
+        for i, (geometry, encoded) in enumerate(features):
+            if geometry is not None and not geometry.is_empty:
+                self._positions[id(geometry)] = i
+                self._geometries.append(geometry)
+        if len(self._geometries) > 0:
+            self.tree = STRtree(self._geometries)
+
+    def __len__(self):
+        return len(self.encoded or [])
+
+    def query(self, geometry=None, tolerance=0):
+        """ Return the encoded features whose geometries are within
+        ``tolerance`` of ``geometry``, or all the features if ``geometry``
+        is None, in the order of the snapshot. """
+        if geometry is None:
+            return self.encoded
+        if self.tree is None:
+            return []
+        minx, miny, maxx, maxy = geometry.bounds
+        candidates = self.tree.query(box(minx - tolerance, miny - tolerance,
+                                         maxx + tolerance, maxy + tolerance))
+        if tolerance > 0:
+            test = lambda g: g.distance(geometry) <= tolerance
+        else:
+            test = prep(geometry).intersects
+        positions = [self._positions[id(g)] for g in candidates if test(g)]
+        positions.sort()
+        return [self.encoded[i] for i in positions]
+
+
+class MemoryLayer(object):
+    """ The in-memory copy of a table, to be passed to the protocol as the
+    ``memory`` option.
+
+      reload_interval
+          the number of seconds after which the features are reloaded from
+          the database, or None to only reload them when the table is
+          modified through the protocol. Defaults to None.
+
+      max_features
+          the maximum number of features held in memory, larger tables are
+          read from the database. Defaults to 100000.
+    """
+
+    # the request params the layer answers, the requests with other params
+    # of the protocol are sent to the database
+    params = ('bbox', 'lon', 'lat', 'geometry', 'tolerance', 'epsg',
+              'limit', 'maxfeatures', 'offset')
+
+    def __init__(self, reload_interval=None, max_features=100000):
+        self.reload_interval = reload_interval
+        self.max_features = max_features
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _is_stale(self, index, version):
+        if index.version != version:
+            return True
+        return self.reload_interval is not None and \
+               time.time() - index.time >= self.reload_interval
+
+    def get(self, version, load):
+        """ Return the ``MemoryIndex`` of the table at ``version``. If the
+        current snapshot is missing or stale, a new one is built from the
+        list returned by ``load()``, see ``MemoryIndex``. """
+        index = self._index
+        if index is not None and not self._is_stale(index, version):
+            return index
+        if index is None:
+            self._lock.acquire()
+        elif not self._lock.acquire(False):
+            # another thread is reloading the features, the previous
+            # snapshot is used meanwhile
+            return index
+        try:
+            index = self._index
+            if index is None or self._is_stale(index, version):
+                index = self._index = MemoryIndex(load(), version)
+            return index
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """ Drop the snapshot, the features are reloaded on the next
+        read. """
+        self._index = None
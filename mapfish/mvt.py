@@ -0,0 +1,302 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+""" Encoding of Mapbox Vector Tiles.
+
+Tiles follow the web mercator tiling scheme (EPSG:3857), and are encoded
+according to the version 2 of the vector tile specification, see
+<https://github.com/mapbox/vector-tile-spec>. The protocol buffers are
+written by hand, this module has no dependency other than Shapely.
+
+Example::
+
+    from mapfish import mvt
+
+    layer = mvt.Layer('spots', mvt.tile_bounds(z, x, y))
+    layer.add_feature(Point(x, y), {'height': 420.4}, 1)
+    data = mvt.encode([layer])
+
+The PostGIS version of ``Protocol.tile`` does not use this module, the
+tiles are encoded by the database.
+"""
+
+import struct
+
+from shapely import affinity
+from shapely.geometry import box
+
+EXTENT = 4096
+""" The default size of a tile, in tile coordinates. """
+
+BUFFER = 64
+""" The default width of the area around a tile where the geometries are
+kept, in tile coordinates. """
+
+ORIGIN = 20037508.342789244
+""" Half the width of the world in web mercator. """
+
+# geometry types
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+
+# geometry commands
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+def tile_bounds(z, x, y):
+    """ Return the bounds of tile ``z/x/y`` in web mercator. """
+    size = 2 * ORIGIN / 2 ** z
+    minx = -ORIGIN + x * size
+    maxy = ORIGIN - y * size
+    return (minx, maxy - size, minx + size, maxy)
+
+def encode(layers):
+    """ Return the tile made of ``layers``, a list of ``Layer`` objects,
+    as a string. """
+    return ''.join(_message(3, layer.encode()) for layer in layers)
+
+class Layer(object):
+    """ A layer of a tile.
+
+      name
+          the name of the layer.
+
+      bounds
+          the bounds of the tile, ``(minx, miny, maxx, maxy)``, in the
+          system of the geometries given to ``add_feature()``.
+
+      extent
+          the size of the tile in tile coordinates.
+
+      buffer
+          the width of the area around the tile where the geometries are
+          kept, in tile coordinates.
+    """
+
+    def __init__(self, name, bounds, extent=EXTENT, buffer=BUFFER):
+        self.name = name
+        self.bounds = bounds
+        self.extent = extent
+        self.buffer = buffer
+        self.features = []
+
+    def add_feature(self, geometry, properties=None, id=None):
+        """ Add a feature to the layer. ``geometry`` is a Shapely geometry,
+        it is clipped to the tile and converted to tile coordinates, the
+        feature is left out if nothing of it remains. The properties whose
+        value is ``None`` are left out, and ``id`` must be a positive
+        integer to be kept. """
+        minx, miny, maxx, maxy = self.bounds
+        scale = self.extent / (maxx - minx)
+        margin = self.buffer / scale
+        geometry = geometry.intersection(box(minx - margin, miny - margin,
+                                             maxx + margin, maxy + margin))
+        if geometry.is_empty:
+            return
+        # the y axis of tile coordinates points down
+        geometry = affinity.affine_transform(
+                geometry, [scale, 0, 0, -scale, -minx * scale, maxy * scale])
+        type, commands = _encode_geometry(geometry)
+        if type is None:
+            return
+        self.features.append((id, properties or {}, type, commands))
+
+    def encode(self):
+        """ Return the layer as a protocol buffer string. """
+        keys, values = {}, {}
+        data = [_varint_field(15, 2), _string_field(1, self.name)]
+        for id, properties, type, commands in self.features:
+            tags = []
+            for key, value in properties.items():
+                value = _value(value)
+                if value is None:
+                    continue
+                if key not in keys:
+                    keys[key] = len(keys)
+                if value not in values:
+                    values[value] = len(values)
+                tags.extend([keys[key], values[value]])
+            feature = []
+            if isinstance(id, (int, long)) and id >= 0:
+                feature.append(_varint_field(1, id))
+            if tags:
+                feature.append(_packed_field(2, tags))
+            feature.append(_varint_field(3, type))
+            feature.append(_packed_field(4, commands))
+            data.append(_message(2, ''.join(feature)))
+        for key, index in sorted(keys.items(), key=lambda i: i[1]):
+            data.append(_string_field(3, key))
+        for value, index in sorted(values.items(), key=lambda i: i[1]):
+            data.append(_message(4, value))
+        data.append(_varint_field(5, self.extent))
+        return ''.join(data)
+
+def _value(value):
+    # Return the Value message of a property, or None.
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    if isinstance(value, (int, long)):
+        if value >= 0:
+            return _varint_field(5, value)
+        return _varint_field(6, _zigzag(value))
+    if isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    if not isinstance(value, basestring):
+        # decimals and dates, as encoded in GeoJSON
+        value = str(value)
+    return _string_field(1, value)
+
+def _encode_geometry(geometry):
+    # Return the type and the commands of a geometry in tile coordinates,
+    # or (None, None) if the geometry is empty once quantized.
+    type = {'Point': POINT, 'MultiPoint': POINT,
+            'LineString': LINESTRING, 'MultiLineString': LINESTRING,
+            'Polygon': POLYGON, 'MultiPolygon': POLYGON}.get(geometry.geom_type)
+    if type is None:
+        # a collection resulting from the clipping, the parts of the
+        # highest dimension are kept
+        parts = {}
+        for g in geometry.geoms:
+            t, commands = _encode_geometry(g)
+            if t is not None:
+                parts.setdefault(t, []).append(g)
+        if not parts:
+            return None, None
+        type = max(parts)
+        geometries = parts[type]
+    elif hasattr(geometry, 'geoms'):
+        geometries = list(geometry.geoms)
+    else:
+        geometries = [geometry]
+
+    commands = []
+    cursor = [0, 0]
+    if type == POINT:
+        points = [_quantize(g.coords)[0] for g in geometries]
+        commands.append(_command(MOVE_TO, len(points)))
+        _append_deltas(commands, cursor, points)
+    elif type == LINESTRING:
+        for g in geometries:
+            points = _quantize(g.coords)
+            if len(points) < 2:
+                continue
+            commands.append(_command(MOVE_TO, 1))
+            _append_deltas(commands, cursor, points[:1])
+            commands.append(_command(LINE_TO, len(points) - 1))
+            _append_deltas(commands, cursor, points[1:])
+    else:
+        for g in geometries:
+            # exterior rings have a positive area, interior rings
+            # a negative area
+            rings = [(_ring(g.exterior.coords), 1)]
+            if rings[0][0] is None:
+                continue
+            rings.extend((_ring(r.coords), -1) for r in g.interiors)
+            for points, sign in rings:
+                if points is None:
+                    continue
+                if _area(points) * sign < 0:
+                    points.reverse()
+                commands.append(_command(MOVE_TO, 1))
+                _append_deltas(commands, cursor, points[:1])
+                commands.append(_command(LINE_TO, len(points) - 1))
+                _append_deltas(commands, cursor, points[1:])
+                commands.append(_command(CLOSE_PATH, 1))
+    if not commands:
+        return None, None
+    return type, commands
+
+def _quantize(coords):
+    # Round the coordinates to integers and remove the repeated points.
+    points = []
+    for c in coords:
+        p = (int(round(c[0])), int(round(c[1])))
+        if not points or points[-1] != p:
+            points.append(p)
+    return points
+
+def _ring(coords):
+    # Return the points of a ring without the closing point, or None if
+    # the ring is degenerated once quantized.
+    points = _quantize(coords)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    if len(points) < 3 or _area(points) == 0:
+        return None
+    return points
+
+def _area(points):
+    # Twice the signed area of a ring.
+    area = 0
+    for i in range(len(points)):
+        x1, y1 = points[i - 1]
+        x2, y2 = points[i]
+        area += x1 * y2 - x2 * y1
+    return area
+
+def _append_deltas(commands, cursor, points):
+    for x, y in points:
+        commands.append(_zigzag(x - cursor[0]))
+        commands.append(_zigzag(y - cursor[1]))
+        cursor[0], cursor[1] = x, y
+
+def _command(id, count):
+    return (id & 0x7) | (count << 3)
+
+def _zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def _varint(n):
+    data = []
+    while n > 0x7f:
+        data.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    data.append(chr(n))
+    return ''.join(data)
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+def _varint_field(field, n):
+    return _key(field, 0) + _varint(n)
+
+def _message(field, data):
+    return _key(field, 2) + _varint(len(data)) + data
+
+def _string_field(field, value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return _message(field, value)
+
+def _packed_field(field, numbers):
+    return _message(field, ''.join(_varint(n) for n in numbers))
@@ -35,27 +35,218 @@
 #
 
 import logging
+import warnings
 log = logging.getLogger(__name__)
 
 from pylons.controllers.util import abort
 
-from shapely.geometry import asShape
+from shapely import wkb
+from shapely.geometry import asShape, mapping, shape
 from shapely.geometry.point import Point
 from shapely.geometry.polygon import Polygon
 
-from sqlalchemy.sql import asc, desc, and_
+from sqlalchemy import func, types
+from sqlalchemy.sql import asc, desc, and_, or_, cast, literal, tuple_, \
+                           select, literal_column, bindparam, case
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import class_mapper, defer, ColumnProperty
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
+from sqlalchemy.schema import Sequence
+from sqlalchemy.dialects.postgresql.base import PGDialect
+from sqlalchemy.dialects.sqlite.base import SQLiteDialect
+from sqlalchemy.dialects.oracle.base import OracleDialect
 
 from geoalchemy import WKBSpatialElement
+from geoalchemy.base import RawColumn, SpatialElement, GeometryBase
 from geoalchemy.functions import functions
 
 from geojson import Feature, FeatureCollection, loads, GeoJSON
 
+import re
+import math
+import datetime
+import simplejson
+from decimal import Decimal, InvalidOperation
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from itertools import islice
+
+from hashlib import sha1
+
+from mapfish.cache import ProtocolCache, LRUCache
+from mapfish.decorators import round_coordinates, MapFishEncoder
+from mapfish import mvt, export, topojson
+from mapfish.wkb import dumps as dumps_wkb, loads as loads_wkb, \
+                        TYPES as wkb_types
+from mapfish.sqlalchemygeom import EnvelopeFilter, PreFiltered, \
+                                  SimplifiedWKB, Paginated
+
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# the feature versions used for the ETags of the protocols that have no
+# cache nor versions backend
+_versions = ProtocolCache(LRUCache(maxsize=10000))
+
+# the compiled statements of the reads with the default filter, by mapped
+# class, dialect and shape of the request, see the statement_cache option of
+# Protocol
+_statements = LRUCache(maxsize=1000)
+
+# the coordinate transformations, by source and destination EPSG codes
+_transforms = {}
+
+# the areas where the transformations are valid, by source and destination
+# EPSG codes
+_areas = {}
+
+def _get_transform(from_epsg, to_epsg):
+    """ Return a function transforming x and y coordinates from the
+    ``from_epsg`` to the ``to_epsg`` spatial reference system, or None if
+    pyproj is not installed or does not know one of the systems. """
+    if pyproj is None:
+        return None
+    key = (from_epsg, to_epsg)
+    if key not in _transforms:
+        try:
+            if hasattr(pyproj, 'Transformer'):
+                transform = pyproj.Transformer.from_crs(
+                        from_epsg, to_epsg, always_xy=True).transform
+            else:
+                # pyproj < 2.2
+                from_proj = pyproj.Proj(init='epsg:%d' % from_epsg)
+                to_proj = pyproj.Proj(init='epsg:%d' % to_epsg)
+                transform = lambda x, y: pyproj.transform(from_proj, to_proj,
+                                                          x, y)
+        except RuntimeError:
+            log.warning('Cannot transform EPSG:%d to EPSG:%d' % key)
+            transform = None
+        _transforms[key] = transform
+    return _transforms[key]
+
+def _get_area(from_epsg, to_epsg):
+    """ Return the area of use of both the ``from_epsg`` and the ``to_epsg``
+    systems as a Shapely polygon in the ``from_epsg`` system, or None if
+    pyproj does not give it. """
+    if pyproj is None or not hasattr(pyproj, 'CRS'):
+        return None
+    key = (from_epsg, to_epsg)
+    if key not in _areas:
+        area = None
+        try:
+            bounds = [pyproj.CRS.from_epsg(epsg).area_of_use
+                      for epsg in key]
+        except pyproj.exceptions.CRSError:
+            bounds = [None]
+        if None not in bounds and \
+           all(b.west <= b.east for b in bounds):
+            # in longitudes and latitudes, the areas crossing the
+            # antimeridian are not supported
+            west = max(b.west for b in bounds)
+            south = max(b.south for b in bounds)
+            east = min(b.east for b in bounds)
+            north = min(b.north for b in bounds)
+            if west < east and south < north:
+                area = Polygon(((west, south), (west, north), (east, north),
+                                (east, south), (west, south)))
+                if from_epsg != 4326:
+                    transform = _get_transform(4326, from_epsg)
+                    area = None if transform is None else \
+                           _transform_geometry(area, transform)
+                    if area is not None and not _is_finite(area):
+                        area = None
+        _areas[key] = area
+    return _areas[key]
+
+def _is_finite(geometry):
+    """ Return whether the bounds of ``geometry`` are finite numbers. """
+    return all(not (math.isinf(v) or math.isnan(v)) for v in geometry.bounds)
+
+def _project_geometry(geometry, tolerance, from_epsg, to_epsg):
+    """ Return the Shapely geometry of a filter, in the ``from_epsg``
+    system, expanded by ``tolerance`` and transformed to the ``to_epsg``
+    system, or None if it cannot be transformed, the column is then to be
+    transformed by the database. The geometry is clipped to the area of
+    use of the systems beforehand, a world box has no finite coordinates
+    in most projections. """
+    transform = _get_transform(from_epsg, to_epsg)
+    if transform is None:
+        return None
+    if tolerance > 0:
+        geometry = geometry.buffer(tolerance)
+    area = _get_area(from_epsg, to_epsg)
+    if area is not None and geometry.is_valid and \
+       not area.contains(geometry):
+        geometry = geometry.intersection(area)
+        if geometry.is_empty or \
+           geometry.geom_type == 'GeometryCollection':
+            return None
+    geometry = _transform_geometry(geometry, transform)
+    if not _is_finite(geometry) or not geometry.is_valid:
+        return None
+    return geometry
+
+def _densify(positions, max_length):
+    """ Add positions along the segments longer than ``max_length``. """
+    ret = [tuple(positions[0])]
+    for i in range(1, len(positions)):
+        (x0, y0), (x1, y1) = positions[i - 1][:2], positions[i][:2]
+        n = int(((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5 / max_length)
+        for j in range(1, n + 1):
+            ret.append((x0 + (x1 - x0) * j / (n + 1),
+                        y0 + (y1 - y0) * j / (n + 1)))
+        ret.append(tuple(positions[i]))
+    return ret
+
+def _transform_coordinates(coordinates, transform, max_length):
+    if isinstance(coordinates[0], (int, long, float)):
+        # a single position
+        return transform(*coordinates[:2])
+    if isinstance(coordinates[0][0], (int, long, float)):
+        # a line or a ring, densified so that it is bent by the
+        # transformation as the edges of the geometry are
+        return [transform(*p) for p in _densify(coordinates, max_length)]
+    return [_transform_coordinates(c, transform, max_length)
+            for c in coordinates]
+
+def _transform_geometry(geometry, transform):
+    """ Return the Shapely geometry transformed with ``transform``, a
+    function as returned by ``_get_transform``. """
+    minx, miny, maxx, maxy = geometry.bounds
+    max_length = max(maxx - minx, maxy - miny) / 32 or 1
+    geojson = mapping(geometry)
+    coordinates = _transform_coordinates(geojson['coordinates'],
+                                         transform, max_length)
+    return asShape({'type': geojson['type'], 'coordinates': coordinates})
 
 def create_geom_filter(request, mapped_class, **kwargs):
     """Create MapFish geometry filter based on the request params. Either
     a box or within or geometry filter, depending on the request params.
-    Additional named arguments are passed to the spatial filter."""
+    Additional named arguments are passed to the spatial filter.
+
+    If the ``epsg`` param differs from the SRID of the geometry column, the
+    geometry of the filter is transformed to the SRID of the column when
+    pyproj is installed, and the column is transformed to ``epsg`` by the
+    database otherwise."""
+    geometry, epsg, tolerance = _get_geom_params(request)
+
+    if geometry is None:
+        return None
+
+    return _create_geom_filter(geometry, epsg, tolerance, mapped_class, **kwargs)
 
+def _get_geom_params(request):
+    """ Return the Shapely geometry of the ``bbox``, ``lon`` and ``lat``,
+    or ``geometry`` request params, or None, the ``epsg`` param or None,
+    and the ``tolerance`` param. """
     tolerance = 0
     if 'tolerance' in request.params:
         tolerance = float(request.params['tolerance'])
@@ -83,27 +274,87 @@ def create_geom_filter(request, mapped_class, **kwargs):
         geometry = loads(request.params['geometry'], object_hook=factory)
         geometry = asShape(geometry)
 
-    if geometry is None:
-        return None
+    return geometry, epsg, tolerance
 
+def _create_geom_filter(geometry, epsg, tolerance, mapped_class, **kwargs):
+    # Create the geometry filter of a Shapely geometry in the epsg system,
+    # or in the system of the geometry column if epsg is None.
     geom_column = mapped_class.geometry_column()
+    envelope = True
 
     epsg = geom_column.type.srid if epsg is None else epsg
     if epsg != geom_column.type.srid:
-        geom_column = functions.transform(geom_column, epsg)
+        # transform the geometry rather than the column for the spatial
+        # index to be used, the tolerance is given in the units of the
+        # request's system so the geometry is buffered beforehand
+        projected = _project_geometry(geometry, tolerance, epsg,
+                                      geom_column.type.srid)
+        if projected is not None:
+            geometry, tolerance = projected, 0
+            epsg = geom_column.type.srid
+        else:
+            geom_column = functions.transform(geom_column, epsg)
+            # the spatial index cannot be used on the transformed column
+            envelope = False
 
     wkb_geometry = WKBSpatialElement(buffer(geometry.wkb), epsg)
 
+    bounds = None
+    if envelope:
+        minx, miny, maxx, maxy = geometry.bounds
+        bounds = (minx - tolerance, miny - tolerance,
+                  maxx + tolerance, maxy + tolerance)
+
+    return _geom_filter(geom_column, wkb_geometry, tolerance, bounds, epsg,
+                        **kwargs)
+
+def _group_rows(rows):
+    """ Return the rows, dicts of values by column key, grouped by set of
+    keys, as a list of (sorted keys, rows) tuples. """
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+    return groups.items()
+
+def _wkb_bindparam(name, srid):
+    """ Return a ``WKBSpatialElement`` whose WKB is the bind param
+    ``name``, given when the statement is executed. """
+    element = WKBSpatialElement(buffer(''), srid)
+    element.desc = bindparam(name)
+    return element
+
+def _geom_filter(geom_column, geometry, tolerance, bounds, epsg, **kwargs):
+    # The exact test of the geometry filter, preceded by an index-backed
+    # pre-filter on bounds where the test does not use the index, see
+    # PreFiltered, unless bounds is None. The values may be bind params,
+    # see Protocol._cached_query.
     if 'additional_params' in kwargs:
-        return functions._within_distance(geom_column, wkb_geometry, tolerance,
-                                          kwargs['additional_params'])
+        filter = functions._within_distance(geom_column, geometry, tolerance,
+                                            kwargs['additional_params'])
     else:
-        return functions._within_distance(geom_column, wkb_geometry, tolerance)
+        filter = functions._within_distance(geom_column, geometry, tolerance)
+
+    if bounds is not None:
+        filter = PreFiltered(EnvelopeFilter(geom_column, bounds, epsg),
+                             filter)
+
+    return filter
 
 def create_attr_filter(request, mapped_class):
     """Create an ``and_`` SQLAlchemy filter (a ClauseList object) based
     on the request params (``queryable``, ``eq``, ``ne``, ...)."""
 
+    filters = []
+    for k, col, op in _get_attr_params(request):
+        column = getattr(mapped_class, col)
+        f = getattr(column, op)(request.params[k])
+        filters.append(f)
+
+    return and_(*filters) if len(filters) > 0 else None
+
+def _get_attr_params(request):
+    """ Return the attribute filters of the request params as a list of
+    (param name, column name, operator method) tuples. """
     mapping = {
         'eq'   : '__eq__',
         'ne'   : '__ne__',
@@ -115,7 +366,7 @@ def create_attr_filter(request, mapped_class):
         'ilike': 'ilike'
     }
 
-    filters = []
+    params = []
     if 'queryable' in request.params:
         queryable = request.params['queryable'].split(',')
         for k in request.params:
@@ -126,11 +377,9 @@ def create_attr_filter(request, mapped_class):
             if col not in queryable or op not in mapping.keys():
                 continue
 
-            column = getattr(mapped_class, col)
-            f = getattr(column, mapping[op])(request.params[k])
-            filters.append(f)
+            params.append((k, col, mapping[op]))
 
-    return and_(*filters) if len(filters) > 0 else None
+    return params
 
 def create_default_filter(request, mapped_class, **kwargs):
     """ Create MapFish default filter based on the request params. Additional
@@ -152,6 +401,367 @@ def asbool(val):
     else:
         return bool(val)
 
+class _FixedOffset(datetime.tzinfo):
+    # The time zone of the datetimes read from cursors, see _coerce_value.
+    def __init__(self, minutes):
+        self.offset = datetime.timedelta(minutes=minutes)
+    def utcoffset(self, dt):
+        return self.offset
+    def dst(self, dt):
+        return datetime.timedelta(0)
+    def tzname(self, dt):
+        return None
+
+_datetime_re = re.compile(r'^(\d{4})-(\d\d)-(\d\d)'
+                          r'(?:[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?'
+                          r'(Z|[+-]\d\d:?\d\d)?)?$')
+
+def _parse_datetime(value):
+    # Parse the ISO 8601 form of a date or datetime, as written by
+    # isoformat(), into a datetime.
+    match = _datetime_re.match(value) if isinstance(value, basestring) \
+            else None
+    if match is None:
+        raise ValueError('invalid date: %r' % (value,))
+    year, month, day, hour, minute, second, fraction, tz = match.groups()
+    tzinfo = None
+    if tz == 'Z':
+        tzinfo = _FixedOffset(0)
+    elif tz is not None:
+        minutes = int(tz[1:3]) * 60 + int(tz[-2:])
+        tzinfo = _FixedOffset(-minutes if tz[0] == '-' else minutes)
+    return datetime.datetime(int(year), int(month), int(day), int(hour or 0),
+                             int(minute or 0), int(second or 0),
+                             int((fraction or '0').ljust(6, '0')), tzinfo)
+
+def _coerce_value(type, value):
+    """ Return ``value``, a string or a value decoded from JSON, converted
+    to the Python type of the SA ``type``. Raise ``ValueError`` if it is
+    not of that type. Dates are given in ISO 8601 form and numbers are
+    kept exact if they are decoded as decimals. """
+    if value is None:
+        return None
+    if isinstance(type, types.DateTime):
+        return _parse_datetime(value)
+    if isinstance(type, types.Date):
+        return _parse_datetime(value).date()
+    if isinstance(type, types.Numeric) or isinstance(type, types.Integer):
+        if isinstance(value, bool):
+            raise ValueError('invalid number: %r' % (value,))
+        try:
+            number = Decimal(repr(value) if isinstance(value, float)
+                             else unicode(value).strip())
+        except InvalidOperation:
+            raise ValueError('invalid number: %r' % (value,))
+        if not number.is_finite():
+            raise ValueError('invalid number: %r' % (value,))
+        if isinstance(type, types.Integer):
+            if number != number.to_integral_value():
+                raise ValueError('invalid integer: %r' % (value,))
+            return int(number)
+        return number if type.asdecimal else float(number)
+    if isinstance(type, types.String):
+        return unicode(value)
+    return value
+
+def _encode_value(value):
+    # The default function of the JSON encoding of the cursors, dates are
+    # written in ISO 8601 form.
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+def _grid_cells(points, size):
+    # Group the (x, y) points into the cells of a grid of the given size,
+    # the cells being centered on the multiples of the size as with
+    # ST_SnapToGrid, and return the (count, x, y) tuples of the cells,
+    # where x and y are the means of the coordinates of their points.
+    if len(points) == 0:
+        return []
+    size = float(size)
+    if numpy is not None:
+        coordinates = numpy.array(points, dtype=float)
+        keys = numpy.floor(coordinates / size + 0.5).astype(numpy.int64)
+        keys, inverse = numpy.unique(keys, axis=0, return_inverse=True)
+        counts = numpy.bincount(inverse)
+        xs = numpy.bincount(inverse, weights=coordinates[:, 0]) / counts
+        ys = numpy.bincount(inverse, weights=coordinates[:, 1]) / counts
+        return zip(counts.tolist(), xs.tolist(), ys.tolist())
+    cells = {}
+    for x, y in points:
+        key = (math.floor(x / size + 0.5), math.floor(y / size + 0.5))
+        cell = cells.setdefault(key, [0, 0.0, 0.0])
+        cell[0] += 1
+        cell[1] += x
+        cell[2] += y
+    return [(n, sx / n, sy / n) for n, sx, sy in cells.values()]
+
+class Explain(Executable, ClauseElement):
+    """ An ``EXPLAIN`` statement, the statement given to the constructor is
+    not executed but planned by the database. Only PostgreSQL is
+    supported. """
+
+    def __init__(self, statement):
+        self.statement = statement
+
+@compiles(Explain, 'postgresql')
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN %s' % compiler.process(element.statement)
+
+class Upsert(Executable, ClauseElement):
+    """ An ``INSERT`` statement updating the ``columns`` of the existing
+    rows whose ``index_column`` conflicts with an inserted row. Only
+    PostgreSQL 9.5 or higher and SQLite 3.24 or higher are supported. """
+
+    def __init__(self, insert, index_column, columns):
+        self.insert = insert
+        self.index_column = index_column
+        self.columns = columns
+
+@compiles(Upsert, 'postgresql', 'sqlite')
+def _compile_upsert(element, compiler, **kw):
+    quote = lambda c: compiler.preparer.quote(c.name, c.quote)
+    action = 'NOTHING'
+    if len(element.columns) > 0:
+        action = 'UPDATE SET ' + ', '.join(
+            ['%s = excluded.%s' % (quote(c), quote(c)) for c in element.columns])
+    return '%s ON CONFLICT (%s) DO %s' % (compiler.process(element.insert),
+                                          quote(element.index_column), action)
+
+class UpdateFromValues(Executable, ClauseElement):
+    """ An ``UPDATE`` statement setting the ``columns`` of the rows of
+    ``table`` whose ``key_column`` matches one of the ``rows``, dicts of
+    values by column key, given as a ``VALUES`` list. Only PostgreSQL and
+    SQLite 3.33 or higher are supported. """
+
+    def __init__(self, table, key_column, columns, rows):
+        self.table = table
+        self.key_column = key_column
+        self.columns = columns
+        self.rows = rows
+
+def _update_from_values(element, compiler, value, names, alias):
+    # The UPDATE statement, value returns the SQL expression of a value of
+    # a column, names are the names of the columns of the VALUES list and
+    # alias its alias.
+    quote = lambda c: compiler.preparer.quote(c.name, c.quote)
+    columns = [element.key_column] + list(element.columns)
+    values = []
+    for row in element.rows:
+        values.append('(%s)' % ', '.join(
+            [compiler.process(value(c, row[c.key])) for c in columns]))
+    return 'UPDATE %s SET %s FROM (VALUES %s) AS %s WHERE %s = mf_values.%s' % (
+        compiler.preparer.format_table(element.table),
+        ', '.join(['%s = mf_values.%s' % (quote(c), n)
+                   for c, n in zip(columns[1:], names[1:])]),
+        ', '.join(values), alias, compiler.process(element.key_column),
+        names[0])
+
+def _values_value(column, value):
+    # The expression of a value of the VALUES list.
+    if isinstance(column.type, GeometryBase):
+        return WKBSpatialElement(value, column.type.srid)
+    return literal(value, column.type)
+
+@compiles(UpdateFromValues, 'postgresql')
+def _compile_update_from_values_postgresql(element, compiler, **kw):
+    # the values are cast, the types of the columns of the VALUES list are
+    # not known otherwise
+    def value(column, value):
+        if isinstance(column.type, GeometryBase):
+            return _values_value(column, value)
+        return cast(literal(value, column.type), column.type)
+    quote = lambda c: compiler.preparer.quote(c.name, c.quote)
+    names = [quote(c) for c in [element.key_column] + list(element.columns)]
+    return _update_from_values(element, compiler, value, names,
+                               'mf_values (%s)' % ', '.join(names))
+
+@compiles(UpdateFromValues, 'sqlite')
+def _compile_update_from_values_sqlite(element, compiler, **kw):
+    # the columns of the VALUES list are named column1, column2, ...
+    names = ['column%d' % (i + 1) for i in range(len(element.columns) + 1)]
+    return _update_from_values(element, compiler, _values_value, names,
+                               'mf_values')
+
+class _JSONReader(object):
+    """ Reader of the JSON values of the ``length`` first bytes of the
+    file-like object ``input``, which is read ``chunk_size`` bytes at a
+    time. The methods raise ``ValueError`` if the document is invalid. """
+
+    def __init__(self, input, length, chunk_size=65536, object_hook=None):
+        self.input = input
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.decoder = simplejson.JSONDecoder(object_hook=object_hook)
+        self.buffer = ''
+        self.pos = 0
+
+    def _read(self, size):
+        # Append data to the buffer, return False at the end of the input.
+        if self.remaining <= 0:
+            return False
+        data = self.input.read(min(size, self.remaining))
+        if not data:
+            self.remaining = 0
+            return False
+        self.remaining -= len(data)
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Skip the whitespaces and return the next character, or an
+        empty string at the end of the input. """
+        while True:
+            buffer, pos = self.buffer, self.pos
+            while pos < len(buffer) and buffer[pos] in ' \t\n\r':
+                pos += 1
+            self.pos = pos
+            if pos < len(buffer) or not self._read(self.chunk_size):
+                return buffer[pos:pos + 1]
+
+    def expect(self, chars):
+        """ Consume and return the next character, which must be one of
+        ``chars``. """
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError('Expected one of %r at %d' % (chars, self.pos))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """ Consume and return the next JSON value. """
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # the value may continue beyond the buffer, whose size is
+                # doubled not to decode large values too many times
+                if not self._read(size):
+                    raise
+                size *= 2
+                continue
+            # a number may continue as well
+            if end < len(self.buffer) or not self._read(size):
+                self.pos = end
+                return value
+
+def _read_features(input, length, chunk_size=65536):
+    """ Generator returning the features of the GeoJSON feature collection
+    read from the file-like object ``input``, one at a time, so that the
+    document is never held in memory. Raise ``ValueError`` if the document
+    is not a feature collection. """
+    reader = _JSONReader(input, length, chunk_size,
+                         lambda ob: GeoJSON.to_instance(ob))
+    reader.expect('{')
+    type = None
+    if reader.peek() != '}':
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key == 'features':
+                reader.expect('[')
+                if reader.peek() != ']':
+                    while True:
+                        feature = reader.value()
+                        if not isinstance(feature, Feature):
+                            raise ValueError('Not a feature')
+                        yield feature
+                        if reader.expect(',]') == ']':
+                            break
+                else:
+                    reader.expect(']')
+            else:
+                value = reader.value()
+                if key == 'type':
+                    type = value
+                    if type != 'FeatureCollection':
+                        raise ValueError('Not a feature collection')
+            if reader.expect(',}') == '}':
+                break
+    else:
+        reader.expect('}')
+    if type != 'FeatureCollection':
+        raise ValueError('Not a feature collection')
+
+def _field_kind(type):
+    """ Return the kind and the width of an export field, see
+    ``mapfish.export``, given the SA type of its column. """
+    if isinstance(type, types.Boolean):
+        return 'bool', None
+    if isinstance(type, types.Integer):
+        return 'int', None
+    if isinstance(type, (types.Float, types.Numeric)):
+        return 'float', None
+    if isinstance(type, types.DateTime):
+        return 'datetime', None
+    if isinstance(type, types.Date):
+        return 'date', None
+    return 'str', getattr(type, 'length', None)
+
+class FeatureStream(object):
+    """ An iterable of features to be encoded and sent to the client
+    chunk by chunk, as opposed to a ``FeatureCollection`` which is encoded
+    in one go. ``geojsonify`` recognizes objects providing ``iterencode``
+    and returns them to the WSGI server as the response body.
+
+      features
+          an iterable of ``geojson.Feature`` objects, it is only consumed
+          when the stream is iterated.
+
+      buffer_size
+          the minimum size, in bytes, of the chunks yielded by
+          ``iterencode``.
+
+      members
+          a dict of additional members of the feature collection, encoded
+          after the features so that it may be filled while the features
+          are iterated.
+    """
+
+    def __init__(self, features, buffer_size=65536, members=None):
+        self.features = features
+        self.buffer_size = buffer_size
+        self.members = members if members is not None else {}
+
+    def __iter__(self):
+        return iter(self.features)
+
+    def encode(self, feature, encoder):
+        """ Return the JSON representation of a single feature. """
+        return encoder.encode(feature)
+
+    def iterencode(self, encoder):
+        """ Encode the features one by one with ``encoder`` and yield the
+        GeoJSON feature collection as a sequence of strings. """
+        chunk = ['{"type": "FeatureCollection", "features": [']
+        size = 0
+        separator = ''
+        for feature in self:
+            data = separator + self.encode(feature, encoder)
+            separator = ', '
+            chunk.append(data)
+            size += len(data)
+            if size >= self.buffer_size:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        chunk.append(']')
+        for key, value in self.members.items():
+            chunk.append(', %s: %s' % (encoder.encode(key),
+                                       encoder.encode(value)))
+        chunk.append('}')
+        yield ''.join(chunk)
+
+class EncodedFeatureStream(FeatureStream):
+    """ A ``FeatureStream`` whose features are already encoded as GeoJSON
+    strings, typically by the database. """
+
+    def encode(self, feature, encoder):
+        return feature
+
 class Protocol(object):
     """ Protocol class.
 
@@ -184,6 +794,102 @@ class Protocol(object):
             a callback function called before a feature is deleted
             in the database table, the function receives the request
             and the database object about to be deleted.
+
+          chunk_size
+            the number of rows fetched at a time from the database when
+            reading features in stream mode (see ``read()``), and the
+            maximum number of identifiers per query when reading features
+            by identifiers. Defaults to 1000.
+
+          database_geojson
+            if ``True`` and the database is PostgreSQL, features read in
+            stream mode are encoded to GeoJSON by PostGIS, which spares
+            decoding the WKB geometries and encoding the features in
+            Python. To keep the JSON equivalent to the Python encoding,
+            it is only used when the geometries are left out or rounded
+            (see the ``precision`` option), when the exported keys are
+            columns, and when none of them is a timestamp with time zone.
+            Other reads and other databases use the Python encoding.
+            Requires PostgreSQL 9.5 or higher. Defaults to ``False``.
+
+          cache
+            a ``mapfish.cache.CacheBackend`` where the results of
+            ``read()`` and ``count()`` are cached, the entries are
+            invalidated when the table is modified through this protocol.
+            Reads with a custom filter or in stream mode are not cached.
+
+          estimate_threshold
+            when the client asks for an estimated count (see ``count()``),
+            the exact count is returned if the estimate is below this
+            number. Defaults to 100000.
+
+          etag
+            if ``True``, ``read()`` and ``count()`` set an ``ETag`` header
+            on the response when they are passed the response, and abort
+            with 304 if the request has a matching ``If-None-Match``
+            header, before querying the database. The ETag depends on the
+            request params and on a version of the table replaced every
+            time it is modified through the protocol. The versions are
+            stored in the ``cache`` backend, or else in the ``versions``
+            backend. With neither, or with an in-process backend such as
+            ``LRUCache``, the versions are held by each process and the
+            modifications done by other processes are not seen, so that
+            their clients keep stale responses; a warning is issued if
+            there is no backend. Requests with a custom filter have no ETag.
+            Defaults to ``False``.
+
+          versions
+            a cache backend shared by the processes serving the table (see
+            ``mapfish.cache.CacheBackend``), storing the versions of the
+            table used by the ``etag`` and ``memory`` options when the
+            protocol has no ``cache``.
+
+          precision
+            the number of decimals the coordinates of the features read
+            are rounded to, unless the client gives the ``precision``
+            parameter. Defaults to ``None``, no rounding.
+
+          cluster_size
+            the size, in pixels, of the grid cells the features are
+            grouped into when the client asks for clusters (see
+            ``read()``). Defaults to 40.
+
+          bulk_create
+            if ``True``, ``create()`` reads the existing objects of the
+            features with one query per ``chunk_size`` identifiers, and
+            writes the objects with one batched statement per set of
+            columns, an ``INSERT ... ON CONFLICT`` upsert, on PostgreSQL
+            and SQLite. On PostgreSQL the identifiers of the new objects are
+            taken from the sequence of the primary key beforehand, the new
+            objects are inserted through the ORM on the other databases.
+            ``before_create`` is called as usual. Defaults to ``False``.
+
+          batch_update
+            if ``True``, ``bulk_update()`` writes the modified objects with
+            one ``UPDATE ... FROM (VALUES ...)`` statement per
+            ``chunk_size`` objects on PostgreSQL and SQLite 3.33 or higher,
+            instead of one statement per object. Defaults to ``False``.
+
+          memory
+            a ``mapfish.memory.MemoryLayer`` holding the features of the
+            table in memory, ``read()`` then answers the requests with no
+            other params than a box, point or geometry filter, ``limit``
+            and ``offset`` from memory. The features are reloaded when the
+            table is modified through the protocol, see the ``etag``
+            option for the modifications done by other processes.
+
+          quantization
+            the number of cells per axis of the grid the coordinates of
+            the TopoJSON reads are quantized to (see ``read()``), unless
+            the client gives the ``quantization`` parameter. ``0`` or
+            ``None`` for no quantization. Defaults to 100000.
+
+          statement_cache
+            if ``True``, the SQL statements of the reads with the default
+            filter are compiled once per shape of the request, that is the
+            request params but the values of the geometry and attribute
+            filters, the limit and the offset, which are bind params. Only
+            PostgreSQL and SQLite are supported. Defaults to ``False``.
     """
 
     def __init__(self, Session, mapped_class, readonly=False, **kwargs):
@@ -200,6 +906,29 @@ class Protocol(object):
         self.before_delete = None
         if kwargs.has_key('before_delete'):
             self.before_delete = kwargs['before_delete']
+        self.chunk_size = kwargs.get('chunk_size', 1000)
+        self.database_geojson = kwargs.get('database_geojson', False)
+        self.cache = None
+        if kwargs.get('cache') is not None:
+            self.cache = ProtocolCache(kwargs['cache'])
+        self.versions = None
+        if kwargs.get('versions') is not None:
+            self.versions = ProtocolCache(kwargs['versions'])
+        self.etag = kwargs.get('etag', False)
+        if self.etag and self.cache is None and self.versions is None:
+            msg = "The ETags of %s depend on versions held in the process " \
+                  "memory, pass a shared cache or versions backend when " \
+                  "several processes modify the table" % mapped_class.__name__
+            warnings.warn(msg, Warning, 2)
+            log.warning(msg)
+        self.estimate_threshold = kwargs.get('estimate_threshold', 100000)
+        self.precision = kwargs.get('precision')
+        self.cluster_size = kwargs.get('cluster_size', 40)
+        self.memory = kwargs.get('memory')
+        self.bulk_create = kwargs.get('bulk_create', False)
+        self.batch_update = kwargs.get('batch_update', False)
+        self.quantization = kwargs.get('quantization', 100000)
+        self.statement_cache = kwargs.get('statement_cache', False)
 
     def _filter_attrs(self, feature, request):
         """ Remove some attributes from the feature and set the geometry to None
@@ -217,8 +946,106 @@ class Protocol(object):
             feature.geometry=None
         return feature
 
-    def _get_order_by(self, request):
-        """ Return an SA order_by """
+    def _get_projection(self, request):
+        """ Return the names of the attributes to export and whether the
+        geometry is to be left out, based on the ``attrs`` and the
+        ``no_geom`` parameters. """
+        attrs = None
+        if 'attrs' in request.params:
+            attrs = request.params['attrs'].split(',')
+        no_geom = asbool(request.params.get('no_geom', False))
+        return attrs, no_geom
+
+    def _get_deferred(self, request):
+        """ Return SA ``defer`` options for the columns that need not be
+        loaded from the database given the ``attrs`` and the ``no_geom``
+        parameters. """
+        attrs, no_geom = self._get_projection(request)
+        if attrs is None and not no_geom:
+            return []
+        mapper = class_mapper(self.mapped_class)
+        fid_column = self.mapped_class.primary_key_column().name
+        geom_column = self.mapped_class.geometry_column().name
+        sort_column = self._get_sort_column(request)
+        options = []
+        for name in self.mapped_class.__table__.c.keys():
+            if name == fid_column or not mapper.has_property(name):
+                continue
+            if sort_column is not None and name == sort_column.name:
+                # read to build the cursor of the next page
+                continue
+            if name == geom_column:
+                if no_geom:
+                    options.append(defer(name))
+            elif attrs is not None and name not in attrs:
+                options.append(defer(name))
+        return options
+
+    def _to_feature(self, obj, request):
+        """ Convert a mapped object to a feature, exporting only the
+        attributes requested by the client. """
+        attrs, no_geom = self._get_projection(request)
+        feature = self._filter_attrs(
+                obj.toFeature(attrs, no_geom, self._get_resolution(request),
+                              shapely=False),
+                request)
+        precision = self._get_precision(request)
+        if precision is not None:
+            # new objects are created, the geometry of the mapped object
+            # may be shared with other features
+            coordinates = getattr(feature.geometry, 'coordinates', None)
+            if coordinates is not None:
+                feature.geometry = feature.geometry.__class__(
+                        round_coordinates(coordinates, precision))
+            if feature.extra.get('bbox') is not None:
+                feature.extra['bbox'] = round_coordinates(
+                        feature.extra['bbox'], precision)
+        return feature
+
+    def _get_precision(self, request):
+        """ Return the number of decimals of the coordinates, given by the
+        ``precision`` parameter or the ``precision`` option, or None. """
+        if 'precision' in request.params:
+            return int(request.params['precision'])
+        return self.precision
+
+    def _get_resolution(self, request):
+        """ Return the resolution given by the ``resolution`` parameter, in
+        units of the geometry column per pixel, or None. """
+        if 'resolution' in request.params:
+            return float(request.params['resolution'])
+        return None
+
+    def _simplifies_in_database(self, request):
+        """ Return whether the geometries are simplified by the database,
+        based on the ``resolution`` and ``no_geom`` parameters. """
+        attrs, no_geom = self._get_projection(request)
+        return self._get_resolution(request) is not None and not no_geom \
+               and isinstance(self._dialect(), SimplifiedWKB.dialects)
+
+    def _objects(self, rows, request):
+        """ Generator returning the mapped objects of the rows of a query
+        built by ``_query``. If the database simplifies the geometries the
+        rows also include the simplified geometry, which is then set as the
+        shape of the object. """
+        if not self._simplifies_in_database(request):
+            for o in rows:
+                yield o
+        else:
+            geom_column = self.mapped_class.geometry_column().name
+            for o, data in rows:
+                if data is None:
+                    # the geometry is NULL, it is set as loaded for the
+                    # deferred column not to be read by another query
+                    o._mf_shape = None
+                    set_committed_value(o, geom_column, None)
+                else:
+                    o._mf_shape = wkb.loads(str(data))
+                yield o
+
+    def _get_sort_column(self, request):
+        """ Return the column given by the ``sort`` or ``order_by``
+        parameter, or None. """
         column_name = None
         if 'sort' in request.params:
             column_name = request.params['sort']
@@ -226,25 +1053,145 @@ class Protocol(object):
             column_name = request.params['order_by']
 
         if column_name and column_name in self.mapped_class.__table__.c:
-            column = self.mapped_class.__table__.c[column_name]
-            if 'dir' in request.params and request.params['dir'].upper() == 'DESC':
-                return desc(column)
-            else:
-                return asc(column)
-        else:
+            return self.mapped_class.__table__.c[column_name]
+        return None
+
+    def _is_descending(self, request):
+        return 'dir' in request.params and \
+               request.params['dir'].upper() == 'DESC'
+
+    def _get_order_by(self, request):
+        """ Return a list of SA order_by, the primary key is added as a
+        tie-breaker to the sort column so that the order is deterministic,
+        which the ``cursor`` parameter relies upon. """
+        column = self._get_sort_column(request)
+        fid_column = self.mapped_class.primary_key_column()
+        direction = desc if self._is_descending(request) else asc
+        if column is None:
+            if 'cursor' in request.params:
+                return [direction(fid_column)]
+            return []
+        if column is fid_column:
+            return [direction(column)]
+        return [direction(column), direction(fid_column)]
+
+    def _get_limit(self, request):
+        """ Return the limit given by the ``limit`` or ``maxfeatures``
+        parameter, or None. """
+        limit = None
+        if 'maxfeatures' in request.params:
+            limit = int(request.params['maxfeatures'])
+        if 'limit' in request.params:
+            limit = int(request.params['limit'])
+        return limit
+
+    def _encode_cursor(self, request, sort_value, fid):
+        """ Return the cursor pointing after the row whose sort key and
+        primary key are given, an opaque string for the client. """
+        values = [fid]
+        column = self._get_sort_column(request)
+        if column is not None and \
+           column is not self.mapped_class.primary_key_column():
+            values.insert(0, sort_value)
+        return urlsafe_b64encode(simplejson.dumps(values,
+                                                  default=_encode_value))
+
+    def _get_sort_value(self, request, obj):
+        """ Return the value of the sort column for ``obj``. """
+        column = self._get_sort_column(request)
+        if column is None:
+            return None
+        return getattr(obj, column.name)
+
+    def _get_next_cursor(self, request, count, fid, sort_value):
+        """ Return the cursor of the next page given the number of rows read
+        and the primary key and sort key of the last one. None is returned
+        if the page is not full, or if the client paginates with neither a
+        sort order nor a cursor. """
+        limit = self._get_limit(request)
+        if limit is None or count < limit or count == 0 or \
+           (self._get_sort_column(request) is None and \
+            'cursor' not in request.params):
             return None
+        return self._encode_cursor(request, sort_value, fid)
+
+    def _nulls_first(self, request):
+        """ Return whether the rows whose sort column is NULL come first in
+        the order of the read. PostgreSQL and Oracle sort NULL after the
+        other values, the other databases before. """
+        nulls_high = isinstance(self._dialect(), (PGDialect, OracleDialect))
+        return nulls_high == self._is_descending(request)
+
+    def _get_cursor_filter(self, request):
+        """ Return the filter selecting the rows after the position given by
+        the ``cursor`` parameter, or None. With an index on the sort column
+        and the primary key the cost of this filter does not depend on the
+        position, unlike ``offset``. The rows whose sort column is NULL are
+        placed as the database orders them, see ``_nulls_first``. """
+        if not request.params.get('cursor'):
+            # an empty cursor requests the first page
+            return None
+        column = self._get_sort_column(request)
+        fid_column = self.mapped_class.primary_key_column()
+        try:
+            # the numbers are decoded as decimals to be kept exact
+            values = simplejson.loads(
+                urlsafe_b64decode(str(request.params['cursor'])),
+                use_decimal=True)
+            if not isinstance(values, list) or len(values) == 0:
+                abort(400)
+            values[-1] = _coerce_value(fid_column.type, values[-1])
+            if len(values) == 2 and column is not None:
+                values[0] = _coerce_value(column.type, values[0])
+        except (TypeError, ValueError):
+            abort(400)
+
+        if self._is_descending(request):
+            op, op_or_equal = '__lt__', '__le__'
+        else:
+            op, op_or_equal = '__gt__', '__ge__'
+        if column is None or column is fid_column:
+            if len(values) != 1:
+                abort(400)
+            return getattr(fid_column, op)(values[0])
+        if len(values) != 2:
+            abort(400)
+        value, fid = values
+        if value is None:
+            # the NULL rows are compared on the primary key, and followed by
+            # the other rows if NULL comes first
+            filter = and_(column == None, getattr(fid_column, op)(fid))
+            if self._nulls_first(request):
+                filter = or_(filter, column != None)
+            return filter
+        if isinstance(self._dialect(), PGDialect):
+            # row value comparisons use multi-column indexes in PostgreSQL
+            filter = getattr(tuple_(column, fid_column), op)(
+                    tuple_(value, fid))
+        else:
+            # comparing the sort column first lets the other databases use
+            # an index on that column
+            filter = and_(getattr(column, op_or_equal)(value),
+                          or_(getattr(column, op)(value),
+                              and_(column == value,
+                                   getattr(fid_column, op)(fid))))
+        if column.nullable and not self._nulls_first(request):
+            # the comparisons are not true for the NULL rows
+            filter = or_(filter, column == None)
+        return filter
 
     def _query(self, request, filter=None, execute=True):
         """ Build a query based on the filter and the request params,
             and send the query to the database. """
 
-        limit = None
+        if filter is None and execute and self.statement_cache:
+            objs = self._cached_query(request)
+            if objs is not None:
+                return objs
+
+        limit = self._get_limit(request)
         offset = None
 
-        if 'maxfeatures' in request.params:
-            limit = int(request.params['maxfeatures'])
-        if 'limit' in request.params:
-            limit = int(request.params['limit'])
         if 'offset' in request.params:
             offset = int(request.params['offset'])
 
@@ -253,52 +1200,902 @@ class Protocol(object):
             filter = create_default_filter(request, self.mapped_class)
 
         query = self.Session.query(self.mapped_class).filter(filter)
+        query = query.options(*self._get_deferred(request))
+
+        cursor_filter = self._get_cursor_filter(request)
+        if cursor_filter is not None:
+            # the cursor replaces the offset
+            query = query.filter(cursor_filter)
+            offset = None
 
-        order_by = self._get_order_by(request)
-        if order_by is not None:
-            query = query.order_by(order_by)
+        query = query.order_by(*self._get_order_by(request))
 
         query = query.limit(limit).offset(offset)
 
+        if self._simplifies_in_database(request):
+            # the geometry is replaced by a simplified geometry
+            geom_column = self.mapped_class.geometry_column()
+            query = query.options(defer(geom_column.name)).add_columns(
+                    SimplifiedWKB(geom_column, self._get_resolution(request)))
+
         if execute:
-            return query.all()
+            return list(self._objects(query, request))
         else:
             return query
 
-    def count(self, request, filter=None):
-        """ Return the number of records matching the given filter. """
+    # the request params of the reads whose statements are cached, see
+    # _get_shape
+    _shape_params = ('bbox', 'lon', 'lat', 'geometry', 'tolerance', 'epsg',
+                     'queryable', 'limit', 'maxfeatures', 'offset', 'sort',
+                     'order_by', 'dir', 'attrs', 'no_geom', 'precision',
+                     'quantization')
+
+    def _get_shape(self, request):
+        """ Return the shape of the request, a tuple identifying the SQL
+        statement of the read with the default filter, and the values of
+        the bind params of the statement, or None if the statement of the
+        request is not cached. """
+        for name in request.params:
+            if name in ProtocolCache.params and \
+               name not in self._shape_params:
+                return None
+        if not isinstance(self._dialect(), (PGDialect, SQLiteDialect)):
+            # MySQL's envelope filter does not take bind params
+            return None
+
+        values = {}
+        geometry, epsg, tolerance = _get_geom_params(request)
+        if geometry is not None:
+            srid = self.mapped_class.geometry_column().type.srid
+            if epsg is not None and epsg != srid:
+                geometry = _project_geometry(geometry, tolerance, epsg, srid)
+                if geometry is None:
+                    # the column is transformed by the database
+                    return None
+                tolerance = 0
+            values.update(geometry=buffer(geometry.wkb), tolerance=tolerance)
+
+        attr_params = []
+        for k, col, op in _get_attr_params(request):
+            values[k] = request.params[k]
+            attr_params.append((k, col, op))
+        attr_params.sort()
+
+        attrs, no_geom = self._get_projection(request)
+        if attrs is not None:
+            attrs = tuple(sorted(attrs))
+        sort_column = self._get_sort_column(request)
+        if sort_column is not None:
+            sort_column = sort_column.name
+        limit = self._get_limit(request)
+        if limit is not None:
+            values['limit'] = limit
+        if 'offset' in request.params:
+            values['offset'] = int(request.params['offset'])
+
+        shape = (geometry is not None, tuple(attr_params), attrs, no_geom,
+                 sort_column, self._is_descending(request),
+                 'limit' in values, 'offset' in values)
+        return shape, values
+
+    def _shape_statement(self, request, shape):
+        """ Return the select statement of the reads of the given shape,
+        whose values are bind params, and the statement to execute, which
+        adds the limit and the offset. """
+        has_geometry, attr_params = shape[:2]
+        filters = []
+        if has_geometry:
+            geom_column = self.mapped_class.geometry_column()
+            srid = geom_column.type.srid
+            geometry = _wkb_bindparam('geometry', srid)
+            # the exact test uses the spatial index of PostgreSQL and
+            # SQLite, see PreFiltered
+            filters.append(_geom_filter(geom_column, geometry,
+                                        bindparam('tolerance'), None, srid))
+        for k, col, op in attr_params:
+            column = getattr(self.mapped_class, col)
+            # typed as the values compared to the column by
+            # create_attr_filter
+            filters.append(getattr(column, op)(
+                bindparam(k, type_=column.property.columns[0].type)))
+
+        has_limit, has_offset = shape[-2:]
+        query = self.Session.query(self.mapped_class)
+        if len(filters) > 0:
+            query = query.filter(and_(*filters))
+        query = query.options(*self._get_deferred(request))
+        query = query.order_by(*self._get_order_by(request))
+        return query.statement, Paginated(query.statement, has_limit,
+                                          has_offset)
+
+    def _cached_query(self, request):
+        """ Execute the query of a read with the default filter, compiled
+        once per shape of the request (see ``_get_shape``) and dialect.
+        Return the mapped objects, or None if the statement of the request
+        is not cached. """
+        shape = self._get_shape(request)
+        if shape is None:
+            return None
+        shape, values = shape
+
+        dialect = self._dialect()
+        key = (self.mapped_class, dialect, shape)
+        entry = _statements.get(key)
+        if entry is None:
+            statement, paginated = self._shape_statement(request, shape)
+            entry = (statement, paginated.compile(dialect=dialect))
+            _statements.set(key, entry)
+        statement, compiled = entry
+
+        if self.Session.autoflush:
+            self.Session.flush()
+        mapper = class_mapper(self.mapped_class)
+        result = self.Session.connection(mapper=mapper).execute(compiled,
+                                                                values)
+        query = self.Session.query(self.mapped_class)
+        query = query.options(*self._get_deferred(request))
+        return list(query.from_statement(statement).instances(result))
+
+    def _cached(self, request, kind, func, *args):
+        """ Return the result of ``func()``, from the cache if possible.
+        ``args`` are added to the cache key. """
+        key = self.cache.key(self.mapped_class, request, kind, *args)
+        ret = self.cache.get(key)
+        if ret is None:
+            ret = func()
+            self.cache.set(key, ret)
+        return ret
+
+    def _get_versions(self):
+        """ Return the ``ProtocolCache`` holding the version of the
+        table. """
+        if self.cache is not None:
+            return self.cache
+        if self.versions is not None:
+            return self.versions
+        return _versions
+
+    def _invalidate(self):
+        """ To be called once modifications of the table are committed. """
+        self._get_versions().invalidate(self.mapped_class)
+
+    def _check_etag(self, request, response, kind, *args):
+        """ Set the ETag header of the response, or abort with 304 if the
+        client already has the current version of the response. """
+        key = self._get_versions().key(self.mapped_class, request, kind,
+                                       *args)
+        etag = '"%s"' % sha1(key).hexdigest()
+        if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            if '*' in tags or etag in tags or 'W/' + etag in tags:
+                abort(304, headers=[('ETag', etag)])
+        response.headers['ETag'] = etag
+
+    def count(self, request, filter=None, response=None):
+        """ Return the number of records matching the given filter.
+
+        If the ``estimate`` param is true and the database is PostgreSQL,
+        the number estimated by the query planner is returned, unless it is
+        below the ``estimate_threshold`` option. When passed the response,
+        this method sets its ``X-Count-Type`` header to ``estimated`` or
+        ``exact``. See also the ``etag`` option. """
+        if self.etag and filter is None and response is not None:
+            self._check_etag(request, response, 'count')
+        if self.cache is not None and filter is None:
+            count, estimated = self._cached(request, 'count',
+                                            lambda: self._count(request))
+        else:
+            count, estimated = self._count(request, filter)
+        if response is not None:
+            response.headers['X-Count-Type'] = \
+                    'estimated' if estimated else 'exact'
+        return count
+
+    def _count(self, request, filter=None):
+        """ Return the number of records matching the given filter, as a
+        string, and whether this number is an estimate. """
         if filter is None:
             filter = create_default_filter(request, self.mapped_class)
-        return str(self.Session.query(self.mapped_class).filter(filter).count())
+        if asbool(request.params.get('estimate', False)) and \
+           isinstance(self._dialect(), PGDialect):
+            estimate = self._estimate_count(filter)
+            if estimate >= self.estimate_threshold:
+                return str(estimate), True
+        query = self.Session.query(self.mapped_class).filter(filter)
+        return str(query.count()), False
+
+    def _estimate_count(self, filter=None):
+        """ Return the number of records matching the given filter as
+        estimated by PostgreSQL, from the table statistics if there is no
+        filter, and from the query plan otherwise. """
+        if filter is None:
+            preparer = self._dialect().identifier_preparer
+            name = preparer.format_table(self.mapped_class.__table__)
+            reltuples = self.Session.execute(
+                    'SELECT reltuples FROM pg_class '
+                    'WHERE oid = CAST(:name AS regclass)',
+                    {'name': name},
+                    mapper=self.mapped_class).scalar()
+            # reltuples is -1 for tables that were never analyzed
+            return max(int(reltuples or 0), 0)
+        query = self.Session.query(self.mapped_class.primary_key_column())
+        plan = self.Session.execute(Explain(query.filter(filter).statement),
+                                    mapper=self.mapped_class).fetchone()
+        match = re.search(r' rows=(\d+) ', plan[0])
+        return int(match.group(1)) if match else 0
+
+    def _stream(self, query, request, members):
+        """ Generator converting the objects of the query to features, the
+        rows are read from the database in batches of ``chunk_size``. The
+        cursor of the next page is stored in ``members``. The session is
+        closed once the rows are consumed, as the stream is usually
+        iterated after the controller action has returned. """
+        count, o = 0, None
+        try:
+            for o in self._objects(query.yield_per(self.chunk_size), request):
+                count += 1
+                yield self._to_feature(o, request)
+            if o is not None:
+                cursor = self._get_next_cursor(request, count, o.fid,
+                                               self._get_sort_value(request, o))
+                if cursor is not None:
+                    members['cursor'] = cursor
+        finally:
+            self.Session.close()
+
+    def _dialect(self):
+        """ Return the SQLAlchemy dialect of the database the mapped class
+        is bound to. """
+        return self.Session.get_bind(self.mapped_class).dialect
+
+    def _get_exported_keys(self, request):
+        """ Return the names of the feature properties, based on the
+        ``exported_keys`` of the mapped class and the ``attrs``
+        parameter. """
+        attrs, no_geom = self._get_projection(request)
+        fid_column = self.mapped_class.primary_key_column()
+        geom_column = self.mapped_class.geometry_column()
+
+        exported = self.mapped_class.exported_keys or \
+                   self.mapped_class.__table__.c.keys()
+        if attrs is not None:
+            exported = [k for k in exported if k in attrs]
+        return [str(k) for k in exported
+                if str(k) not in (fid_column.name, geom_column.name)]
+
+    def _get_exported_columns(self, request):
+        """ Return the columns of the feature properties, the exported keys
+        that are not columns are left out. """
+        table = self.mapped_class.__table__
+        return [table.c[name] for name in self._get_exported_keys(request)
+                if name in table.c]
+
+    def _encodes_in_database(self, request):
+        """ Return whether the features of a read in stream mode are
+        encoded by PostGIS, see the ``database_geojson`` option. """
+        if not self.database_geojson or \
+           not isinstance(self._dialect(), PGDialect):
+            return False
+        attrs, no_geom = self._get_projection(request)
+        if not no_geom and self._get_precision(request) is None:
+            return False
+        table = self.mapped_class.__table__
+        for name in self._get_exported_keys(request):
+            if name not in table.c:
+                # a property of the mapped class
+                return False
+            type = table.c[name].type
+            if isinstance(type, types.DateTime) and type.timezone:
+                return False
+        return True
 
-    def read(self, request, filter=None, id=None):
+    def _json_query(self, query, request):
+        """ Return a query whose rows are made of the feature identifier,
+        the sort key, the properties as JSON, the geometry as GeoJSON and
+        the bounds of the geometry, all computed by PostGIS. """
+        attrs, no_geom = self._get_projection(request)
+        fid_column = self.mapped_class.primary_key_column()
+        geom_column = RawColumn(self.mapped_class.geometry_column())
+
+        args = []
+        for column in self._get_exported_columns(request):
+            name = column.name
+            # MapFishEncoder encodes dates as str() does, and decimals as
+            # numbers as json_build_object does
+            if isinstance(column.type, types.DateTime):
+                seconds = func.to_char(column, 'YYYY-MM-DD HH24:MI:SS')
+                column = case([(func.to_char(column, 'US') == '000000',
+                                seconds)],
+                              else_=func.to_char(column,
+                                                 'YYYY-MM-DD HH24:MI:SS.US'))
+            elif isinstance(column.type, types.Date):
+                column = func.to_char(column, 'YYYY-MM-DD')
+            args.extend([literal(name), column])
+
+        # json_build_object takes up to 100 arguments, wider tables are
+        # processed by merging several jsonb objects
+        if len(args) <= 100:
+            properties = func.json_build_object(*args)
+        else:
+            properties = func.jsonb_build_object(*args[:100])
+            for i in range(100, len(args), 100):
+                properties = properties.op('||')(
+                    func.jsonb_build_object(*args[i:i + 100]))
+        properties = cast(properties, types.UnicodeText)
+
+        sort_column = self._get_sort_column(request)
+        if sort_column is None:
+            sort_column = fid_column
+
+        if no_geom:
+            return query.with_entities(fid_column, sort_column, properties)
+
+        resolution = self._get_resolution(request)
+        if resolution is not None:
+            geom_column = func.ST_SimplifyPreserveTopology(geom_column,
+                                                           resolution)
+        precision = self._get_precision(request)
+        if precision is None:
+            geometry = func.ST_AsGeoJSON(geom_column)
+        else:
+            geometry = func.ST_AsGeoJSON(geom_column, precision)
+        return query.with_entities(fid_column, sort_column, properties,
+                                   geometry,
+                                   func.ST_XMin(geom_column),
+                                   func.ST_YMin(geom_column),
+                                   func.ST_XMax(geom_column),
+                                   func.ST_YMax(geom_column))
+
+    def _stream_json(self, query, request, members):
+        """ Generator yielding the features of the query as GeoJSON strings,
+        the features are encoded by the database and the strings are
+        formatted like the ``MapFishEncoder`` output. """
+        precision = self._get_precision(request)
+        count, row = 0, None
+        try:
+            for row in query.yield_per(self.chunk_size):
+                count += 1
+                geometry = None
+                if len(row) > 3:
+                    geometry = row[3]
+                    bbox = row[4:8]
+                    if precision is not None:
+                        bbox = round_coordinates(bbox, precision)
+                if geometry is None:
+                    yield '{"geometry": null, "id": %s, "type": "Feature", ' \
+                          '"properties": %s}' % (simplejson.dumps(row[0]),
+                                                 row[2])
+                else:
+                    yield '{"geometry": %s, "id": %s, "type": "Feature", ' \
+                          '"bbox": [%r, %r, %r, %r], "properties": %s}' % (
+                          geometry, simplejson.dumps(row[0]),
+                          bbox[0], bbox[1], bbox[2], bbox[3], row[2])
+            if row is not None:
+                cursor = self._get_next_cursor(request, count, row[0], row[1])
+                if cursor is not None:
+                    members['cursor'] = cursor
+        finally:
+            self.Session.close()
+
+    def read(self, request, filter=None, id=None, stream=False,
+             response=None, format=None):
         """ Build a query based on the filter or the idenfier, send the query
-        to the database, and return a Feature or a FeatureCollection. """
+        to the database, and return a Feature or a FeatureCollection. If
+        ``stream`` is ``True`` a ``FeatureStream`` is returned instead of a
+        FeatureCollection, the query is then executed when the stream is
+        iterated and the features are encoded as they are read from the
+        database.
+
+        If the ``resolution`` parameter is given, in units of the geometry
+        column per pixel, the geometries are simplified with this tolerance,
+        by the database on PostGIS and SpatiaLite and once read otherwise.
+        If the ``precision`` parameter or option is given, the coordinates
+        are rounded to this number of decimals.
+
+        If the ``ids`` parameter is given, a comma-separated list of
+        identifiers, the features with these identifiers are returned in
+        the same order, and the collection includes a ``missing`` member
+        listing the identifiers that were not found.
+
+        If the ``cluster`` parameter is true, the features are grouped into
+        the cells of a grid whose size is ``cluster_size`` pixels at the
+        given ``resolution``, which is then required, and one point feature
+        is returned per cell, at the centroid of its features, with the
+        number of features as ``count`` property. The cells are computed by
+        the database on PostGIS and in Python otherwise.
+
+        For keyset pagination the client passes ``limit`` and an empty
+        ``cursor`` parameter, possibly with ``sort`` and ``dir``; if more
+        features are available the collection includes a ``cursor`` member
+        whose value is to be passed as the ``cursor`` parameter to get the
+        next page. The features whose sort column is NULL are paged as the
+        database orders them, last in ascending order on PostgreSQL and
+        Oracle, first on the other databases.
+
+        With the ``memory`` option the features read from memory are
+        decoded from their JSON encoding into a FeatureCollection, their
+        dates are then strings, or returned as an ``EncodedFeatureStream``
+        if ``stream`` is ``True``.
+
+        If ``format`` is given, or else the ``format`` parameter, or else
+        if the ``Accept`` header of the request names the media type of a
+        format of ``mapfish.export.FORMATS`` (``fgb``, ``gpkg`` or ``shp``),
+        the features are returned in a file of that format, as a
+        ``mapfish.export.ExportStream``. The file is written as the
+        features are read from the database, with the query of the
+        GeoJSON reads, and the ``attrs``, ``no_geom``, ``resolution`` and
+        ``ids`` parameters apply, the coordinates are not rounded. The
+        ``cluster`` parameter aborts with 400. The ``json`` and ``geojson``
+        formats are the GeoJSON reads, other formats abort with 400.
+
+        With the ``topojson`` format the features are returned as a TopoJSON
+        topology, a dict, whose boundaries shared by adjacent features are
+        stored once, see ``mapfish.topojson``. The features are those of
+        the GeoJSON read, including with the ``ids`` and ``cluster``
+        parameters, and are the geometries of an object named after the
+        table. The coordinates are quantized with the ``quantization``
+        parameter or option, ``0`` for no quantization. ``stream`` is
+        ignored, the arcs depend on all the features.
+
+        See the ``etag`` option for the ``response`` argument. """
+        key = (id,)
+        if id is None:
+            format = self._get_format(request, format)
+            if format == 'topojson':
+                key = (id, format)
+            elif format is not None:
+                if asbool(request.params.get('cluster', False)):
+                    abort(400)
+                return self._export(request, filter, format)
+        else:
+            format = None
+        if self.etag and filter is None and response is not None:
+            self._check_etag(request, response, 'read', *key)
+        if self.memory is not None and filter is None and id is None and \
+           format is None:
+            ret = self._read_memory(request, stream)
+            if ret is not None:
+                return ret
+        if self.cache is not None and filter is None and \
+           (not stream or format is not None):
+            return self._cached(request, 'read',
+                                lambda: self._read(request, id=id,
+                                                   format=format), *key)
+        return self._read(request, filter, id, stream, format)
+
+    def _read(self, request, filter=None, id=None, stream=False,
+              format=None):
         ret = None
         if id is not None:
-            o = self.Session.query(self.mapped_class).get(id)
+            query = self.Session.query(self.mapped_class)
+            o = query.options(*self._get_deferred(request)).get(id)
             if o is None:
                 abort(404)
-            ret = self._filter_attrs(o.toFeature(), request)
+            ret = self._to_feature(o, request)
+        elif 'ids' in request.params:
+            ret = self._read_ids(request, filter)
+        elif asbool(request.params.get('cluster', False)):
+            ret = self._cluster(request, filter)
+        elif stream and format is None:
+            query = self._query(request, filter, execute=False)
+            members = {}
+            if self._encodes_in_database(request):
+                query = self._json_query(query, request)
+                ret = EncodedFeatureStream(
+                        self._stream_json(query, request, members),
+                        members=members)
+            else:
+                ret = FeatureStream(self._stream(query, request, members),
+                                    members=members)
         else:
             objs = self._query(request, filter)
             ret = FeatureCollection(
-                    [self._filter_attrs(o.toFeature(), request) \
-                        for o in objs])
+                    [self._to_feature(o, request) for o in objs])
+            if len(objs) > 0:
+                cursor = self._get_next_cursor(
+                        request, len(objs), objs[-1].fid,
+                        self._get_sort_value(request, objs[-1]))
+                if cursor is not None:
+                    ret.extra['cursor'] = cursor
+        if format == 'topojson':
+            ret = self._topojson(request, ret)
         return ret
 
-    def create(self, request, response, execute=True):
+    def _get_quantization(self, request):
+        """ Return the quantization of the TopoJSON coordinates, given by
+        the ``quantization`` parameter or the ``quantization`` option, or
+        None. """
+        if 'quantization' in request.params:
+            quantization = int(request.params['quantization'])
+        else:
+            quantization = self.quantization
+        return quantization or None
+
+    def _topojson(self, request, collection):
+        """ Return the features of a FeatureCollection as a TopoJSON
+        topology, with the additional members of the collection. """
+        try:
+            ret = topojson.topology(collection.features,
+                                    self._get_quantization(request),
+                                    self.mapped_class.__table__.name)
+        except ValueError:
+            abort(400)
+        ret.update(collection.extra)
+        return ret
+
+    def _get_format(self, request, format=None):
+        """ Return the format given by ``format``, the ``format`` parameter
+        or the ``Accept`` header, an export format or ``topojson``, or None
+        for GeoJSON. """
+        if format is None:
+            format = request.params.get('format')
+        if format is None:
+            accept = request.environ.get('HTTP_ACCEPT', '')
+            types = [t.split(';')[0].strip() for t in accept.split(',')]
+            for name, writer in export.FORMATS.items():
+                if writer.content_type in types:
+                    return name
+            return None
+        if format in ('json', 'geojson'):
+            return None
+        if format not in export.FORMATS and format != 'topojson':
+            abort(400)
+        return format
+
+    def _export(self, request, filter, format):
+        """ Return the features of the read as an ``ExportStream`` of the
+        given format. """
+        geom_column = self.mapped_class.geometry_column()
+        attrs, no_geom = self._get_projection(request)
+        columns = self._get_exported_columns(request)
+        fields = [(c.name,) + _field_kind(c.type) for c in columns]
+        geometry_type = type(geom_column.type).__name__
+        if geometry_type not in wkb_types:
+            geometry_type = None
+        srid = geom_column.type.srid
+        if srid is not None and srid <= 0:
+            srid = None
+        writer = export.FORMATS[format](
+                self.mapped_class.__table__.name, fields, geometry_type, srid,
+                getattr(geom_column.type, 'dimension', 2) > 2 and not no_geom)
+        if 'ids' in request.params:
+            # the identifiers are checked before the response is started
+            objects = self._iter_ids(self._get_ids(request), request, filter)
+        else:
+            query = self._query(request, filter, execute=False)
+            objects = self._objects(query.yield_per(self.chunk_size),
+                                    request)
+        features = self._export_features(objects, request, columns)
+        return export.ExportStream(writer.write(features),
+                                   writer.content_type,
+                                   '%s.%s' % (writer.name, writer.extension))
+
+    def _export_features(self, objects, request, columns):
+        """ Generator returning the objects, read from the database in
+        batches of ``chunk_size``, as ``(fid, wkb, properties)`` tuples. The
+        session is closed once the objects are consumed. """
+        attrs, no_geom = self._get_projection(request)
+        resolution = self._get_resolution(request)
+        try:
+            for o in objects:
+                properties = dict((c.name, getattr(o, c.name, None))
+                                  for c in columns)
+                data, shape = None, getattr(o, '_mf_shape', None)
+                if no_geom:
+                    pass
+                elif shape is not None:
+                    # simplified by the database, or written through the
+                    # protocol
+                    data = shape.wkb if hasattr(shape, 'wkb') \
+                           else dumps_wkb(shape)
+                elif getattr(o.geometry, 'geom_wkb', None) is not None:
+                    data = str(o.geometry.geom_wkb)
+                    if resolution is not None:
+                        data = wkb.loads(data).simplify(
+                                resolution, preserve_topology=True).wkb
+                yield o.fid, data, properties
+        finally:
+            self.Session.close()
+
+    def _read_memory(self, request, stream=False):
+        """ Return the features matching the request params from the memory
+        layer as a FeatureCollection, or as an ``EncodedFeatureStream`` if
+        ``stream`` is ``True``, or None if the request cannot be answered
+        from memory. """
+        for name in request.params:
+            if name in ProtocolCache.params and \
+               name not in self.memory.params:
+                return None
+        index = self.memory.get(
+                self._get_versions().version(self.mapped_class),
+                self._load_memory)
+        if index.encoded is None:
+            # too many features
+            return None
+
+        geometry, epsg, tolerance = _get_geom_params(request)
+        srid = self.mapped_class.geometry_column().type.srid
+        if geometry is not None and epsg is not None and epsg != srid:
+            geometry = _project_geometry(geometry, tolerance, epsg, srid)
+            if geometry is None:
+                return None
+            tolerance = 0
+
+        features = index.query(geometry, tolerance)
+        offset = int(request.params.get('offset', 0))
+        limit = self._get_limit(request)
+        if limit is not None:
+            features = features[offset:offset + limit]
+        elif offset:
+            features = features[offset:]
+        if stream:
+            return EncodedFeatureStream(features)
+        return FeatureCollection([loads(f, object_hook=GeoJSON.to_instance)
+                                  for f in features])
+
+    def _load_memory(self):
+        """ Return the geometries and the encoded features of the table,
+        see ``mapfish.memory.MemoryIndex``, or None if the table has more
+        features than the memory layer holds. """
+        query = self.Session.query(self.mapped_class)
+        count = query.count()
+        if count > self.memory.max_features:
+            log.warning('%s has %d features, it is not held in memory' % (
+                        self.mapped_class.__name__, count))
+            return None
+        encoder = MapFishEncoder(precision=self.precision)
+        fid_column = self.mapped_class.primary_key_column()
+        features = []
+        query = query.order_by(fid_column).yield_per(self.chunk_size)
+        for o in query:
+            feature = o.toFeature()
+            geometry = None
+            if feature.geometry is not None:
+                geometry = shape(feature.geometry)
+            features.append((geometry, encoder.encode(feature)))
+        return features
+
+    def _get_ids(self, request):
+        """ Return the identifiers given by the ``ids`` parameter, converted
+        to the type of the primary key (see ``_coerce_id``) and without
+        duplicates, as ``(id, param)`` tuples where ``param`` is the
+        identifier as given. Abort with 400 if an identifier cannot be
+        converted. """
+        ids, seen = [], set()
+        for param in request.params['ids'].split(','):
+            param = param.strip()
+            if not param:
+                continue
+            id = self._coerce_id(param)
+            if unicode(id) not in seen:
+                ids.append((id, param))
+                seen.add(unicode(id))
+        return ids
+
+    def _read_ids(self, request, filter=None):
+        """ Return the features whose identifiers are given by the ``ids``
+        parameter as a FeatureCollection. The ``missing`` member lists the
+        identifiers with no feature as they are given. """
+        ids = self._get_ids(request)
+        objs = self._get_objects([id for id, param in ids], filter,
+                                 self._get_deferred(request))
+
+        features, missing = [], []
+        for id, param in ids:
+            if unicode(id) in objs:
+                features.append(self._to_feature(objs[unicode(id)], request))
+            else:
+                missing.append(param)
+        ret = FeatureCollection(features)
+        ret.extra['missing'] = missing
+        return ret
+
+    def _iter_ids(self, ids, request, filter=None):
+        """ Generator returning the objects whose identifiers, as returned
+        by ``_get_ids``, are given, in the same order, read ``chunk_size``
+        identifiers at a time. """
+        ids = [id for id, param in ids]
+        options = self._get_deferred(request)
+        for i in range(0, len(ids), self.chunk_size):
+            chunk = ids[i:i + self.chunk_size]
+            objs = self._get_objects(chunk, filter, options)
+            for id in chunk:
+                if unicode(id) in objs:
+                    yield objs[unicode(id)]
+
+    def _get_objects(self, ids, filter=None, options=()):
+        """ Return the objects whose identifiers are in ``ids`` and that
+        match the filter, by identifier as a unicode string, read with one
+        query per ``chunk_size`` identifiers. """
+        fid_column = self.mapped_class.primary_key_column()
+        objs = {}
+        # the IN lists are kept short, Oracle for one limits them to
+        # 1000 items
+        for i in range(0, len(ids), self.chunk_size):
+            query = self.Session.query(self.mapped_class).options(*options)
+            query = query.filter(fid_column.in_(ids[i:i + self.chunk_size]))
+            if filter is not None:
+                query = query.filter(filter)
+            for o in query:
+                objs[unicode(o.fid)] = o
+        return objs
+
+    def _cluster(self, request, filter=None):
+        """ Return the features grouped into the cells of a grid as a
+        FeatureCollection of points. """
+        resolution = self._get_resolution(request)
+        if resolution is None:
+            abort(400)
+        size = resolution * self.cluster_size
+
+        if filter is None:
+            filter = create_default_filter(request, self.mapped_class)
+
+        if isinstance(self._dialect(), PGDialect):
+            cells = self._cluster_query(filter, size).all()
+        else:
+            geom_column = self.mapped_class.geometry_column()
+            query = self.Session.query(geom_column).filter(filter)
+            points = []
+            for g, in query.yield_per(self.chunk_size):
+                if g is None or g.geom_wkb is None:
+                    continue
+                centroid = wkb.loads(str(g.geom_wkb)).centroid
+                if not centroid.is_empty:
+                    points.append((centroid.x, centroid.y))
+            cells = _grid_cells(points, size)
+
+        precision = self._get_precision(request)
+        features = []
+        for count, x, y in cells:
+            if precision is not None:
+                x, y = round(x, precision), round(y, precision)
+            features.append(Feature(geometry=Point(x, y),
+                                    properties={'count': int(count)}))
+        return FeatureCollection(features)
+
+    def _cluster_query(self, filter, size):
+        """ Return the query of the (count, x, y) tuples of the grid cells,
+        computed by PostGIS. """
+        geom_column = self.mapped_class.geometry_column()
+        centroid = func.ST_Centroid(RawColumn(geom_column))
+        query = self.Session.query(func.count(centroid),
+                                   func.avg(func.ST_X(centroid)),
+                                   func.avg(func.ST_Y(centroid)))
+        query = query.filter(filter).filter(RawColumn(geom_column) != None)
+        return query.group_by(func.ST_SnapToGrid(centroid, size))
+
+    def tile(self, request, z, x, y, filter=None, response=None):
+        """ Return the features intersecting the tile ``z/x/y`` of the web
+        mercator tiling scheme as a Mapbox Vector Tile, a string. If no
+        filter is given the attribute filter of the request params is used
+        (see ``create_attr_filter()``), and the ``attrs`` parameter
+        restricts the properties of the features. The tile has one layer,
+        named after the table.
+
+        On PostgreSQL the tile is encoded by PostGIS, which requires
+        PostGIS 3.0 or higher. Otherwise it is encoded by
+        ``mapfish.mvt``, which requires pyproj if the geometry column is
+        not in EPSG:3857.
+
+        See the ``etag`` option for the ``response`` argument. """
+        z, x, y = int(z), int(x), int(y)
+        if self.etag and filter is None and response is not None:
+            self._check_etag(request, response, 'tile', z, x, y)
+        if self.cache is not None and filter is None:
+            return self._cached(request, 'tile',
+                                lambda: self._tile(request, z, x, y),
+                                z, x, y)
+        return self._tile(request, z, x, y, filter)
+
+    def _tile(self, request, z, x, y, filter=None):
+        if z < 0 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            abort(404)
+        bounds = mvt.tile_bounds(z, x, y)
+
+        if filter is None:
+            filter = create_attr_filter(request, self.mapped_class)
+        # the features in the buffer of the tile are kept
+        margin = (bounds[2] - bounds[0]) * mvt.BUFFER / mvt.EXTENT
+        geometry = Polygon(((bounds[0] - margin, bounds[1] - margin),
+                            (bounds[0] - margin, bounds[3] + margin),
+                            (bounds[2] + margin, bounds[3] + margin),
+                            (bounds[2] + margin, bounds[1] - margin),
+                            (bounds[0] - margin, bounds[1] - margin)))
+        filter = and_(_create_geom_filter(geometry, 3857, 0, self.mapped_class),
+                      filter)
+
+        if isinstance(self._dialect(), PGDialect):
+            data = self.Session.execute(
+                    self._tile_query(request, filter, bounds),
+                    mapper=self.mapped_class).scalar()
+            return str(data) if data is not None else ''
+
+        srid = self.mapped_class.geometry_column().type.srid
+        transform = None
+        if srid != 3857:
+            transform = _get_transform(srid, 3857)
+            if transform is None:
+                abort(501)
+
+        attrs, no_geom = self._get_projection(request)
+        layer = mvt.Layer(self.mapped_class.__table__.name, bounds)
+        query = self.Session.query(self.mapped_class).filter(filter)
+        for o in query.yield_per(self.chunk_size):
+            if o.geometry is None or o.geometry.geom_wkb is None:
+                continue
+            geometry = wkb.loads(str(o.geometry.geom_wkb))
+            if transform is not None:
+                geometry = _transform_geometry(geometry, transform)
+            properties = o.toFeature(attrs, no_geom=True).properties
+            layer.add_feature(geometry, properties, o.fid)
+        return mvt.encode([layer])
+
+    def _tile_query(self, request, filter, bounds):
+        """ Return the statement making PostGIS encode the features of the
+        filter as a vector tile of the given bounds. """
+        fid_column = self.mapped_class.primary_key_column()
+        geom_column = self.mapped_class.geometry_column()
+        srid = geom_column.type.srid
+        geom_column = RawColumn(geom_column)
+        if srid != 3857:
+            geom_column = func.ST_Transform(geom_column, 3857)
+        envelope = func.ST_MakeEnvelope(*(bounds + (3857,)))
+        geometry = func.ST_AsMVTGeom(geom_column, envelope, mvt.EXTENT,
+                                     mvt.BUFFER, True).label('mvt_geom')
+
+        columns = [fid_column] + self._get_exported_columns(request)
+        rows = self.Session.query(*(columns + [geometry])).filter(filter)
+        rows = rows.subquery('mvt_rows')
+        return select([func.ST_AsMVT(literal_column(rows.name),
+                                     self.mapped_class.__table__.name,
+                                     mvt.EXTENT, 'mvt_geom', fid_column.name)],
+                      from_obj=rows)
+
+    def create(self, request, response, execute=True, stream=False):
         """ Read the GeoJSON feature collection from the request body and
-            create new objects in the database. """
+            create new objects in the database.
+
+        The body is parsed one feature at a time. If ``stream`` is ``True``
+        the features are also written to the database in batches of
+        ``chunk_size`` features as they are parsed, each batch being
+        committed, and the created features are returned as an
+        ``EncodedFeatureStream``, so that large collections are never held
+        in memory. Only the first batch is created before this method
+        returns, the next ones are created as the stream is iterated. """
         if self.readonly:
             abort(403)
-        content = request.environ['wsgi.input'].read(int(request.environ['CONTENT_LENGTH']))
-        factory = lambda ob: GeoJSON.to_instance(ob)
-        collection = loads(content, object_hook=factory)
-        if not isinstance(collection, FeatureCollection):
+        features = _read_features(request.environ['wsgi.input'],
+                                  int(request.environ['CONTENT_LENGTH']))
+        if stream:
+            return self._create_stream(request, response, features)
+        try:
+            features = list(features)
+        except ValueError:
             abort(400)
+        objects = self._create_objects(request, features, execute)
+        # We call flush, create the feature collection, and then commit. Commit
+        # expires the session, so we create the feature collection before
+        # commit to avoid SELECT queries in toFeature.
+        if execute:
+            self.Session.flush()
+        collection = None
+        if len(objects) > 0:
+            collection = FeatureCollection([o.toFeature() for o in objects])
+        if execute:
+            self.Session.commit()
+            self._invalidate()
+        response.status = 201
+        return collection
+
+    def _create_objects(self, request, features, execute=True):
+        """ Create or update the objects of the features, and return the
+        objects. """
+        if self.bulk_create and execute:
+            return self._bulk_create(request, features)
         objects = []
-        for feature in collection.features:
+        for feature in features:
             create = False
             obj = None
             if feature.id is not None:
@@ -312,18 +2109,148 @@ class Protocol(object):
             if create:
                 self.Session.add(obj)
             objects.append(obj)
-        # We call flush, create the feature collection, and then commit. Commit
-        # expires the session, so we create the feature collection before
-        # commit to avoid SELECT queries in toFeature.
-        if execute:
-            self.Session.flush()
-        collection = None
-        if len(objects) > 0:
-            collection = FeatureCollection([o.toFeature() for o in objects])
-        if execute:
-            self.Session.commit()
+        return objects
+
+    def _create_stream(self, request, response, features):
+        """ Create or update the objects of the features in batches of
+        ``chunk_size`` features, and return the created features as an
+        ``EncodedFeatureStream``. The first batch is committed here, the
+        next ones as the stream is iterated, so that a single batch is held
+        in memory. """
+        encoder = MapFishEncoder(precision=self.precision)
+        features = iter(features)
+        try:
+            batch = list(islice(features, self.chunk_size))
+        except ValueError:
+            abort(400)
+        encoded = self._create_batch(request, batch, encoder)
         response.status = 201
-        return collection
+        return EncodedFeatureStream(
+                self._create_batches(request, features, encoder, encoded))
+
+    def _create_batches(self, request, features, encoder, encoded):
+        """ Yield the encoded features of the first batch, then create the
+        objects of the next batches and yield their encoded features. A
+        ValueError raised by a malformed document interrupts the stream,
+        the batches yielded so far are committed. """
+        for data in encoded:
+            yield data
+        while True:
+            batch = list(islice(features, self.chunk_size))
+            if len(batch) == 0:
+                break
+            for data in self._create_batch(request, batch, encoder):
+                yield data
+
+    def _create_batch(self, request, features, encoder):
+        """ Create or update the objects of a batch of features, commit
+        them, and return the encoded features of the objects. The objects
+        are then removed from the session not to be held in memory. """
+        objects = self._create_objects(request, features)
+        self.Session.flush()
+        ret = [encoder.encode(o.toFeature()) for o in objects]
+        self.Session.commit()
+        self._invalidate()
+        for o in objects:
+            if o in self.Session:
+                self.Session.expunge(o)
+        return ret
+
+    def _bulk_create(self, request, features):
+        """ Create or update the objects of the features, see the
+        ``bulk_create`` option, and return the objects. """
+        ids, seen = [], set()
+        for feature in features:
+            if feature.id is not None and feature.id not in seen:
+                ids.append(feature.id)
+                seen.add(feature.id)
+        existing = self._get_objects(ids)
+
+        objects, updated, inserted = [], [], []
+        seen = set()
+        for feature in features:
+            obj = None
+            if feature.id is not None:
+                obj = existing.get(unicode(feature.id))
+                if obj is not None and obj.fid not in seen:
+                    updated.append(obj)
+                    seen.add(obj.fid)
+            if self.before_create is not None:
+                self.before_create(request, feature, obj)
+            if obj is None:
+                obj = self.mapped_class()
+                inserted.append(obj)
+            self.__copy_attributes(feature, obj)
+            objects.append(obj)
+
+        dialect = self._dialect()
+        if isinstance(dialect, (PGDialect, SQLiteDialect)):
+            upserted = updated
+            if isinstance(dialect, PGDialect) and len(inserted) > 0:
+                new_ids = self._next_ids(len(inserted))
+                if None not in new_ids:
+                    for obj, id in zip(inserted, new_ids):
+                        obj.fid = id
+                    upserted, inserted = updated + inserted, []
+            for obj in updated:
+                # the objects are written by the upsert, not by the ORM
+                self.Session.expunge(obj)
+            self._upsert([self._get_row(o) for o in upserted])
+        self.Session.add_all(inserted)
+        return objects
+
+    def _next_ids(self, count):
+        """ Return ``count`` new values of the primary key, taken from its
+        sequence. PostgreSQL only. """
+        fid_column = self.mapped_class.primary_key_column()
+        if isinstance(fid_column.default, Sequence):
+            sequence = fid_column.default.name
+            if fid_column.default.schema is not None:
+                sequence = '%s.%s' % (fid_column.default.schema, sequence)
+        else:
+            sequence = func.pg_get_serial_sequence(
+                    self.mapped_class.__table__.fullname, fid_column.name)
+        query = select([func.nextval(sequence)],
+                       from_obj=func.generate_series(1, count))
+        return [r[0] for r in self.Session.execute(query,
+                                                   mapper=self.mapped_class)]
+
+    def _get_row(self, obj):
+        """ Return the values of the columns of a mapped object that are
+        set or loaded, by column key, the geometry as WKB. """
+        state = instance_state(obj)
+        geom_column = self.mapped_class.geometry_column()
+        row = {}
+        for prop in class_mapper(self.mapped_class).iterate_properties:
+            if not isinstance(prop, ColumnProperty) or \
+               prop.key not in state.dict:
+                continue
+            column = prop.columns[0]
+            value = state.dict[prop.key]
+            if column is geom_column:
+                while isinstance(value, SpatialElement):
+                    value = value.desc
+            row[column.key] = value
+        return row
+
+    def _upsert(self, rows):
+        """ Insert or update the rows, as returned by ``_get_row``, with one
+        batched statement per set of columns. """
+        table = self.mapped_class.__table__
+        fid_column = self.mapped_class.primary_key_column()
+        geom_column = self.mapped_class.geometry_column()
+        wkb_key = '%s_wkb' % geom_column.key
+
+        for keys, batch in _group_rows(rows):
+            insert = table.insert()
+            if geom_column.key in keys:
+                insert = insert.values(**{geom_column.key: _wkb_bindparam(
+                        wkb_key, geom_column.type.srid)})
+                for row in batch:
+                    row[wkb_key] = row.pop(geom_column.key)
+            columns = [table.c[k] for k in keys if k != fid_column.key]
+            self.Session.execute(Upsert(insert, fid_column, columns), batch,
+                                 mapper=self.mapped_class)
 
     def update(self, request, response, id):
         """ Read the GeoJSON feature from the request body and update the
@@ -347,9 +2274,92 @@ class Protocol(object):
         self.Session.flush()
         feature = obj.toFeature()
         self.Session.commit()
+        self._invalidate()
         response.status = 201
         return feature
 
+    def bulk_update(self, request, response):
+        """ Read the GeoJSON feature collection from the request body and
+        update the corresponding objects in the database, the features must
+        have identifiers. The objects are read with one query per
+        ``chunk_size`` identifiers, ``before_update`` is called for each
+        feature, and the modifications are committed at once. Abort with
+        404, before any modification, if an object does not exist. See
+        also the ``batch_update`` option. """
+        if self.readonly:
+            abort(403)
+        try:
+            features = list(_read_features(
+                    request.environ['wsgi.input'],
+                    int(request.environ['CONTENT_LENGTH'])))
+        except ValueError:
+            abort(400)
+        ids, seen = [], set()
+        for feature in features:
+            if feature.id is None:
+                abort(400)
+            id = self._coerce_id(feature.id)
+            if unicode(id) not in seen:
+                ids.append(id)
+                seen.add(unicode(id))
+        objs = self._get_objects(ids)
+        if len(objs) < len(ids):
+            abort(404)
+
+        objects = []
+        for feature in features:
+            obj = objs[unicode(self._coerce_id(feature.id))]
+            if self.before_update is not None:
+                self.before_update(request, feature, obj)
+            self.__copy_attributes(feature, obj)
+            objects.append(obj)
+
+        if self.batch_update and self._updates_from_values():
+            # the objects are written by the UPDATE statements, not by the
+            # ORM
+            for obj in objs.values():
+                self.Session.expunge(obj)
+            self._update_from_values([self._get_row(o)
+                                      for o in objs.values()])
+        else:
+            self.Session.flush()
+        collection = FeatureCollection([o.toFeature() for o in objects])
+        self.Session.commit()
+        self._invalidate()
+        response.status = 201
+        return collection
+
+    def _coerce_id(self, id):
+        """ Return the feature identifier ``id`` converted to the Python
+        type of the primary key column, so that ``1``, ``1.0`` and ``"01"``
+        identify the same object of an integer column. Abort with 400 if
+        the identifier is not of that type. """
+        try:
+            return _coerce_value(self.mapped_class.primary_key_column().type,
+                                 id)
+        except ValueError:
+            abort(400)
+
+    def _updates_from_values(self):
+        """ Return whether the database supports ``UpdateFromValues``. """
+        dialect = self._dialect()
+        if isinstance(dialect, SQLiteDialect):
+            return dialect.dbapi.sqlite_version_info >= (3, 33)
+        return isinstance(dialect, PGDialect)
+
+    def _update_from_values(self, rows):
+        """ Update the rows, as returned by ``_get_row``, with one
+        statement per set of columns and ``chunk_size`` rows. """
+        table = self.mapped_class.__table__
+        fid_column = self.mapped_class.primary_key_column()
+        for keys, batch in _group_rows(rows):
+            columns = [table.c[k] for k in keys if k != fid_column.key]
+            for i in range(0, len(batch), self.chunk_size):
+                self.Session.execute(
+                    UpdateFromValues(table, fid_column, columns,
+                                     batch[i:i + self.chunk_size]),
+                    mapper=self.mapped_class)
+
     def delete(self, request, response, id):
         """ Remove the targetted feature from the database """
         if self.readonly:
@@ -361,19 +2371,82 @@ class Protocol(object):
             self.before_delete(request, obj)
         self.Session.delete(obj)
         self.Session.commit()
+        self._invalidate()
+        response.status = 204
+        return
+
+    def bulk_delete(self, request, response, filter=None):
+        """ Remove the features whose identifiers are given by the ``ids``
+        parameter, a comma-separated list, or the features matching the
+        filter, the MapFish default filter if ``filter`` is None, from the
+        database. The identifiers are converted to the type of the primary
+        key, see ``_coerce_id``, identifiers with no feature are ignored.
+        Abort with 400 if an identifier cannot be converted, or if there is
+        neither ``ids`` parameter nor filter, rather than emptying the
+        table.
+
+        Without ``before_delete`` the features are removed with one
+        ``DELETE`` statement, per ``chunk_size`` identifiers, and are not
+        loaded. Otherwise they are loaded ``chunk_size`` at a time, and
+        ``before_delete`` is called for each of them before it is
+        removed. """
+        if self.readonly:
+            abort(403)
+        fid_column = self.mapped_class.primary_key_column()
+        filters = []
+        if 'ids' in request.params:
+            ids = [id for id, param in self._get_ids(request)]
+            for i in range(0, len(ids), self.chunk_size):
+                f = fid_column.in_(ids[i:i + self.chunk_size])
+                filters.append(f if filter is None else and_(f, filter))
+        else:
+            if filter is None:
+                filter = create_default_filter(request, self.mapped_class)
+            if filter is None:
+                abort(400)
+            filters.append(filter)
+
+        for f in filters:
+            if self.before_delete is None:
+                query = self.Session.query(self.mapped_class).filter(f)
+                query.delete(synchronize_session=False)
+            else:
+                self._delete_batches(request, f)
+        self.Session.commit()
+        self._invalidate()
         response.status = 204
         return
 
+    def _delete_batches(self, request, filter):
+        """ Remove the objects matching the filter, read ``chunk_size`` at
+        a time in identifier order, calling ``before_delete`` for each of
+        them. """
+        fid_column = self.mapped_class.primary_key_column()
+        last = None
+        while True:
+            query = self.Session.query(self.mapped_class).filter(filter)
+            if last is not None:
+                query = query.filter(fid_column > last)
+            objs = query.order_by(fid_column).limit(self.chunk_size).all()
+            for obj in objs:
+                self.before_delete(request, obj)
+                self.Session.delete(obj)
+            self.Session.flush()
+            if len(objs) < self.chunk_size:
+                break
+            last = objs[-1].fid
+
     def __copy_attributes(self, json_feature, obj):
         """Updates the passed-in object with the values
         from the GeoJSON feature."""
-        # create a Shapely geometry from GeoJSON and persist the geometry
-        # using WKB
-        shape = asShape(json_feature.geometry)
+        # persist the geometry using WKB, written directly from the GeoJSON
+        # coordinates, no Shapely geometry is created
         srid = self.mapped_class.geometry_column().type.srid
-        obj.geometry = WKBSpatialElement(buffer(shape.wkb), srid=srid)
-        # also store the Shapely geometry so that we can use it to return the
-        # geometry as GeoJSON and avoid a SELECT
-        obj._mf_shape = shape
+        data = dumps_wkb(json_feature.geometry)
+        obj.geometry = WKBSpatialElement(buffer(data), srid=srid)
+        # also store the GeoJSON geometry so that we can return it and avoid
+        # a SELECT, decoded from the WKB so that its coordinates are floats
+        # as when the feature is read
+        obj._mf_shape = loads_wkb(data)
         for key in json_feature.properties:
             obj[key] = json_feature.properties[key]
@@ -26,7 +26,8 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-__all__ = ['GeometryTableMixIn']
+__all__ = ['GeometryTableMixIn', 'EnvelopeFilter', 'PreFiltered',
+           'SimplifiedWKB', 'Paginated']
 
 
 """
@@ -77,14 +78,18 @@ print [(i.gid, i.the_geom.distance(me)) for i in r]
 from shapely.wkb import loads
 from geojson import Feature
 
+from mapfish.wkb import loads_bounds, bounds as geojson_bounds
+
 from geoalchemy import Geometry as GeometryBase
+from geoalchemy.base import RawColumn
 from geoalchemy.functions import BaseFunction, parse_clause
 from geoalchemy.geometry import GeometryExtensionColumn
 from geoalchemy.spatialite import SQLiteSpatialDialect
 
 from sqlalchemy.ext.compiler import compiles
-from sqlalchemy.sql import and_, text, table, column 
-from sqlalchemy import select, func
+from sqlalchemy.sql import and_, text, table, column, null, bindparam
+from sqlalchemy.sql.expression import ColumnElement, Executable, ClauseElement
+from sqlalchemy import select, func, types
 from sqlalchemy.schema import Column
 
 from sqlalchemy.dialects.postgresql.base import PGDialect
@@ -92,6 +97,151 @@ from sqlalchemy.dialects.sqlite.base import SQLiteDialect
 from sqlalchemy.dialects.mysql.base import MySQLDialect
 from sqlalchemy.dialects.oracle.base import OracleDialect
 
+class EnvelopeFilter(ColumnElement):
+    """Filter selecting the rows whose geometry's bounding box intersects
+    the box ``bounds`` (``(minx, miny, maxx, maxy)`` in the ``srid`` system).
+
+    The filter is compiled to the operator that makes use of the spatial
+    index of ``column`` on each database: ``&&`` on PostGIS, a sub-select on
+    the ``SpatialIndex`` virtual table on SpatiaLite, ``MBRIntersects`` on
+    MySQL and ``SDO_FILTER`` on Oracle. It is meant to be combined with an
+    exact spatial test, see ``PreFiltered``."""
+
+    __visit_name__ = 'envelope_filter'
+    type = types.Boolean()
+
+    def __init__(self, column, bounds, srid):
+        self.column = column
+        self.bounds = tuple(bounds)
+        self.srid = srid
+
+@compiles(EnvelopeFilter)
+def _envelope_filter(element, compiler, **kw):
+    # no index-backed filter known for the dialect, the exact test
+    # does the job alone
+    return '1 = 1'
+
+@compiles(EnvelopeFilter, 'postgresql')
+def _envelope_filter_postgis(element, compiler, **kw):
+    envelope = func.ST_MakeEnvelope(*(element.bounds + (element.srid,)))
+    return '%s && %s' % (compiler.process(element.column),
+                         compiler.process(envelope))
+
+@compiles(EnvelopeFilter, 'sqlite')
+def _envelope_filter_spatialite(element, compiler, **kw):
+    if not element.column.type.spatial_index or \
+       not SQLiteSpatialDialect.supports_rtree(compiler.dialect):
+        return '1 = 1'
+    table_name = element.column.table.fullname
+    index = table('SpatialIndex', column('ROWID'), column('f_table_name'),
+                  column('f_geometry_column'), column('search_frame'))
+    frame = func.BuildMbr(*(element.bounds + (element.srid,)))
+    return compiler.process(
+        table(table_name, column('rowid')).c.rowid.in_(
+            select([index.c.ROWID]).where(
+                and_(index.c.f_table_name == table_name,
+                     index.c.f_geometry_column == element.column.name,
+                     index.c.search_frame == frame))))
+
+@compiles(EnvelopeFilter, 'mysql')
+def _envelope_filter_mysql(element, compiler, **kw):
+    minx, miny, maxx, maxy = element.bounds
+    wkt = 'POLYGON((%r %r,%r %r,%r %r,%r %r,%r %r))' % (
+        minx, miny, maxx, miny, maxx, maxy, minx, maxy, minx, miny)
+    return compiler.process(
+        func.MBRIntersects(element.column,
+                           func.GeomFromText(wkt, element.srid)))
+
+@compiles(EnvelopeFilter, 'oracle')
+def _envelope_filter_oracle(element, compiler, **kw):
+    # an optimized rectangle, see the SDO_GEOMETRY documentation
+    envelope = func.MDSYS.SDO_GEOMETRY(
+        2003, element.srid, null(),
+        func.MDSYS.SDO_ELEM_INFO_ARRAY(1, 1003, 3),
+        func.MDSYS.SDO_ORDINATE_ARRAY(*element.bounds))
+    return compiler.process(
+        func.SDO_FILTER(element.column, envelope) == 'TRUE')
+
+class PreFiltered(ColumnElement):
+    """The exact spatial test ``filter``, preceded by the ``EnvelopeFilter``
+    ``envelope`` on the dialects where the test does not use the spatial
+    index by itself.
+
+    The ``_within_distance`` test of GeoAlchemy already uses the index on
+    PostGIS (``ST_Expand`` and ``&&``), SpatiaLite (a sub-select on the
+    R*Tree of the column) and Oracle (``SDO_WITHIN_DISTANCE``), the envelope
+    is only added on MySQL, whose test builds its polygon with ``Concat``.
+    """
+
+    __visit_name__ = 'pre_filtered'
+    type = types.Boolean()
+
+    def __init__(self, envelope, filter):
+        self.envelope = envelope
+        self.filter = filter
+
+@compiles(PreFiltered)
+def _pre_filtered(element, compiler, **kw):
+    return compiler.process(and_(element.envelope, element.filter))
+
+@compiles(PreFiltered, 'postgresql')
+@compiles(PreFiltered, 'sqlite')
+@compiles(PreFiltered, 'oracle')
+def _pre_filtered_indexed(element, compiler, **kw):
+    return compiler.process(element.filter)
+
+class SimplifiedWKB(ColumnElement):
+    """The geometry of ``column`` simplified by the database with the
+    distance tolerance ``tolerance``, keeping the topology, as WKB.
+
+    The construct is compiled to ``ST_SimplifyPreserveTopology`` on PostGIS
+    and ``SimplifyPreserveTopology`` on SpatiaLite, ``dialects`` lists the
+    dialects it supports."""
+
+    __visit_name__ = 'simplified_wkb'
+    type = types.LargeBinary()
+    dialects = (PGDialect, SQLiteDialect)
+
+    def __init__(self, column, tolerance):
+        self.column = column
+        self.tolerance = tolerance
+
+@compiles(SimplifiedWKB, 'postgresql')
+def _simplified_wkb_postgis(element, compiler, **kw):
+    return compiler.process(func.ST_AsBinary(
+        func.ST_SimplifyPreserveTopology(RawColumn(element.column),
+                                         element.tolerance)))
+
+@compiles(SimplifiedWKB, 'sqlite')
+def _simplified_wkb_spatialite(element, compiler, **kw):
+    return compiler.process(func.AsBinary(
+        func.SimplifyPreserveTopology(RawColumn(element.column),
+                                      element.tolerance)))
+
+class Paginated(Executable, ClauseElement):
+    """A ``SELECT`` statement whose ``LIMIT`` and ``OFFSET``, if ``limit``
+    and ``offset`` are true, are the ``limit`` and ``offset`` bind params,
+    where SQLAlchemy renders them as literals, so that the statement can be
+    compiled once for all the pages. Only PostgreSQL and SQLite are
+    supported."""
+
+    def __init__(self, select, limit, offset):
+        self.select = select
+        self.limit = limit
+        self.offset = offset
+
+@compiles(Paginated, 'postgresql', 'sqlite')
+def _compile_paginated(element, compiler, **kw):
+    text = compiler.process(element.select)
+    if element.limit:
+        text += ' \n LIMIT ' + compiler.process(bindparam('limit'))
+    elif element.offset and isinstance(compiler.dialect, SQLiteDialect):
+        # SQLite requires a LIMIT before the OFFSET
+        text += ' \n LIMIT -1'
+    if element.offset:
+        text += ' OFFSET ' + compiler.process(bindparam('offset'))
+    return text
+
 class GeometryTableMixIn(object):
 
     """Class to be mixed in mapped classes.
@@ -192,12 +342,24 @@ class GeometryTableMixIn(object):
                 cls.__column_cache__ = dict(primary_key=keys.pop())
         return cls.__column_cache__["primary_key"]
 
-    def toFeature(self):
-        """Create and return a ``geojson.Feature`` object from this mapped object."""
+    def toFeature(self, attrs=None, no_geom=False, tolerance=None,
+                  shapely=True):
+        """Create and return a ``geojson.Feature`` object from this mapped object.
+        If ``attrs`` is given only the attributes whose names are in ``attrs``
+        are exported, and if ``no_geom`` is ``True`` the feature has no
+        geometry. The attributes and geometry left out are not read from the
+        object, they may therefore be deferred in the query. If ``tolerance``
+        is given the geometry read from the database is simplified with this
+        distance tolerance. If ``shapely`` is ``False`` the geometry read from
+        the database is decoded to a ``geojson`` geometry, along with its
+        bounds, without creating a Shapely geometry, unless it is
+        simplified."""
         if not self.exported_keys:
             exported = self.__table__.c.keys()
         else:
             exported = self.exported_keys
+        if attrs is not None:
+            exported = [k for k in exported if k in attrs]
 
         fid_column = self.primary_key_column().name
         geom_column = self.geometry_column().name
@@ -208,16 +370,30 @@ class GeometryTableMixIn(object):
             if k != fid_column and k != geom_column and hasattr(self, k):
                 attributes[k] = getattr(self, k)
         
-        if hasattr(self, '_mf_shape') and self._mf_shape is not None:
-            # we already have the geometry as Shapely geometry (when updating/inserting)
+        bbox = None
+        if no_geom:
+            geometry = None
+        elif hasattr(self, '_mf_shape') and self._mf_shape is not None:
+            # we already have the geometry, as GeoJSON geometry when
+            # updating/inserting, as Shapely geometry when simplified by the
+            # database
             geometry = self._mf_shape
         elif hasattr(self.geometry, 'geom_wkb') and self.geometry.geom_wkb is not None:
-            # create a Shapely geometry from the WKB geometry returned from the database
-            geometry = loads(str(self.geometry.geom_wkb))
+            if shapely or tolerance:
+                # create a Shapely geometry from the WKB geometry returned from the database
+                geometry = loads(str(self.geometry.geom_wkb))
+                if tolerance:
+                    geometry = geometry.simplify(tolerance, preserve_topology=True)
+            else:
+                geometry, bbox = loads_bounds(self.geometry.geom_wkb)
         else:
             geometry = None
 
+        if geometry is not None and bbox is None:
+            bbox = geometry.bounds if hasattr(geometry, 'bounds') \
+                   else geojson_bounds(geometry)
+
         return Feature(id=self.fid, 
                        geometry=geometry,
                        properties=attributes,
-                       bbox=None if geometry is None else geometry.bounds)
+                       bbox=bbox)
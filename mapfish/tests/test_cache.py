@@ -0,0 +1,99 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+""" This module includes unit tests for cache.py """
+
+import time
+import unittest
+
+from nose.tools import eq_, ok_
+
+from mapfish.cache import LRUCache, ProtocolCache
+from mapfish.tests.test_protocol import FakeRequest, MappedClass
+
+class Test(unittest.TestCase):
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        eq_(cache.get('a'), 1)
+        cache.set('c', 3)
+        # b is the least recently used entry
+        eq_(len(cache), 2)
+        ok_(cache.get('b') is None)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('c'), 3)
+        cache.delete('a')
+        ok_(cache.get('a') is None)
+
+    def test_lru_cache_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set('a', 1)
+        eq_(cache.get('a'), 1)
+        time.sleep(0.02)
+        ok_(cache.get('a') is None)
+        eq_(len(cache), 0)
+
+    def test_protocol_cache_key(self):
+        cache = ProtocolCache(LRUCache())
+
+        key1 = cache.key(MappedClass, FakeRequest(
+            {"bbox": "-180,-90,180,90", "attrs": "b,a", "limit": "10",
+             "callback": "foo"}), 'read')
+        key2 = cache.key(MappedClass, FakeRequest(
+            {"bbox": "-180.0,-90,180,90.0", "attrs": "a,b", "limit": "10"}),
+            'read')
+        eq_(key1, key2)
+
+        key3 = cache.key(MappedClass, FakeRequest(
+            {"bbox": "-180.0,-90,180,90.0", "attrs": "a,b", "limit": "20"}),
+            'read')
+        ok_(key1 != key3)
+        ok_(key1 != cache.key(MappedClass, FakeRequest({}), 'count'))
+
+        key1 = cache.key(MappedClass, FakeRequest(
+            {"queryable": "text", "text__eq": "foo", "id__eq": "1"}), 'read')
+        key2 = cache.key(MappedClass, FakeRequest(
+            {"queryable": "text", "text__eq": "foo"}), 'read')
+        eq_(key1, key2)
+        ok_(key1 != cache.key(MappedClass, FakeRequest(
+            {"queryable": "text", "text__eq": "bar"}), 'read'))
+
+        ok_(cache.key(MappedClass, FakeRequest({}), 'read', 1) !=
+            cache.key(MappedClass, FakeRequest({}), 'read', 2))
+
+    def test_protocol_cache_invalidate(self):
+        cache = ProtocolCache(LRUCache())
+        version = cache.version(MappedClass)
+        eq_(cache.version(MappedClass), version)
+        key = cache.key(MappedClass, FakeRequest({}), 'count')
+        cache.invalidate(MappedClass)
+        ok_(cache.version(MappedClass) != version)
+        ok_(cache.key(MappedClass, FakeRequest({}), 'count') != key)
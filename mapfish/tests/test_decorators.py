@@ -41,6 +41,8 @@ from shapely.geometry import Point
 from geojson import Feature, FeatureCollection
 
 from mapfish.decorators import MapFishEncoder, _jsonify, geojsonify
+from mapfish.protocol import FeatureStream
+from mapfish.export import ExportStream
 from mapfish.tests import TestWSGIController
 
 class Controller(WSGIController):
@@ -60,6 +62,19 @@ class Controller(WSGIController):
             ]
         return FeatureCollection(features)
 
+    @_jsonify(cls=MapFishEncoder, cb='foo')
+    def return_feature_stream(self):
+        features = [
+            Feature(id=1, geometry=Point(1, 2)),
+            Feature(id=2, geometry=Point(3, 4))
+            ]
+        return FeatureStream(iter(features))
+
+    @_jsonify(cls=MapFishEncoder, cb='foo')
+    def return_export_stream(self):
+        return ExportStream(iter(['fgb', '\x03fgb\x00']),
+                            'application/flatgeobuf', 'layer.fgb')
+
     @_jsonify(cls=MapFishEncoder, cb='foo')
     def return_feature_with_callback(self):
         return Feature(id=1,
@@ -67,6 +82,12 @@ class Controller(WSGIController):
                        properties={"strkey": "strval", "boolkey": True}
                        )
 
+    @_jsonify(cls=MapFishEncoder, precision=2)
+    def return_feature_with_precision(self):
+        return Feature(id=1,
+                       geometry=Point(1.23456, 2.3456),
+                       bbox=[1.23456, 2.3456, 1.23456, 2.3456])
+
 environ = {}
 app = ControllerWrap(Controller)
 app = sap = SetupCacheGlobal(app, environ)
@@ -79,9 +100,13 @@ class Test(TestWSGIController):
         self.app = app
         TestWSGIController.setUp(self)
         warnings.simplefilter('error', Warning)
+        # the responses are compared with the output of simplejson
+        self.backend = MapFishEncoder.__dict__['backend']
+        MapFishEncoder.backend = None
 
     def tearDown(self):
         warnings.simplefilter('always', Warning)
+        MapFishEncoder.backend = self.backend
 
     def test_feature(self):
         response = self.get_response(action='return_feature')
@@ -95,9 +120,115 @@ class Test(TestWSGIController):
         assert response.response.content_type == 'application/json'
         assert response.body == '{"type": "FeatureCollection", "features": [{"geometry": {"type": "Point", "coordinates": [1.0, 2.0]}, "type": "Feature", "properties": {}, "id": 1}, {"geometry": {"type": "Point", "coordinates": [3.0, 4.0]}, "type": "Feature", "properties": {}, "id": 2}]}'
 
+    def test_feature_stream(self):
+        response = self.get_response(action='return_feature_stream')
+        assert response.status == 200
+        assert response.response.content_type == 'application/json'
+        assert response.body == '{"type": "FeatureCollection", "features": [{"geometry": {"type": "Point", "coordinates": [1.0, 2.0]}, "type": "Feature", "properties": {}, "id": 1}, {"geometry": {"type": "Point", "coordinates": [3.0, 4.0]}, "type": "Feature", "properties": {}, "id": 2}]}'
+
+        response = self.get_response(action='return_feature_stream',
+                                     test_args=dict(params={'foo': 'jsfunc'}))
+        assert response.status == 200
+        assert response.response.content_type == 'text/javascript'
+        assert response.body.startswith('jsfunc({"type": "FeatureCollection", ')
+        assert response.body.endswith(']});')
+
+    def test_export_stream(self):
+        response = self.get_response(action='return_export_stream',
+                                     test_args=dict(params={'foo': 'jsfunc'}))
+        assert response.status == 200
+        assert response.response.content_type == 'application/flatgeobuf'
+        assert response.header('Content-Disposition') == \
+               'attachment; filename="layer.fgb"'
+        assert response.body == 'fgb\x03fgb\x00'
+
+    def test_feature_with_precision(self):
+        response = self.get_response(action='return_feature_with_precision')
+        assert response.status == 200
+        assert '"coordinates": [1.23, 2.35]' in response.body
+        assert '"bbox": [1.23, 2.35, 1.23, 2.35]' in response.body
+
     def test_feature_with_callback(self):
         response = self.get_response(action='return_feature_with_callback',
                                      test_args=dict(params={'foo': 'jsfunc'}))
         assert response.status == 200
         assert response.response.content_type == 'text/javascript'
         assert response.body == 'jsfunc({"geometry": {"type": "Point", "coordinates": [1.0, 2.0]}, "type": "Feature", "properties": {"boolkey": true, "strkey": "strval"}, "id": 1});'
+
+    def test_encoder_backend(self):
+        import decimal, datetime
+        import simplejson
+        from shapely.geometry import LineString
+        calls = []
+        def backend(data):
+            calls.append(data)
+            return simplejson.dumps(data)
+        MapFishEncoder.backend = staticmethod(backend)
+
+        feature = Feature(id=1, geometry=Point(1.23456, 2),
+                          properties={"height": 1.5,
+                                      "date": datetime.date(2011, 1, 2)},
+                          bbox=[1.23456, 2, 1.23456, 2])
+        collection = FeatureCollection(
+            [feature, Feature(id=2, geometry=LineString([(0, 0), (1, 1)]))],
+            cursor="abc")
+        expected = simplejson.loads(simplejson.dumps(
+            collection, cls=MapFishEncoder, indent=1))
+        eq_(len(calls), 0)
+        output = simplejson.dumps(collection, cls=MapFishEncoder)
+        eq_(len(calls), 1)
+        eq_(simplejson.loads(output), expected)
+        eq_(expected["features"][0]["properties"],
+            {"height": 1.5, "date": "2011-01-02"})
+
+        output = simplejson.dumps(feature, cls=MapFishEncoder, precision=2)
+        eq_(len(calls), 2)
+        eq_(simplejson.loads(output)["geometry"]["coordinates"], [1.23, 2])
+        eq_(simplejson.loads(output)["bbox"], [1.23, 2, 1.23, 2])
+
+        # decimals are kept exact by simplejson
+        output = simplejson.dumps({"a": decimal.Decimal("1.50")},
+                                  cls=MapFishEncoder)
+        eq_(len(calls), 2)
+        eq_(output, '{"a": 1.50}')
+
+        # objects the fast paths do not convert go through simplejson
+        class Other(MapFishEncoder):
+            def default(self, obj):
+                if isinstance(obj, set):
+                    return list(obj)
+                return MapFishEncoder.default(self, obj)
+        output = simplejson.dumps({"a": set([1])}, cls=Other)
+        eq_(len(calls), 2)
+        eq_(output, '{"a": [1]}')
+        try:
+            simplejson.dumps({"a": set([1])}, cls=MapFishEncoder)
+        except (TypeError, ValueError):
+            pass
+        else:
+            assert False
+        eq_(len(calls), 2)
+
+    def test_encoder_ujson(self):
+        import decimal
+        import simplejson
+        from nose.plugins.skip import SkipTest
+        from mapfish.decorators import ujson, ujson_dumps
+        if ujson is None:
+            raise SkipTest('ujson is not installed')
+        eq_(MapFishEncoder.backend, None)
+        MapFishEncoder.backend = staticmethod(ujson_dumps)
+
+        feature = Feature(id=1, geometry=Point(0.1, 2.0 / 3),
+                          properties={"height": 1454.66})
+        output = simplejson.dumps(feature, cls=MapFishEncoder)
+        # encoded by ujson, with no whitespace and 15 decimals
+        ok_(': ' not in output)
+        data = simplejson.loads(output)
+        eq_(data["geometry"]["coordinates"], [0.1, round(2.0 / 3, 15)])
+        eq_(data["properties"], {"height": 1454.66})
+
+        # the features holding decimals are encoded by simplejson
+        feature.properties["height"] = decimal.Decimal("1454.660")
+        output = simplejson.dumps(feature, cls=MapFishEncoder)
+        ok_('"height": 1454.660' in output)
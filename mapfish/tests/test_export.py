@@ -0,0 +1,205 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import struct
+import sqlite3
+import tempfile
+import unittest
+import datetime
+from StringIO import StringIO
+from zipfile import ZipFile
+from nose.tools import eq_, ok_
+
+import geojson
+
+from mapfish import export, wkb
+
+FIELDS = [('name', 'str', 10), ('count', 'int', None),
+          ('height', 'float', None), ('valid', 'bool', None),
+          ('day', 'date', None)]
+
+def _features():
+    return [
+        (1, wkb.dumps(geojson.Polygon([[[0, 0], [0, 4], [4, 4], [4, 0],
+                                        [0, 0]]])),
+         {'name': u'caf\xe9', 'count': 3, 'height': 1.5, 'valid': True,
+          'day': datetime.date(2011, 5, 4)}),
+        (2, None, {'name': None, 'count': None, 'height': None,
+                   'valid': False, 'day': None}),
+    ]
+
+def _table(data, pos):
+    """Return the fields of the flatbuffer table at ``pos`` as a dict of
+    their positions by id."""
+    vtable = pos - struct.unpack_from('<i', data, pos)[0]
+    size = struct.unpack_from('<H', data, vtable)[0]
+    offsets = struct.unpack_from('<%dH' % ((size - 4) // 2), data, vtable + 4)
+    return dict((i, pos + o) for i, o in enumerate(offsets) if o != 0)
+
+def _ref(data, pos):
+    return pos + struct.unpack_from('<I', data, pos)[0]
+
+def _vector(data, pos, format):
+    pos = _ref(data, pos)
+    count = struct.unpack_from('<I', data, pos)[0]
+    return struct.unpack_from('<%d%s' % (count, format), data, pos + 4)
+
+def _string(data, pos):
+    pos = _ref(data, pos)
+    length = struct.unpack_from('<I', data, pos)[0]
+    return data[pos + 4:pos + 4 + length]
+
+def _write_temporary(chunks):
+    fd, path = tempfile.mkstemp()
+    for chunk in chunks:
+        os.write(fd, chunk)
+    os.close(fd)
+    return path
+
+class Test(unittest.TestCase):
+
+    def test_flatgeobuf(self):
+        writer = export.FlatGeobufWriter('layer', FIELDS, 'Polygon', 4326)
+        data = ''.join(writer.write(_features()))
+        eq_(data[:8], 'fgb\x03fgb\x00')
+
+        size = struct.unpack_from('<I', data, 8)[0]
+        header = data[12:12 + size]
+        fields = _table(header, _ref(header, 0))
+        eq_(_string(header, fields[0]), 'layer')
+        eq_(ord(header[fields[2]]), 3)
+        crs = _table(header, _ref(header, fields[10]))
+        eq_(struct.unpack_from('<i', header, crs[1])[0], 4326)
+        columns = _ref(header, fields[7])
+        eq_(struct.unpack_from('<I', header, columns)[0], len(FIELDS))
+        column = _table(header, _ref(header, columns + 4))
+        eq_(_string(header, column[0]), 'name')
+        eq_(ord(header[column[1]]), 11)
+
+        pos = 12 + size
+        size = struct.unpack_from('<I', data, pos)[0]
+        feature = data[pos + 4:pos + 4 + size]
+        fields = _table(feature, _ref(feature, 0))
+        geometry = _table(feature, _ref(feature, fields[0]))
+        eq_(_vector(feature, geometry[1], 'd'),
+            (0, 0, 0, 4, 4, 4, 4, 0, 0, 0))
+        ok_(2 not in geometry)
+        properties = ''.join(_vector(feature, fields[1], 'c'))
+        eq_(properties[:2], '\x00\x00')
+        eq_(properties[2:6], struct.pack('<I', 5))
+        eq_(properties[6:11], u'caf\xe9'.encode('utf-8'))
+        eq_(struct.unpack_from('<Hq', properties, 11), (1, 3))
+
+        # the second feature has no geometry
+        pos += 4 + size
+        size = struct.unpack_from('<I', data, pos)[0]
+        feature = data[pos + 4:pos + 4 + size]
+        fields = _table(feature, _ref(feature, 0))
+        ok_(0 not in fields)
+        eq_(''.join(_vector(feature, fields[1], 'c')), '\x03\x00\x00')
+        eq_(pos + 4 + size, len(data))
+
+    def test_flatgeobuf_multipolygon(self):
+        writer = export.FlatGeobufWriter('layer', [], None, None, True)
+        polygon = [[[0, 0, 1], [0, 1, 2], [1, 1, 3], [0, 0, 1]],
+                   [[0, 0, 1], [0, 0.5, 2], [0.5, 0.5, 3], [0, 0, 1]]]
+        data = ''.join(writer.write(
+                [(1, wkb.dumps(geojson.MultiPolygon([polygon])), {})]))
+        size = struct.unpack_from('<I', data, 8)[0]
+        feature = data[12 + size + 4:]
+        fields = _table(feature, _ref(feature, 0))
+        geometry = _table(feature, _ref(feature, fields[0]))
+        eq_(ord(feature[geometry[6]]), 6)
+        parts = _ref(feature, geometry[7])
+        eq_(struct.unpack_from('<I', feature, parts)[0], 1)
+        part = _table(feature, _ref(feature, parts + 4))
+        eq_(_vector(feature, part[0], 'I'), (4, 8))
+        eq_(_vector(feature, part[2], 'd'), (1, 2, 3, 1, 1, 2, 3, 1))
+
+    def test_geopackage(self):
+        writer = export.GeoPackageWriter('layer', FIELDS, 'Polygon', 2056)
+        path = _write_temporary(writer.write(_features()))
+        try:
+            db = sqlite3.connect(path)
+            eq_(db.execute('PRAGMA application_id').fetchone()[0],
+                0x47504B47)
+            eq_(db.execute('SELECT geometry_type_name, srs_id '
+                           'FROM gpkg_geometry_columns').fetchall(),
+                [('POLYGON', 2056)])
+            eq_(db.execute('SELECT COUNT(*) FROM gpkg_spatial_ref_sys '
+                           'WHERE srs_id = 2056').fetchone()[0], 1)
+            rows = db.execute('SELECT * FROM layer ORDER BY fid').fetchall()
+            db.close()
+        finally:
+            os.remove(path)
+        eq_(rows[0][0], 1)
+        geometry = str(rows[0][1])
+        eq_(geometry[:8], 'GP\x00\x01' + struct.pack('<i', 2056))
+        eq_(geometry[8:], _features()[0][1])
+        eq_(rows[0][2:], (u'caf\xe9', 3, 1.5, 1, u'2011-05-04'))
+        eq_(rows[1], (2, None, None, None, None, 0, None))
+
+    def test_shapefile(self):
+        fields = FIELDS + [('a_long_name_1', 'int', None),
+                           ('a_long_name_2', 'int', None)]
+        writer = export.ShapefileWriter('layer', fields, None, 4326)
+        archive = ZipFile(StringIO(''.join(writer.write(_features()))))
+        eq_(sorted(archive.namelist()), ['layer.cpg', 'layer.dbf',
+                                         'layer.prj', 'layer.shp',
+                                         'layer.shx'])
+
+        shp = archive.read('layer.shp')
+        eq_(struct.unpack_from('>i', shp, 24)[0] * 2, len(shp))
+        eq_(struct.unpack_from('<ii4d', shp, 28), (1000, 5, 0, 0, 4, 4))
+        length = struct.unpack_from('>ii', shp, 100)[1] * 2
+        record = shp[108:108 + length]
+        eq_(struct.unpack_from('<i4dii', record),
+            (5, 0, 0, 4, 4, 1, 5))
+        # the outer ring is clockwise
+        eq_(struct.unpack_from('<10d', record, 48),
+            (0, 0, 0, 4, 4, 4, 4, 0, 0, 0))
+        eq_(shp[108 + length:], struct.pack('>ii', 2, 2) + '\x00' * 4)
+        shx = archive.read('layer.shx')
+        eq_(struct.unpack_from('>4i', shx, 100), (50, length // 2, (108 + length) // 2, 2))
+
+        dbf = archive.read('layer.dbf')
+        eq_(struct.unpack_from('<I', dbf, 4)[0], 2)
+        names = [dbf[32 + 32 * i:43 + 32 * i].rstrip('\x00')
+                 for i in range(len(fields))]
+        eq_(names, ['name', 'count', 'height', 'valid', 'day',
+                    'a_long_nam', 'a_long_n_1'])
+        header, size = struct.unpack_from('<HH', dbf, 8)
+        record = dbf[header:header + size]
+        eq_(record[:11], ' caf\xc3\xa9     ')
+        eq_(record[11:29].strip(), '3')
+        eq_(record[29:53].strip(), '1.500000000000000')
+        eq_(record[53:62], 'T20110504')
+        record = dbf[header + size:header + 2 * size]
+        eq_(record[53:62], 'F        ')
+        eq_(dbf[-1], '\x1a')
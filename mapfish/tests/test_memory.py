@@ -0,0 +1,94 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+""" This module includes unit tests for memory.py """
+
+import time
+import unittest
+
+from nose.tools import eq_, ok_
+
+from shapely.geometry import Point, LineString
+
+from mapfish.memory import MemoryIndex, MemoryLayer
+
+class Test(unittest.TestCase):
+
+    def test_memory_index(self):
+        index = MemoryIndex([(Point(0, 0), 'a'),
+                             (None, 'b'),
+                             (LineString([(5, 5), (10, 10)]), 'c'),
+                             (Point(10, 0), 'd')], 'v1')
+        eq_(len(index), 4)
+        eq_(index.query(), ['a', 'b', 'c', 'd'])
+        eq_(index.query(Point(0, 0).buffer(1)), ['a'])
+        eq_(index.query(Point(10, 0).buffer(20)), ['a', 'c', 'd'])
+        # the envelope of the line intersects the box, not the line itself
+        eq_(index.query(Point(9, 6).buffer(1)), [])
+        eq_(index.query(Point(9, 8), 1), ['c'])
+        eq_(index.query(Point(1, 1), 1), [])
+        eq_(index.query(Point(1, 1), 1.5), ['a'])
+
+        index = MemoryIndex([], 'v1')
+        eq_(index.query(), [])
+        eq_(index.query(Point(0, 0), 10), [])
+
+        index = MemoryIndex(None, 'v1')
+        ok_(index.encoded is None)
+
+    def test_memory_layer(self):
+        loads = []
+        def load():
+            loads.append(1)
+            return [(Point(0, 0), str(len(loads)))]
+
+        layer = MemoryLayer()
+        eq_(layer.get('v1', load).query(), ['1'])
+        eq_(layer.get('v1', load).query(), ['1'])
+        # the table was modified
+        eq_(layer.get('v2', load).query(), ['2'])
+        layer.invalidate()
+        eq_(layer.get('v2', load).query(), ['3'])
+
+        layer = MemoryLayer(reload_interval=0.01)
+        eq_(layer.get('v1', load).query(), ['4'])
+        eq_(layer.get('v1', load).query(), ['4'])
+        time.sleep(0.02)
+        eq_(layer.get('v1', load).query(), ['5'])
+
+    def test_memory_layer_reloading(self):
+        # the previous snapshot is used while another thread reloads
+        layer = MemoryLayer()
+        index = layer.get('v1', lambda: [])
+        layer._lock.acquire()
+        try:
+            ok_(layer.get('v2', lambda: []) is index)
+        finally:
+            layer._lock.release()
+        ok_(layer.get('v2', lambda: []) is not index)
@@ -0,0 +1,171 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+import unittest
+import struct
+from nose.tools import eq_, ok_
+
+from shapely import wkt
+from shapely.geometry import Point, Polygon
+
+from mapfish import mvt
+
+def _varint(data, i):
+    n, shift = 0, 0
+    while True:
+        b = ord(data[i])
+        n |= (b & 0x7f) << shift
+        shift += 7
+        i += 1
+        if b < 0x80:
+            return n, i
+
+def _fields(data):
+    """Decode a protocol buffer message into a list of (field, value)
+    tuples, length-delimited values are returned as strings."""
+    fields, i = [], 0
+    while i < len(data):
+        key, i = _varint(data, i)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, i = _varint(data, i)
+        elif wire_type == 1:
+            value, i = struct.unpack('<d', data[i:i + 8])[0], i + 8
+        else:
+            length, i = _varint(data, i)
+            value, i = data[i:i + length], i + length
+        fields.append((field, value))
+    return fields
+
+def _packed(data):
+    numbers, i = [], 0
+    while i < len(data):
+        n, i = _varint(data, i)
+        numbers.append(n)
+    return numbers
+
+def _points(commands):
+    """Return the points of geometry commands."""
+    points, x, y, i = [], 0, 0, 0
+    while i < len(commands):
+        id, count = commands[i] & 0x7, commands[i] >> 3
+        i += 1
+        if id == mvt.CLOSE_PATH:
+            continue
+        for j in range(count):
+            dx, dy = commands[i], commands[i + 1]
+            x += dx >> 1 if dx & 1 == 0 else -((dx + 1) >> 1)
+            y += dy >> 1 if dy & 1 == 0 else -((dy + 1) >> 1)
+            points.append((x, y))
+            i += 2
+    return points
+
+class Test(unittest.TestCase):
+
+    def test_tile_bounds(self):
+        bounds = mvt.tile_bounds(0, 0, 0)
+        eq_(bounds, (-mvt.ORIGIN, -mvt.ORIGIN, mvt.ORIGIN, mvt.ORIGIN))
+        bounds = mvt.tile_bounds(1, 1, 0)
+        eq_(bounds, (0, 0, mvt.ORIGIN, mvt.ORIGIN))
+
+    def test_encode_geometry(self):
+        # the examples of the vector tile specification
+        eq_(mvt._encode_geometry(Point(25, 17)), (mvt.POINT, [9, 50, 34]))
+        eq_(mvt._encode_geometry(wkt.loads('MULTIPOINT (5 7, 3 2)')),
+            (mvt.POINT, [17, 10, 14, 3, 9]))
+        eq_(mvt._encode_geometry(wkt.loads('LINESTRING (2 2, 2 10, 10 10)')),
+            (mvt.LINESTRING, [9, 4, 4, 18, 0, 16, 16, 0]))
+        eq_(mvt._encode_geometry(wkt.loads('MULTILINESTRING ((2 2, 2 10, 10 10), (1 1, 3 5))')),
+            (mvt.LINESTRING, [9, 4, 4, 18, 0, 16, 16, 0, 9, 17, 17, 10, 4, 8]))
+        eq_(mvt._encode_geometry(wkt.loads('POLYGON ((3 6, 8 12, 20 34, 3 6))')),
+            (mvt.POLYGON, [9, 6, 12, 18, 10, 12, 24, 44, 15]))
+        eq_(mvt._encode_geometry(wkt.loads('MULTIPOLYGON (((0 0, 10 0, 10 10, 0 10, 0 0)), ((11 11, 20 11, 20 20, 11 20, 11 11), (13 13, 13 17, 17 17, 17 13, 13 13)))')),
+            (mvt.POLYGON, [9, 0, 0, 26, 20, 0, 0, 20, 19, 0, 15, 9, 22, 2, 26, 18, 0, 0, 18, 17, 0, 15, 9, 4, 13, 26, 0, 8, 8, 0, 0, 7, 15]))
+
+    def test_encode_geometry_winding(self):
+        # the exterior ring is reversed to get a positive area
+        eq_(mvt._encode_geometry(wkt.loads('POLYGON ((3 6, 20 34, 8 12, 3 6))')),
+            mvt._encode_geometry(wkt.loads('POLYGON ((8 12, 20 34, 3 6, 8 12))')))
+
+    def test_encode_geometry_degenerated(self):
+        # the ring is a point once quantized
+        eq_(mvt._encode_geometry(wkt.loads('POLYGON ((3 6, 3.1 6, 3.1 6.1, 3 6))')),
+            (None, None))
+        eq_(mvt._encode_geometry(wkt.loads('LINESTRING (2 2, 2.2 2.2)')),
+            (None, None))
+
+    def test_layer(self):
+        layer = mvt.Layer('spots', (0, 0, 4096, 4096))
+        layer.add_feature(Point(1, 4095), {'name': u'foo', 'height': 420.4,
+                                           'rank': 3, 'delta': -2,
+                                           'good': True, 'none': None}, 1)
+        layer.add_feature(Point(2, 4094), {'name': u'foo'}, 2)
+        # out of the tile and its buffer
+        layer.add_feature(Point(5000, 10), {}, 3)
+
+        fields = _fields(mvt.encode([layer]))
+        eq_(len(fields), 1)
+        eq_(fields[0][0], 3)
+        layer = _fields(fields[0][1])
+        eq_(layer[0], (15, 2))
+        eq_(layer[1], (1, 'spots'))
+        eq_(layer[-1], (5, 4096))
+        features = [dict(_fields(v)) for f, v in layer if f == 2]
+        keys = [v for f, v in layer if f == 3]
+        values = [_fields(v)[0] for f, v in layer if f == 4]
+        eq_(len(features), 2)
+
+        eq_(features[0][1], 1)
+        eq_(features[0][3], mvt.POINT)
+        # the y axis points down
+        eq_(_packed(features[0][4]), [9, 2, 2])
+        tags = _packed(features[0][2])
+        properties = dict((keys[tags[i]], values[tags[i + 1]])
+                          for i in range(0, len(tags), 2))
+        eq_(properties, {'name': (1, 'foo'), 'height': (3, 420.4),
+                         'rank': (5, 3), 'delta': (6, 3), 'good': (7, 1)})
+
+        # the keys and values are shared
+        eq_(_packed(features[1][2]), [keys.index('name'),
+                                      values.index((1, 'foo'))])
+
+    def test_layer_clipping(self):
+        layer = mvt.Layer('lakes', (0, 0, 4096, 4096), buffer=64)
+        layer.add_feature(Polygon(((-1000, -1000), (-1000, 1000),
+                                   (1000, 1000), (1000, -1000),
+                                   (-1000, -1000))))
+        eq_(len(layer.features), 1)
+        id, properties, type, commands = layer.features[0]
+        eq_(id, None)
+        eq_(type, mvt.POLYGON)
+        points = _points(commands)
+        eq_(min(p[0] for p in points), -64)
+        eq_(max(p[0] for p in points), 1000)
+        eq_(min(p[1] for p in points), 3096)
+        eq_(max(p[1] for p in points), 4160)
@@ -32,7 +32,8 @@ import unittest
 from nose.tools import eq_, ok_, raises
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import (create_engine, MetaData, Column, Integer, Numeric, Boolean)
+from sqlalchemy import (create_engine, MetaData, Column, Integer, Numeric, Boolean,
+                        Date, DateTime)
 from sqlalchemy import orm
 
 from geoalchemy import (Point, Polygon, GeometryColumn, GeometryDDL)
@@ -73,6 +74,17 @@ class Lake(Base, GeometryTableMixIn):
 
 GeometryDDL(Lake.__table__)
 
+class Summit(Base, GeometryTableMixIn):
+    __tablename__ = 'summits'
+
+    id = Column(Integer, primary_key=True)
+    height = Column(Numeric(8, 2))
+    surveyed = Column(Date)
+    climbed = Column(DateTime)
+    geom = GeometryColumn(Point(2))
+
+GeometryDDL(Summit.__table__)
+
 class Test(unittest.TestCase):
 
 
@@ -354,3 +366,160 @@ class Test(unittest.TestCase):
         proto = Protocol(session, Spot)
         
         proto.read(FakeRequest({}), id=-1)
+
+
+    def test_protocol_read_stream_database_geojson(self):
+        """The features encoded by PostGIS match the Python encoding"""
+        import datetime
+        from decimal import Decimal
+        from simplejson import loads
+        from mapfish.decorators import MapFishEncoder
+        from mapfish.protocol import EncodedFeatureStream
+
+        def compare(mapped_class, params):
+            proto = Protocol(session, mapped_class)
+            db_proto = Protocol(session, mapped_class, database_geojson=True)
+            stream = proto.read(FakeRequest(dict(params)), stream=True)
+            expected = loads(''.join(stream.iterencode(MapFishEncoder())),
+                             use_decimal=True)
+            stream = db_proto.read(FakeRequest(dict(params)), stream=True)
+            ok_(isinstance(stream, EncodedFeatureStream))
+            collection = loads(''.join(stream.iterencode(MapFishEncoder())),
+                               use_decimal=True)
+            eq_(collection, expected)
+            return collection
+
+        for params in ({"precision": "6"},
+                       {"attrs": "spot_height", "no_geom": "true"}):
+            compare(Spot, params)
+
+        # decimals are encoded as numbers, dates as strings by both
+        # encodings
+        session.add_all([
+            Summit(height=Decimal('1.50'), geom='POINT(6.1234567 46)',
+                   surveyed=datetime.date(2011, 1, 2),
+                   climbed=datetime.datetime(2011, 1, 2, 3, 4, 5)),
+            Summit(height=Decimal('4808.73'), geom='POINT(7 46)',
+                   climbed=datetime.datetime(2011, 1, 2, 3, 4, 5, 250000))
+            ])
+        session.commit()
+        for params in ({"precision": "6"},
+                       {"attrs": "height,surveyed,climbed",
+                        "no_geom": "true"}):
+            collection = compare(Summit, params)
+        eq_([f["properties"] for f in collection["features"]],
+            [{"height": Decimal('1.50'), "surveyed": "2011-01-02",
+              "climbed": "2011-01-02 03:04:05"},
+             {"height": Decimal('4808.73'), "surveyed": None,
+              "climbed": "2011-01-02 03:04:05.250000"}])
+
+
+    def test_protocol_read_cursor(self):
+        """Read all features page by page with a cursor"""
+        proto = Protocol(session, Spot)
+
+        ids = []
+        params = {"sort": "spot_height", "dir": "DESC",
+                  "limit": "4", "cursor": ""}
+        while True:
+            collection = proto.read(FakeRequest(dict(params)))
+            ids.extend([f.id for f in collection.features])
+            if 'cursor' not in collection.extra:
+                break
+            params["cursor"] = collection.extra["cursor"]
+        eq_(ids, [9, 8, 4, 7, 1, 3, 6, 2, 5])
+
+
+    def test_protocol_count_estimate(self):
+        """Get an estimated feature count"""
+        session.execute('ANALYZE spots')
+        proto = Protocol(session, Spot, estimate_threshold=0)
+        request = FakeRequest({"estimate": "true"})
+        response = FakeResponse()
+        ok_(int(proto.count(request, response=response)) > 0)
+        eq_(response.headers['X-Count-Type'], 'estimated')
+
+        request.params['queryable'] = 'spot_height'
+        request.params['spot_height__gte'] = '1454.66'
+        ok_(int(proto.count(request)) > 0)
+
+        proto = Protocol(session, Spot)
+        response = FakeResponse()
+        eq_(proto.count(FakeRequest({"estimate": "true"}), response=response), '9')
+        eq_(response.headers['X-Count-Type'], 'exact')
+
+
+    def test_protocol_read_resolution(self):
+        """Get simplified geometries"""
+        proto = Protocol(session, Spot)
+        # the database simplifies the geometries, Shapely does for a
+        # single feature
+        collection = proto.read(FakeRequest({"resolution": "100"}))
+        eq_(len(collection.features), 9)
+        feature = proto.read(FakeRequest({"resolution": "100"}), id=1)
+        eq_(feature.__geo_interface__['geometry']['coordinates'], (0.0, 0.0))
+
+        stream = proto.read(FakeRequest({"resolution": "100"}), stream=True)
+        eq_(len(list(stream)), 9)
+
+
+    def test_protocol_tile(self):
+        """Get a vector tile"""
+        from mapfish.tests.test_mvt import _fields
+        proto = Protocol(session, Spot)
+
+        tile = _fields(proto.tile(FakeRequest({}), 0, 0, 0))
+        eq_(len(tile), 1)
+        layer = _fields(tile[0][1])
+        eq_(layer[1], (1, 'spots'))
+        eq_(len([v for f, v in layer if f == 2]), 8)
+
+        request = FakeRequest({"queryable": "spot_height",
+                               "spot_height__gte": "1000"})
+        tile = _fields(proto.tile(request, 1, 1, 0))
+        layer = _fields(tile[0][1])
+        eq_(len([v for f, v in layer if f == 2]), 1)
+
+
+    def test_protocol_read_cluster(self):
+        """Get the features grouped into grid cells"""
+        proto = Protocol(session, Spot, cluster_size=10)
+        request = FakeRequest({"cluster": "true", "resolution": "0.5",
+                               "bbox": "-1,-1,12,12"})
+        collection = proto.read(request)
+        counts = sorted((f.properties['count'], f.geometry.coordinates)
+                        for f in collection.features)
+        eq_(counts, [(1, (0.0, 0.0)), (1, (2.0, 3.0)), (1, (5.0, 5.0)),
+                     (2, (10.0, 10.5))])
+
+
+    def test_protocol_read_ids(self):
+        """Get several features by their identifiers"""
+        proto = Protocol(session, Spot, chunk_size=3)
+        collection = proto.read(FakeRequest({"ids": "9,2,42,5,1,3,4"}))
+        eq_([f.id for f in collection.features], [9, 2, 5, 1, 3, 4])
+        eq_(collection.extra['missing'], ['42'])
+        ok_(collection.features[1].__geo_interface__['geometry'] is not None)
+
+
+    def test_protocol_create_bulk(self):
+        """Create and update points in bulk"""
+        old_spot = session.query(Spot).filter(Spot.spot_height==102.34).one()
+        proto = Protocol(session, Spot, bulk_create=True)
+
+        request = FakeRequest({})
+        request.body = '{"type": "FeatureCollection", "features": [\
+            {"type": "Feature", "properties": {"spot_height": 12.0}, "geometry": {"type": "Point", "coordinates": [45, 5]}},\
+            {"type": "Feature", "id": ' + str(old_spot.spot_id) + ', "properties": {}, "geometry": {"type": "Point", "coordinates": [1, 1]}}]}'
+
+        response = FakeResponse()
+        collection = proto.create(request, response)
+        eq_(response.status, 201)
+        eq_([f.id for f in collection.features], [10, old_spot.spot_id])
+
+        session.expire_all()
+        new_spot = session.query(Spot).filter(Spot.spot_height==12.0).one()
+        eq_(session.scalar(new_spot.spot_location.wkt), u'POINT(45 5)')
+        old_spot = session.query(Spot).get(old_spot.spot_id)
+        eq_(old_spot.spot_height, 102.34)
+        eq_(session.scalar(old_spot.spot_location.wkt), u'POINT(1 1)')
@@ -36,9 +36,11 @@ from nose.tools import eq_, ok_
 
 from sqlalchemy import MetaData, Column, create_engine
 from sqlalchemy import types, orm, sql
+from sqlalchemy.interfaces import PoolListener, ConnectionProxy
 from sqlalchemy.ext.declarative import declarative_base
 
-from geojson import dumps, Feature
+from geojson import dumps, Feature, FeatureCollection, \
+                    LineString as GeoJSONLineString
 
 from shapely import wkt, wkb
 from shapely.geometry.polygon import Polygon
@@ -72,6 +74,7 @@ class FakeRequest(object):
 class FakeResponse(object):
     def __init__(self):
         self.status = 0
+        self.headers = {}
 
 # create a session in the same way it's done in a typical Pylons app
 engine = create_engine('postgresql://user:user@no_connection/no_db', echo=True)
@@ -89,6 +92,55 @@ def _compiled_to_string(compiled_filter):
     """
     return unicode(compiled_filter).encode('ascii', 'backslashreplace')
 
+class _SpatialFunctions(PoolListener):
+    """The SpatiaLite functions called by GeoAlchemy, for plain SQLite
+    databases storing the geometries as WKB."""
+    def connect(self, connection, record):
+        connection.create_function('AsBinary', 1, lambda wkb: wkb)
+        connection.create_function('GeomFromWKB', 2, lambda wkb, srid: wkb)
+        connection.create_function('SimplifyPreserveTopology', 2,
+                                   lambda wkb, tolerance: wkb)
+
+class _StatementRecorder(ConnectionProxy):
+    """Append the first keyword of the executed statements to a list."""
+    def __init__(self, statements):
+        self.statements = statements
+    def cursor_execute(self, execute, cursor, statement, parameters,
+                       context, executemany):
+        self.statements.append(statement.split()[0])
+        return execute(cursor, statement, parameters, context)
+
+def sqlite_session(statements=None):
+    """Helper method which creates the table of MappedClass in an
+    in-memory SQLite database, and returns a session bound to it and its
+    engine. If statements is a list the first keyword of the executed
+    statements are appended to it.
+    """
+    kwargs = {}
+    if statements is not None:
+        kwargs['proxy'] = _StatementRecorder(statements)
+    sqlite_engine = create_engine('sqlite://', listeners=[_SpatialFunctions()],
+                                  **kwargs)
+    sqlite_engine.execute('CREATE TABLE "table" '
+                          '(id INTEGER PRIMARY KEY, text VARCHAR, geom BLOB)')
+    session = orm.scoped_session(orm.sessionmaker(bind=sqlite_engine))
+    return session, sqlite_engine
+
+class NoPyproj(object):
+    """Context in which mapfish.protocol works as if pyproj was not
+    installed."""
+    def __enter__(self):
+        import mapfish.protocol
+        self.pyproj = mapfish.protocol.pyproj
+        mapfish.protocol.pyproj = None
+        mapfish.protocol._transforms.clear()
+        mapfish.protocol._areas.clear()
+    def __exit__(self, *args):
+        import mapfish.protocol
+        mapfish.protocol.pyproj = self.pyproj
+        mapfish.protocol._transforms.clear()
+        mapfish.protocol._areas.clear()
+
 #
 # Test
 # 
@@ -109,11 +161,21 @@ class Test(unittest.TestCase):
         assert params["GeomFromWKB_2"] == 4326
         assert params["ST_Expand_1"] == 1
         assert params["ST_Distance_1"] == 1
+
+        # the exact test of MySQL does not use the spatial index
+        from sqlalchemy.dialects import mysql
+        compiled_filter = filter.compile(dialect=mysql.dialect())
+        ok_(_compiled_to_string(compiled_filter).startswith(
+            'MBRIntersects(`table`.geom, GeomFromText(%s, %s)) AND '
+            'Intersects(`table`.geom, '))
+        eq_(compiled_filter.params["GeomFromText_1"],
+            'POLYGON((-181.0 -91.0,181.0 -91.0,181.0 91.0,-181.0 91.0,-181.0 -91.0))')
    
         request = FakeRequest(
             {"bbox": "-180,-90,180,90", "tolerance": "1", "epsg": "900913"}
         )
-        filter = create_geom_filter(request, MappedClass)
+        with NoPyproj():
+            filter = create_geom_filter(request, MappedClass)
         compiled_filter = filter.compile(engine)
         params = compiled_filter.params
         filter_str = _compiled_to_string(compiled_filter)
@@ -142,7 +204,8 @@ class Test(unittest.TestCase):
         request = FakeRequest(
             {"lon": "40", "lat": "5", "tolerance": "1", "epsg": "900913"}
         )
-        filter = create_geom_filter(request, MappedClass)
+        with NoPyproj():
+            filter = create_geom_filter(request, MappedClass)
         compiled_filter = filter.compile(engine)
         params = compiled_filter.params
         filter_str = _compiled_to_string(compiled_filter)
@@ -173,7 +236,8 @@ class Test(unittest.TestCase):
         request = FakeRequest(
             {"geometry": dumps(poly), "tolerance": "1", "epsg": "900913"}
         )
-        filter = create_geom_filter(request, MappedClass)
+        with NoPyproj():
+            filter = create_geom_filter(request, MappedClass)
         compiled_filter = filter.compile(engine)
         params = compiled_filter.params
         filter_str = _compiled_to_string(compiled_filter)
@@ -184,6 +248,113 @@ class Test(unittest.TestCase):
         assert params["param_1"] == 900913
         assert params["ST_Distance_1"] == 1        #assert isinstance(filter, sql.expression.ClauseElement)
 
+    def test_envelope_filter(self):
+        from sqlalchemy.dialects import sqlite, mysql, oracle
+        from mapfish.sqlalchemygeom import EnvelopeFilter
+        filter = EnvelopeFilter(MappedClass.geometry_column(), (1, 2, 3, 4), 4326)
+
+        compiled_filter = filter.compile(engine)
+        eq_(_compiled_to_string(compiled_filter), '"table".geom && ST_MakeEnvelope(%(ST_MakeEnvelope_1)s, %(ST_MakeEnvelope_2)s, %(ST_MakeEnvelope_3)s, %(ST_MakeEnvelope_4)s, %(ST_MakeEnvelope_5)s)')
+
+        dialect = sqlite.dialect()
+        dialect.server_version_info = (3, 7, 0)
+        compiled_filter = filter.compile(dialect=dialect)
+        eq_(_compiled_to_string(compiled_filter), '"table".rowid IN (SELECT "SpatialIndex"."ROWID" \nFROM "SpatialIndex" \nWHERE "SpatialIndex".f_table_name = ? AND "SpatialIndex".f_geometry_column = ? AND "SpatialIndex".search_frame = BuildMbr(?, ?, ?, ?, ?))')
+        eq_(compiled_filter.params["f_table_name_1"], "table")
+        eq_(compiled_filter.params["f_geometry_column_1"], "geom")
+
+        compiled_filter = filter.compile(dialect=mysql.dialect())
+        eq_(_compiled_to_string(compiled_filter), 'MBRIntersects(`table`.geom, GeomFromText(%s, %s))')
+        eq_(compiled_filter.params["GeomFromText_1"], 'POLYGON((1 2,3 2,3 4,1 4,1 2))')
+
+        compiled_filter = filter.compile(dialect=oracle.dialect())
+        eq_(_compiled_to_string(compiled_filter), 'SDO_FILTER("table".geom, MDSYS.SDO_GEOMETRY(:SDO_GEOMETRY_1, :SDO_GEOMETRY_2, NULL, MDSYS.SDO_ELEM_INFO_ARRAY(:SDO_ELEM_INFO_ARRAY_1, :SDO_ELEM_INFO_ARRAY_2, :SDO_ELEM_INFO_ARRAY_3), MDSYS.SDO_ORDINATE_ARRAY(:SDO_ORDINATE_ARRAY_1, :SDO_ORDINATE_ARRAY_2, :SDO_ORDINATE_ARRAY_3, :SDO_ORDINATE_ARRAY_4))) = :SDO_FILTER_1')
+        eq_(compiled_filter.params["SDO_FILTER_1"], 'TRUE')
+
+        # the envelope is left out where the exact test uses the index
+        from mapfish.sqlalchemygeom import PreFiltered
+        exact = MappedClass.geometry_column() != None
+        filter = PreFiltered(filter, exact)
+        for dialect in (engine.dialect, dialect, oracle.dialect()):
+            eq_(unicode(filter.compile(dialect=dialect)),
+                unicode(exact.compile(dialect=dialect)))
+        eq_(unicode(filter.compile(dialect=mysql.dialect())),
+            'MBRIntersects(`table`.geom, GeomFromText(%s, %s)) AND '
+            '`table`.geom IS NOT NULL')
+
+    def test_geom_filter_transform(self):
+        from nose.plugins.skip import SkipTest
+        from mapfish.protocol import create_geom_filter, pyproj
+        if pyproj is None:
+            raise SkipTest("pyproj is not installed")
+
+        request = FakeRequest(
+            {"bbox": "0,0,1000000,1000000", "epsg": "3857"}
+        )
+        filter = create_geom_filter(request, MappedClass)
+        compiled_filter = filter.compile(engine)
+        params = compiled_filter.params
+        filter_str = _compiled_to_string(compiled_filter)
+        # the column is compared as is
+        assert 'ST_Transform' not in filter_str
+        eq_(params["GeomFromWKB_2"], 4326)
+        geometry = wkb.loads(str(params["GeomFromWKB_1"]))
+        bounds = geometry.bounds
+        self.assertAlmostEqual(bounds[0], 0)
+        self.assertAlmostEqual(bounds[1], 0)
+        self.assertAlmostEqual(bounds[2], 8.983152841195214)
+        self.assertAlmostEqual(bounds[3], 8.946573850543412)
+        # the edges were densified
+        assert len(geometry.exterior.coords) > 5
+
+        # the tolerance is applied in the request's system
+        request = FakeRequest(
+            {"lon": "0", "lat": "0", "tolerance": "100000", "epsg": "3857"}
+        )
+        filter = create_geom_filter(request, MappedClass)
+        params = filter.compile(engine).params
+        eq_(params["ST_Distance_1"], 0)
+        geometry = wkb.loads(str(params["GeomFromWKB_1"]))
+        self.assertAlmostEqual(geometry.bounds[2], 0.8983152841195214, 2)
+
+    def test_geom_filter_transform_area(self):
+        from nose.plugins.skip import SkipTest
+        from shapely.geometry import Point
+        from mapfish.protocol import create_geom_filter, pyproj
+        if pyproj is None or not hasattr(pyproj, 'CRS'):
+            raise SkipTest("pyproj 2 is not installed")
+        base = declarative_base(metadata=MetaData())
+        class Mercator(base, GeometryTableMixIn):
+            __tablename__ = "mercator"
+            id = Column(types.Integer, primary_key=True)
+            geom = GeometryColumn(Geometry(dimension=2, srid=3857))
+        class Swiss(base, GeometryTableMixIn):
+            __tablename__ = "swiss"
+            id = Column(types.Integer, primary_key=True)
+            geom = GeometryColumn(Geometry(dimension=2, srid=2056))
+
+        # the world box is clipped to the area of use of the system
+        request = FakeRequest({"bbox": "-180,-90,180,90", "epsg": "4326"})
+        params = create_geom_filter(request, Mercator).compile(engine).params
+        eq_(params["GeomFromWKB_2"], 3857)
+        geometry = wkb.loads(str(params["GeomFromWKB_1"]))
+        self.assertAlmostEqual(geometry.bounds[0], -20037508.34, 2)
+        self.assertAlmostEqual(geometry.bounds[2], 20037508.34, 2)
+        ok_(geometry.bounds[3] < 2.1e7)
+
+        params = create_geom_filter(request, Swiss).compile(engine).params
+        eq_(params["GeomFromWKB_2"], 2056)
+        geometry = wkb.loads(str(params["GeomFromWKB_1"]))
+        ok_(geometry.is_valid)
+        # Geneva and Zurich
+        ok_(geometry.contains(Point(2500000, 1118000)))
+        ok_(geometry.contains(Point(2683000, 1248000)))
+
+        # out of the area of use, the column is transformed by the database
+        request = FakeRequest({"bbox": "140,-40,150,-30", "epsg": "4326"})
+        filter = create_geom_filter(request, Swiss)
+        ok_('ST_Transform' in _compiled_to_string(filter.compile(engine)))
+
     def test_geom_filter_misc(self):
         from mapfish.protocol import create_geom_filter
         request = FakeRequest({})
@@ -319,7 +490,735 @@ class Test(unittest.TestCase):
         assert "ORDER BY" in query_to_str(query)
         assert "DESC" in query_to_str(query)
     
+    def test_protocol_query_cursor(self):
+        from webob.exc import HTTPException
+        from mapfish.protocol import Protocol
+        proto = Protocol(Session, MappedClass)
+
+        request = FakeRequest({"sort": "text", "limit": "2"})
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert 'ORDER BY "table".text ASC, "table".id ASC' in query_str
+
+        request = FakeRequest({"limit": "2", "cursor": ""})
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert 'WHERE' not in query_str
+        assert 'ORDER BY "table".id ASC' in query_str
+
+        cursor = proto._encode_cursor(
+            FakeRequest({"sort": "text"}), u"foo", 12)
+        request = FakeRequest({"sort": "text", "dir": "DESC",
+                               "limit": "2", "offset": "10",
+                               "cursor": cursor})
+        query = proto._query(request, execute=False)
+        query_str = query_to_str(query)
+        assert '("table".text, "table".id) < (' in query_str
+        assert 'ORDER BY "table".text DESC, "table".id DESC' in query_str
+        assert 'OFFSET' not in query_str
+        params = query.statement.compile(engine).params
+        assert u"foo" in params.values()
+        assert 12 in params.values()
+
+        cursor = proto._encode_cursor(FakeRequest({}), None, 12)
+        request = FakeRequest({"limit": "2", "cursor": cursor})
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert '"table".id > ' in query_str
+
+        request = FakeRequest({"limit": "2", "cursor": "foo"})
+        try:
+            proto._query(request, execute=False)
+        except HTTPException, e:
+            eq_(e.wsgi_response.status_int, 400)
+        else:
+            assert False
+
+    def test_protocol_query_cursor_null(self):
+        from mapfish.protocol import Protocol
+        proto = Protocol(Session, MappedClass)
+
+        # PostgreSQL sorts NULL after the other values
+        cursor = proto._encode_cursor(FakeRequest({"sort": "text"}), u"foo", 12)
+        request = FakeRequest({"sort": "text", "limit": "2", "cursor": cursor})
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert 'OR "table".text IS NULL' in query_str
+        request.params["dir"] = "DESC"
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert 'IS NULL' not in query_str
+
+        cursor = proto._encode_cursor(FakeRequest({"sort": "text"}), None, 12)
+        request = FakeRequest({"sort": "text", "limit": "2", "cursor": cursor})
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert '"table".text IS NULL AND "table".id > ' in query_str
+        assert 'IS NOT NULL' not in query_str
+        request.params["dir"] = "DESC"
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert 'OR "table".text IS NOT NULL' in query_str
+
+        # SQLite sorts NULL before the other values
+        session, sqlite_engine = sqlite_session()
+        for i, text in enumerate([u'b', None, u'a', None, u'b', None, u'c']):
+            sqlite_engine.execute('INSERT INTO "table" (id, text) '
+                                  'VALUES (?, ?)', i + 1, text)
+        proto = Protocol(session, MappedClass)
+
+        for dir, expected in (("ASC", [2, 4, 6, 3, 1, 5, 7]),
+                              ("DESC", [7, 5, 1, 3, 6, 4, 2])):
+            ids = []
+            params = {"sort": "text", "dir": dir, "limit": "2", "cursor": ""}
+            while True:
+                collection = proto.read(FakeRequest(dict(params)))
+                ids.extend([f.id for f in collection.features])
+                if 'cursor' not in collection.extra:
+                    break
+                params["cursor"] = collection.extra["cursor"]
+            eq_(ids, expected)
+        session.remove()
+
+    def test_protocol_read_cursor_types(self):
+        import datetime, decimal, simplejson
+        from base64 import urlsafe_b64encode
+        from webob.exc import HTTPException
+        from mapfish.protocol import Protocol
+        class Survey(declarative_base(metadata=MetaData()),
+                     GeometryTableMixIn):
+            __tablename__ = "survey"
+            id = Column(types.Integer, primary_key=True)
+            day = Column(types.Date)
+            time = Column(types.DateTime)
+            height = Column(types.Numeric(8, 3))
+            geom = GeometryColumn(Geometry(dimension=2, srid=4326))
+        sqlite_engine = create_engine('sqlite://')
+        Survey.__table__.create(sqlite_engine)
+        day = datetime.date(2011, 1, 1)
+        time = datetime.datetime(2011, 1, 1, 12, 30, 15, 250000)
+        heights = ['0.1', '0.3', '0.2', '0.3', None, '0.1', '0.2']
+        for i, height in enumerate(heights):
+            sqlite_engine.execute(Survey.__table__.insert().values(
+                id=i + 1, day=day + datetime.timedelta(days=i % 3),
+                time=time + datetime.timedelta(seconds=i % 3),
+                height=height if height is None else decimal.Decimal(height)))
+        session = orm.scoped_session(orm.sessionmaker(bind=sqlite_engine))
+        proto = Protocol(session, Survey)
+
+        def read(sort, dir):
+            ids = []
+            params = {"sort": sort, "dir": dir, "limit": "2", "cursor": "",
+                      "no_geom": "true"}
+            while True:
+                collection = proto.read(FakeRequest(dict(params)))
+                ids.extend([f.id for f in collection.features])
+                if 'cursor' not in collection.extra:
+                    break
+                params["cursor"] = collection.extra["cursor"]
+            return ids
+        for sort in ("day", "time"):
+            eq_(read(sort, "ASC"), [1, 4, 7, 2, 5, 3, 6])
+            eq_(read(sort, "DESC"), [6, 3, 5, 2, 7, 4, 1])
+        eq_(read("height", "ASC"), [5, 1, 6, 3, 7, 2, 4])
+        eq_(read("height", "DESC"), [4, 2, 7, 3, 6, 1, 5])
+
+        # the values of the cursor are of the types of the columns
+        for sort, value in (("day", day), ("time", time),
+                            ("height", decimal.Decimal("0.10000000000000001"))):
+            request = FakeRequest({"sort": sort})
+            request.params["cursor"] = proto._encode_cursor(request, value, 1)
+            params = proto._get_cursor_filter(request).compile().params
+            ok_(value in params.values())
+            eq_(set(type(v) for v in params.values()), set([type(value), int]))
+
+        for sort, values in (("day", ["foo", 1]), ("time", [12, 1]),
+                             ("height", ["foo", 1]), ("height", [0.1, "x"]),
+                             ("height", {"a": 1}), ("height", [])):
+            cursor = urlsafe_b64encode(simplejson.dumps(values))
+            try:
+                proto.read(FakeRequest({"sort": sort, "limit": "2",
+                                        "cursor": cursor}))
+            except HTTPException, e:
+                eq_(e.wsgi_response.status_int, 400)
+            else:
+                assert False, (sort, values)
+        session.remove()
+
+    def test_protocol_next_cursor(self):
+        from simplejson import loads
+        from base64 import urlsafe_b64decode
+        from mapfish.protocol import Protocol
+        proto = Protocol(Session, MappedClass)
+
+        request = FakeRequest({"sort": "text", "limit": "2"})
+        cursor = proto._get_next_cursor(request, 2, 12, u"foo")
+        eq_(loads(urlsafe_b64decode(cursor)), [u"foo", 12])
+        assert proto._get_next_cursor(request, 1, 12, u"foo") is None
+
+        request = FakeRequest({"limit": "2"})
+        assert proto._get_next_cursor(request, 2, 12, None) is None
+
+        request = FakeRequest({"limit": "2", "cursor": ""})
+        cursor = proto._get_next_cursor(request, 2, 12, None)
+        eq_(loads(urlsafe_b64decode(cursor)), [12])
+
+    def test_protocol_query_projection(self):
+        from mapfish.protocol import Protocol
+        proto = Protocol(Session, MappedClass)
+
+        request = FakeRequest({})
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert '"table".text' in query_str
+        assert '"table".geom' in query_str
+
+        request = FakeRequest({"attrs": "id", "no_geom": "true"})
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert '"table".id' in query_str
+        assert '"table".text' not in query_str
+        assert '"table".geom' not in query_str
+
+        request = FakeRequest({"attrs": "text"})
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert '"table".id' in query_str
+        assert '"table".text' in query_str
+        assert '"table".geom' in query_str
+
+    def test_to_feature_projection(self):
+        obj = MappedClass(id=1, text=u"foo")
+        obj._mf_shape = Polygon(((1, 2), (1, 3), (2, 3), (2, 2), (1, 2)))
+
+        feature = obj.toFeature()
+        eq_(feature.properties, {"text": u"foo"})
+        ok_(feature.__geo_interface__["geometry"] is not None)
+
+        feature = obj.toFeature(attrs=[], no_geom=True)
+        eq_(feature.id, 1)
+        eq_(feature.properties, {})
+        ok_(feature.__geo_interface__["geometry"] is None)
+
+    def test_to_feature_tolerance(self):
+        from geoalchemy import WKBSpatialElement
+        from geoalchemy.postgis import PGPersistentSpatialElement
+        from sqlalchemy.orm.attributes import set_committed_value
+        from shapely.geometry import LineString
+        line = LineString([(0, 0), (1, 0.01), (2, 0), (3, 0.01), (4, 0)])
+        obj = MappedClass(id=1, text=u"foo")
+        # as read from the database
+        set_committed_value(obj, "geom", PGPersistentSpatialElement(
+            WKBSpatialElement(buffer(line.wkb), 4326)))
+
+        feature = obj.toFeature()
+        eq_(len(feature.__geo_interface__["geometry"]["coordinates"]), 5)
+
+        feature = obj.toFeature(tolerance=0.1)
+        eq_(len(feature.__geo_interface__["geometry"]["coordinates"]), 2)
+
+        # decoded without Shapely
+        feature = obj.toFeature(shapely=False)
+        ok_(isinstance(feature.geometry, GeoJSONLineString))
+        eq_(feature.geometry.coordinates[1], (1.0, 0.01))
+        eq_(feature.extra["bbox"], (0, 0, 4, 0.01))
+        feature = obj.toFeature(tolerance=0.1, shapely=False)
+        eq_(len(feature.__geo_interface__["geometry"]["coordinates"]), 2)
+
+    def test_protocol_query_resolution(self):
+        from shapely.geometry import Point
+        from mapfish.protocol import Protocol
+        proto = Protocol(Session, MappedClass)
+
+        request = FakeRequest({"resolution": "10"})
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert 'ST_AsBinary(ST_SimplifyPreserveTopology("table".geom, %(ST_SimplifyPreserveTopology_1)s))' in query_str
+        # the full geometry is not read
+        assert 'AsBinary("table".geom)' not in query_str
+
+        request = FakeRequest({"resolution": "10", "no_geom": "true"})
+        query_str = query_to_str(proto._query(request, execute=False))
+        assert 'Simplify' not in query_str
+
+        # the simplified geometry is set as the shape of the objects
+        request = FakeRequest({"resolution": "10"})
+        objs = list(proto._objects(
+            [(MappedClass(id=1), buffer(Point(1, 2).wkb)),
+             (MappedClass(id=2), None)], request))
+        ok_(objs[0]._mf_shape.equals(Point(1, 2)))
+        ok_(objs[1]._mf_shape is None)
+
+        # the NULL geometries are not read by other queries
+        statements = []
+        session, sqlite_engine = sqlite_session(statements)
+        sqlite_engine.execute('INSERT INTO "table" (id, geom) VALUES (?, ?)',
+                              [(1, buffer(Point(1, 2).wkb)), (2, None)])
+        del statements[:]
+        collection = Protocol(session, MappedClass).read(request)
+        eq_([getattr(f.geometry, "coordinates", None)
+             for f in collection.features], [(1.0, 2.0), None])
+        eq_(statements, ["SELECT"])
+        session.remove()
+
+        proto = Protocol(Session, MappedClass, database_geojson=True)
+        request = FakeRequest({"resolution": "10"})
+        query = proto._json_query(proto._query(request, execute=False), request)
+        assert 'ST_AsGeoJSON(ST_SimplifyPreserveTopology("table".geom, ' in query_to_str(query)
+
+    def test_protocol_precision(self):
+        from mapfish.protocol import Protocol
+        obj = MappedClass(id=1, text=u"foo")
+        obj._mf_shape = Polygon(((1.23456, 2), (1, 3), (2, 3.45678), (2, 2), (1.23456, 2)))
+
+        proto = Protocol(Session, MappedClass)
+        feature = proto._to_feature(obj, FakeRequest({}))
+        eq_(feature.geometry.coordinates[0][0], (1.23456, 2.0))
+
+        proto = Protocol(Session, MappedClass, precision=2)
+        feature = proto._to_feature(obj, FakeRequest({}))
+        eq_(feature.geometry.coordinates[0][0], [1.23, 2.0])
+        eq_(feature.extra['bbox'], [1.0, 2.0, 2.0, 3.46])
+        # the geometry of the object is not modified
+        eq_(obj._mf_shape.exterior.coords[0], (1.23456, 2.0))
+
+        feature = proto._to_feature(obj, FakeRequest({"precision": "1"}))
+        eq_(feature.geometry.coordinates[0][2], [2.0, 3.5])
+
+        proto = Protocol(Session, MappedClass, database_geojson=True)
+        request = FakeRequest({"precision": "3"})
+        query = proto._json_query(proto._query(request, execute=False), request)
+        compiled = query.statement.compile(engine)
+        eq_(compiled.params["ST_AsGeoJSON_2"], 3)
+
+    def test_protocol_read_stream(self):
+        from mapfish.protocol import Protocol, FeatureStream
+        proto = Protocol(Session, MappedClass)
+
+        # the query is only executed when the stream is iterated
+        request = FakeRequest({"limit": "2"})
+        stream = proto.read(request, stream=True)
+        assert isinstance(stream, FeatureStream)
+
+    def test_protocol_read_stream_database_geojson(self):
+        from mapfish.protocol import Protocol, EncodedFeatureStream
+        proto = Protocol(Session, MappedClass, database_geojson=True)
+
+        request = FakeRequest({"precision": "6"})
+        stream = proto.read(request, stream=True)
+        assert isinstance(stream, EncodedFeatureStream)
+
+        query = proto._json_query(proto._query(request, execute=False), request)
+        query_str = query_to_str(query)
+        assert 'json_build_object(' in query_str
+        assert 'ST_AsGeoJSON("table".geom, ' in query_str
+        assert 'ST_XMin("table".geom)' in query_str
+
+        request = FakeRequest({"no_geom": "true"})
+        assert isinstance(proto.read(request, stream=True),
+                          EncodedFeatureStream)
+        query = proto._json_query(proto._query(request, execute=False), request)
+        assert 'ST_AsGeoJSON' not in query_to_str(query)
+
+        # PostGIS does not write the coordinates as repr() does
+        stream = proto.read(FakeRequest({}), stream=True)
+        ok_(not isinstance(stream, EncodedFeatureStream))
+
+        # the dates are formatted as str() does
+        class Dated(declarative_base(metadata=MetaData()),
+                    GeometryTableMixIn):
+            __tablename__ = "dated"
+            id = Column(types.Integer, primary_key=True)
+            day = Column(types.Date)
+            time = Column(types.DateTime)
+            zoned = Column(types.DateTime(timezone=True))
+            geom = GeometryColumn(Geometry(dimension=2, srid=4326))
+            @property
+            def year(self):
+                return self.day.year
+        proto = Protocol(Session, Dated, database_geojson=True)
+        request = FakeRequest({"no_geom": "true", "attrs": "day,time"})
+        ok_(proto._encodes_in_database(request))
+        query = proto._json_query(proto._query(request, execute=False), request)
+        query_str = query_to_str(query)
+        assert "to_char(dated.day, %(to_char_1)s)" in query_str
+        assert "CASE WHEN (to_char(dated.time, %(to_char_2)s) = " \
+               "%(to_char_3)s) THEN to_char(dated.time, %(to_char_4)s) " \
+               "ELSE to_char(dated.time, %(to_char_5)s) END" in query_str
+        params = query.statement.compile(engine).params
+        eq_([params["to_char_%d" % i] for i in range(1, 6)],
+            ['YYYY-MM-DD', 'US', '000000', 'YYYY-MM-DD HH24:MI:SS',
+             'YYYY-MM-DD HH24:MI:SS.US'])
+
+        # the properties and the timestamps with time zone are encoded in
+        # Python
+        request = FakeRequest({"no_geom": "true", "attrs": "day,zoned"})
+        ok_(not proto._encodes_in_database(request))
+        Dated.exported_keys = ["day", "year"]
+        request = FakeRequest({"no_geom": "true", "attrs": "day,year"})
+        ok_(not proto._encodes_in_database(request))
+        request = FakeRequest({"no_geom": "true", "attrs": "day"})
+        ok_(proto._encodes_in_database(request))
+
+    def test_feature_stream(self):
+        from simplejson import loads
+        from mapfish.decorators import MapFishEncoder
+        from mapfish.protocol import FeatureStream
+        features = [Feature(id=i, properties={"text": "foo"}) for i in range(10)]
+
+        stream = FeatureStream(features, buffer_size=100)
+        chunks = list(stream.iterencode(MapFishEncoder()))
+        assert len(chunks) > 1
+        collection = loads(''.join(chunks))
+        eq_(collection["type"], "FeatureCollection")
+        eq_([f["id"] for f in collection["features"]], range(10))
+
+        stream = FeatureStream([])
+        eq_(''.join(stream.iterencode(MapFishEncoder())),
+            '{"type": "FeatureCollection", "features": []}')
+
+        stream = FeatureStream([], members={"cursor": "WzEyXQ=="})
+        eq_(''.join(stream.iterencode(MapFishEncoder())),
+            '{"type": "FeatureCollection", "features": [], "cursor": "WzEyXQ=="}')
+
+    def test_protocol_cache(self):
+        from mapfish.cache import LRUCache
+        from mapfish.protocol import Protocol
+        proto = Protocol(Session, MappedClass, cache=LRUCache())
+        calls = []
+        def count(request, filter=None):
+            calls.append(request)
+            return str(len(calls)), False
+        proto._count = count
+
+        eq_(proto.count(FakeRequest({"bbox": "-180,-90,180,90"})), '1')
+        eq_(proto.count(FakeRequest({"bbox": "-180,-90,180,90.0"})), '1')
+        eq_(proto.count(FakeRequest({"bbox": "-180,-90,180,80"})), '2')
+        # custom filters are not cached
+        eq_(proto.count(FakeRequest({}), filter=MappedClass.id == 1), '3')
+        eq_(proto.count(FakeRequest({"bbox": "-180,-90,180,90"})), '1')
+
+        proto._invalidate()
+        eq_(proto.count(FakeRequest({"bbox": "-180,-90,180,90"})), '4')
+
+    def test_protocol_etag(self):
+        from webob.exc import HTTPException
+        from mapfish.protocol import Protocol
+        from mapfish.cache import LRUCache
+        proto = Protocol(Session, MappedClass, etag=True,
+                         versions=LRUCache())
+        calls = []
+        def count(request, filter=None):
+            calls.append(request)
+            return str(len(calls)), False
+        proto._count = count
+
+        response = FakeResponse()
+        eq_(proto.count(FakeRequest({"bbox": "-180,-90,180,90"}),
+                        response=response), '1')
+        etag = response.headers['ETag']
+
+        request = FakeRequest({"bbox": "-180,-90,180,90"})
+        request.environ['HTTP_IF_NONE_MATCH'] = '"foo", ' + etag
+        try:
+            proto.count(request, response=FakeResponse())
+        except HTTPException, e:
+            eq_(e.wsgi_response.status_int, 304)
+            eq_(e.wsgi_response.headers['ETag'], etag)
+        else:
+            assert False
+        eq_(len(calls), 1)
+
+        # another request
+        response = FakeResponse()
+        request = FakeRequest({"bbox": "-180,-90,180,80"})
+        request.environ['HTTP_IF_NONE_MATCH'] = etag
+        eq_(proto.count(request, response=response), '2')
+        ok_(response.headers['ETag'] != etag)
+
+        # the table is modified
+        proto._invalidate()
+        response = FakeResponse()
+        request = FakeRequest({"bbox": "-180,-90,180,90"})
+        request.environ['HTTP_IF_NONE_MATCH'] = etag
+        eq_(proto.count(request, response=response), '3')
+        ok_(response.headers['ETag'] != etag)
+
+    def test_protocol_etag_warning(self):
+        import warnings
+        from mapfish.protocol import Protocol
+        from mapfish.cache import LRUCache
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', Warning)
+            Protocol(Session, MappedClass, etag=True)
+            eq_(len(caught), 1)
+            ok_('MappedClass' in str(caught[0].message))
+            Protocol(Session, MappedClass, etag=True, cache=LRUCache())
+            Protocol(Session, MappedClass, etag=True, versions=LRUCache())
+            Protocol(Session, MappedClass)
+            eq_(len(caught), 1)
+
+    def test_protocol_count_estimate(self):
+        from mapfish.protocol import Protocol, Explain
+        proto = Protocol(Session, MappedClass, estimate_threshold=1000)
+        proto._estimate_count = lambda filter: 2300000
+
+        request = FakeRequest({"estimate": "true"})
+        response = FakeResponse()
+        eq_(proto.count(request, response=response), '2300000')
+        eq_(response.headers['X-Count-Type'], 'estimated')
+
+        query = Session.query(MappedClass.id).filter(MappedClass.id > 1)
+        explain = Explain(query.statement).compile(engine)
+        eq_(unicode(explain),
+            u'EXPLAIN SELECT "table".id \nFROM "table" \nWHERE "table".id > %(id_1)s')
+        eq_(explain.params, {"id_1": 1})
+
+    def test_protocol_read_ids(self):
+        from webob.exc import HTTPException
+        from mapfish.protocol import Protocol
+        session, sqlite_engine = sqlite_session()
+        for i in range(1, 6):
+            sqlite_engine.execute('INSERT INTO "table" (id, text) '
+                                  'VALUES (%d, \'foo%d\')' % (i, i))
+        proto = Protocol(session, MappedClass, chunk_size=2)
+
+        request = FakeRequest({"ids": "4,1,7,3,1,5", "no_geom": "true"})
+        collection = proto.read(request)
+        eq_([f.id for f in collection.features], [4, 1, 3, 5])
+        eq_(collection.features[0].properties, {"text": u"foo4"})
+        eq_(collection.extra["missing"], ["7"])
+
+        collection = proto.read(request, filter=MappedClass.id > 3)
+        eq_([f.id for f in collection.features], [4, 5])
+        eq_(collection.extra["missing"], ["1", "7", "3"])
+
+        # the identifiers are converted to the type of the primary key
+        request = FakeRequest({"ids": "04,1.0,1,7.0", "no_geom": "true"})
+        collection = proto.read(request)
+        eq_([f.id for f in collection.features], [4, 1])
+        eq_(collection.extra["missing"], ["7.0"])
+        for ids in ("1,foo", "1.5"):
+            try:
+                proto.read(FakeRequest({"ids": ids}))
+            except HTTPException, e:
+                eq_(e.wsgi_response.status_int, 400)
+            else:
+                assert False
+        session.remove()
+
+    def test_protocol_read_memory(self):
+        from simplejson import loads
+        from shapely.geometry import Point
+        from mapfish.protocol import Protocol, EncodedFeatureStream
+        from mapfish.memory import MemoryLayer
+        session, sqlite_engine = sqlite_session()
+        for i in range(1, 6):
+            sqlite_engine.execute('INSERT INTO "table" (id, text, geom) '
+                                  'VALUES (?, ?, ?)', i, 'foo%d' % i,
+                                  buffer(Point(i, i).wkb))
+        proto = Protocol(session, MappedClass, memory=MemoryLayer())
+        ids = lambda collection: [f.id for f in collection.features]
+
+        stream = proto.read(FakeRequest({}), stream=True)
+        ok_(isinstance(stream, EncodedFeatureStream))
+        eq_([loads(f)["id"] for f in stream], [1, 2, 3, 4, 5])
+        eq_(loads(stream.features[0]),
+            {"type": "Feature", "id": 1, "bbox": [1.0, 1.0, 1.0, 1.0],
+             "geometry": {"type": "Point", "coordinates": [1.0, 1.0]},
+             "properties": {"text": "foo1"}})
+
+        # the features are decoded unless they are streamed
+        collection = proto.read(FakeRequest({}))
+        ok_(isinstance(collection, FeatureCollection))
+        eq_(ids(collection), [1, 2, 3, 4, 5])
+        feature = collection.features[0]
+        ok_(isinstance(feature, Feature))
+        eq_(feature.geometry.coordinates, [1.0, 1.0])
+        eq_(feature.properties, {"text": "foo1"})
+        eq_(feature.extra["bbox"], [1.0, 1.0, 1.0, 1.0])
+
+        # the table is only read once
+        sqlite_engine.execute('DELETE FROM "table" WHERE id = 1')
+        eq_(ids(proto.read(FakeRequest({"bbox": "1.5,1.5,3.5,3.5"}))), [2, 3])
+        eq_(ids(proto.read(FakeRequest({"lon": "1", "lat": "1.5",
+                                        "tolerance": "1.2"}))), [1, 2])
+        eq_(ids(proto.read(FakeRequest({"bbox": "0,0,10,10",
+                                        "offset": "1", "limit": "2"}))), [2, 3])
+
+        # the requests with other params, or with a custom filter, are sent
+        # to the database
+        collection = proto.read(FakeRequest({"no_geom": "true"}))
+        eq_([f.id for f in collection.features], [2, 3, 4, 5])
+        collection = proto.read(FakeRequest({}), filter=MappedClass.id > 3)
+        eq_([f.id for f in collection.features], [4, 5])
+
+        # the features are reloaded once the table is modified
+        proto._invalidate()
+        eq_(ids(proto.read(FakeRequest({}))), [2, 3, 4, 5])
+
+        # the table is too large
+        proto = Protocol(session, MappedClass,
+                         memory=MemoryLayer(max_features=2))
+        collection = proto.read(FakeRequest({}))
+        eq_([f.id for f in collection.features], [2, 3, 4, 5])
+        session.remove()
+
+    def test_protocol_statement_cache(self):
+        import mapfish.protocol
+        from mapfish.protocol import Protocol
+        session, sqlite_engine = sqlite_session()
+        for i in range(1, 6):
+            sqlite_engine.execute('INSERT INTO "table" (id, text) '
+                                  'VALUES (%d, \'foo%d\')' % (i, i))
+        proto = Protocol(session, MappedClass, statement_cache=True)
+        statements = mapfish.protocol.LRUCache()
+        previous = mapfish.protocol._statements
+        mapfish.protocol._statements = statements
+        try:
+            # the cache is opt-in
+            request = FakeRequest({"no_geom": "true"})
+            collection = Protocol(session, MappedClass).read(request)
+            eq_(len(collection.features), 5)
+            eq_(len(statements), 0)
+
+            request = FakeRequest({"queryable": "text", "text__ne": u"foo2",
+                                   "no_geom": "true", "limit": "2"})
+            collection = proto.read(request)
+            eq_([f.id for f in collection.features], [1, 3])
+            eq_(len(statements), 1)
+            request = FakeRequest({"queryable": "text", "text__ne": u"foo1",
+                                   "no_geom": "true", "limit": "2"})
+            collection = proto.read(request)
+            eq_([f.id for f in collection.features], [2, 3])
+            eq_(collection.features[0].properties, {"text": u"foo2"})
+            eq_(len(statements), 1)
+
+            # the limit and the offset are bind params
+            request = FakeRequest({"queryable": "text", "text__ne": u"foo1",
+                                   "no_geom": "true", "limit": "3"})
+            collection = proto.read(request)
+            eq_([f.id for f in collection.features], [2, 3, 4])
+            eq_(len(statements), 1)
+            for offset, ids in (("1", [3, 4]), ("2", [4, 5])):
+                request = FakeRequest({"queryable": "text",
+                                       "text__ne": u"foo1", "no_geom": "true",
+                                       "limit": "2", "offset": offset})
+                collection = proto.read(request)
+                eq_([f.id for f in collection.features], ids)
+                eq_(len(statements), 2)
+            request = FakeRequest({"queryable": "text", "text__ne": u"foo1",
+                                   "no_geom": "true", "offset": "3"})
+            collection = proto.read(request)
+            eq_([f.id for f in collection.features], [5])
+            eq_(len(statements), 3)
+
+            # another shape
+            request = FakeRequest({"no_geom": "true", "sort": "text",
+                                   "dir": "DESC"})
+            collection = proto.read(request)
+            eq_([f.id for f in collection.features], [5, 4, 3, 2, 1])
+            eq_(len(statements), 4)
+
+            # not cached
+            request = FakeRequest({"no_geom": "true", "limit": "1", "cursor": ""})
+            collection = proto.read(request)
+            eq_([f.id for f in collection.features], [1])
+            eq_(len(statements), 4)
+        finally:
+            mapfish.protocol._statements = previous
+            session.remove()
+
+        # the bind params of a geometry filter
+        proto = Protocol(Session, MappedClass)
+        request = FakeRequest({"lon": "1", "lat": "2", "tolerance": "1"})
+        shape, values = proto._get_shape(request)
+        eq_(values["geometry"], buffer(wkt.loads("POINT (1 2)").wkb))
+        eq_(values["tolerance"], 1)
+        statement, paginated = proto._shape_statement(request, shape)
+        statement_str = unicode(statement.compile(engine))
+        ok_('ST_MakeEnvelope' not in statement_str)
+        ok_("GeomFromWKB(%(geometry)s, %(GeomFromWKB_1)s)" in statement_str)
+        ok_('<= %(tolerance)s' in statement_str)
+
+        # the bbox and point filters have the same shape
+        eq_(proto._get_shape(FakeRequest({"bbox": "0,0,1,1"}))[0], shape)
+
+        request = FakeRequest({"limit": "10", "offset": "20"})
+        shape, values = proto._get_shape(request)
+        eq_((values["limit"], values["offset"]), (10, 20))
+        eq_(proto._get_shape(FakeRequest({"limit": "1", "offset": "2"}))[0],
+            shape)
+        statement, paginated = proto._shape_statement(request, shape)
+        ok_(unicode(paginated.compile(engine)).endswith(
+            ' \n LIMIT %(limit)s OFFSET %(offset)s'))
+
+        # the attribute filters are typed as the columns
+        request = FakeRequest({"queryable": "id,text", "id__gt": "2",
+                               "text__ne": "foo"})
+        shape, values = proto._get_shape(request)
+        statement, paginated = proto._shape_statement(request, shape)
+        binds = paginated.compile(engine).binds
+        ok_(isinstance(binds["id__gt"].type, types.Integer))
+        ok_(isinstance(binds["text__ne"].type, types.Unicode))
+
+    def test_protocol_cluster(self):
+        from webob.exc import HTTPException
+        from mapfish.protocol import Protocol, create_default_filter
+        proto = Protocol(Session, MappedClass, cluster_size=20)
+
+        request = FakeRequest({"bbox": "0,0,10,10"})
+        filter = create_default_filter(request, MappedClass)
+        query = proto._cluster_query(filter, 100.0)
+        query_str = query_to_str(query)
+        assert query_str.startswith('SELECT count(ST_Centroid("table".geom)) AS count_1, avg(ST_X(ST_Centroid("table".geom))) AS avg_1, avg(ST_Y(ST_Centroid("table".geom))) AS avg_2 \nFROM "table" \nWHERE (ST_Expand(GeomFromWKB(')
+        assert query_str.endswith(' AND "table".geom IS NOT NULL GROUP BY ST_SnapToGrid(ST_Centroid("table".geom), %(ST_SnapToGrid_1)s)')
+
+        # the resolution is required
+        try:
+            proto.read(FakeRequest({"cluster": "true"}))
+        except HTTPException, e:
+            eq_(e.wsgi_response.status_int, 400)
+        else:
+            assert False
+
+    def test_grid_cells(self):
+        import mapfish.protocol
+        from mapfish.protocol import _grid_cells
+        points = [(0, 0), (1.2, 1.5), (10, 10), (-0.6, 0), (1.8, 1)]
+        expected = [(1, 10.0, 10.0), (2, -0.3, 0.0), (2, 1.5, 1.25)]
+
+        eq_(sorted(_grid_cells(points, 2)), expected)
+        eq_(_grid_cells([], 2), [])
+
+        numpy = mapfish.protocol.numpy
+        mapfish.protocol.numpy = None
+        try:
+            eq_(sorted(_grid_cells(points, 2)), expected)
+        finally:
+            mapfish.protocol.numpy = numpy
+
+    def test_protocol_tile(self):
+        from webob.exc import HTTPException
+        from mapfish.protocol import Protocol, create_attr_filter
+        from mapfish import mvt
+        proto = Protocol(Session, MappedClass)
+
+        request = FakeRequest({"attrs": "text", "queryable": "text",
+                               "text__eq": "foo"})
+        bounds = mvt.tile_bounds(1, 0, 0)
+        filter = create_attr_filter(request, MappedClass)
+        statement = proto._tile_query(request, filter, bounds)
+        compiled = statement.compile(engine)
+        statement_str = _compiled_to_string(compiled)
+        assert statement_str.startswith('SELECT ST_AsMVT(mvt_rows, ')
+        assert 'SELECT "table".id AS id, "table".text AS text, ST_AsMVTGeom(ST_Transform("table".geom, %(ST_Transform_1)s), ST_MakeEnvelope(' in statement_str
+        assert '"table".text = %(text_1)s' in statement_str
+        eq_(compiled.params["ST_AsMVT_2"], "table")
+        eq_(compiled.params["ST_AsMVT_5"], "id")
+        eq_([compiled.params["ST_MakeEnvelope_%d" % i] for i in range(1, 6)],
+            list(bounds) + [3857])
+
+        # the tile is out of the grid
+        for z, x, y in ((1, 2, 0), (1, 0, -1), (-1, 0, 0)):
+            try:
+                proto.tile(FakeRequest({}), z, x, y)
+            except HTTPException, e:
+                eq_(e.wsgi_response.status_int, 404)
+            else:
+                assert False
+
     def test_protocol_create(self):
+        from shapely.geometry import Point
         from mapfish.protocol import Protocol
         proto = Protocol(Session, MappedClass)
         request = FakeRequest({})
@@ -330,6 +1229,436 @@ class Test(unittest.TestCase):
         assert len(Session.new) == 2
         for obj in Session.new:
             assert obj["text"] == "foo"
-            assert obj._mf_shape.x == 45
-            assert obj._mf_shape.y == 5
+            # floats, as the coordinates read from the database
+            assert obj._mf_shape.coordinates == (45.0, 5.0)
+            assert type(obj._mf_shape.coordinates[0]) is float
+            assert str(obj.geometry.desc) == Point(45, 5).wkb
         Session.rollback()
+
+    def test_protocol_create_bulk(self):
+        from shapely.geometry import Point
+        from mapfish.protocol import Protocol
+        statements = []
+        session, sqlite_engine = sqlite_session(statements)
+        for i in range(1, 4):
+            sqlite_engine.execute('INSERT INTO "table" (id, text, geom) '
+                                  'VALUES (?, ?, ?)', i, 'foo%d' % i,
+                                  buffer(Point(i, i).wkb))
+
+        calls = []
+        def before_create(request, feature, obj):
+            calls.append((feature.id, obj is None))
+            if obj is not None:
+                feature.properties["text"] += "-updated"
+        proto = Protocol(session, MappedClass, bulk_create=True,
+                         before_create=before_create, chunk_size=2)
+        feature = '{"type": "Feature", "id": %s, "properties": {"text": "%s"}, "geometry": {"type": "Point", "coordinates": [%d, 0]}}'
+        request = FakeRequest({})
+        request.body = '{"type": "FeatureCollection", "features": [%s]}' % \
+            ', '.join([feature % ('1', 'bar1', 10), feature % ('7', 'bar7', 70),
+                       feature % ('null', 'new', 80), feature % ('3', 'bar3', 30),
+                       feature % ('2', 'bar2', 20)])
+        del statements[:]
+        response = FakeResponse()
+        collection = proto.create(request, response)
+        eq_(response.status, 201)
+        eq_(calls, [(1, False), (7, True), (None, True), (3, False),
+                    (2, False)])
+        # two selects of the existing objects, one upsert of the existing
+        # objects and the inserts of the new objects
+        eq_(statements, ['SELECT', 'SELECT', 'INSERT', 'INSERT', 'INSERT'])
+        eq_([f.id for f in collection.features], [1, 4, 5, 3, 2])
+        eq_([f.properties["text"] for f in collection.features],
+            ["bar1-updated", "bar7", "new", "bar3-updated", "bar2-updated"])
+
+        rows = sqlite_engine.execute('SELECT id, text, geom FROM "table" '
+                                     'ORDER BY id').fetchall()
+        eq_([(r[0], r[1]) for r in rows],
+            [(1, "bar1-updated"), (2, "bar2-updated"), (3, "bar3-updated"),
+             (4, "bar7"), (5, "new")])
+        eq_([wkb.loads(str(r[2])).x for r in rows], [10, 20, 30, 70, 80])
+        session.remove()
+
+    def test_upsert(self):
+        from mapfish.protocol import Upsert
+        table = MappedClass.__table__
+        upsert = Upsert(table.insert(), table.c.id, [table.c.text])
+        eq_(unicode(upsert.compile(engine, column_keys=["id", "text"])),
+            'INSERT INTO "table" (id, text) VALUES (%(id)s, %(text)s) '
+            'ON CONFLICT (id) DO UPDATE SET text = excluded.text')
+        upsert = Upsert(table.insert(), table.c.id, [])
+        eq_(unicode(upsert.compile(engine, column_keys=["id"])),
+            'INSERT INTO "table" (id) VALUES (%(id)s) '
+            'ON CONFLICT (id) DO NOTHING')
+
+    def test_read_features(self):
+        from mapfish.protocol import _read_features
+        def read(body, chunk_size=7):
+            return list(_read_features(StringIO(body), len(body), chunk_size))
+
+        body = '{"features" : [ {"type": "Feature", "id": 12, "properties": {"text": "f\xc3\xa9\xc3\xa9", "n": [1, {"m": null}]}, "geometry": {"type": "Point", "coordinates": [45, 5.125]}},\n\t{"type": "Feature", "properties": {}, "geometry": null, "id": 123456789} ] , "crs": {"type": "name", "properties": {"name": "EPSG:4326"}}, "type": "FeatureCollection"} '
+        for chunk_size in (1, 7, 65536):
+            features = read(body, chunk_size)
+            eq_([f.id for f in features], [12, 123456789])
+            eq_(features[0].properties,
+                {"text": u"f\xe9\xe9", "n": [1, {"m": None}]})
+            eq_(features[0].geometry.coordinates, [45, 5.125])
+            eq_(features[1].properties, {})
+
+        eq_(read('{"type": "FeatureCollection", "features": []}'), [])
+        # the length of the body is given
+        eq_(read('{"type": "FeatureCollection", "features": []}garbage'[:-7]), [])
+
+        for body in ('{"type": "Feature", "properties": {}, "geometry": null}',
+                     '{"type": "FeatureCollection", "features": [{"type": "Point", "coordinates": [1, 2]}]}',
+                     '{"type": "FeatureCollection", "features": [{"type": "Feature"}',
+                     '{"type": "FeatureCollection", "features": [} ',
+                     '{"features": []}',
+                     '[]'):
+            try:
+                read(body)
+            except ValueError:
+                pass
+            else:
+                assert False, body
+
+    def test_protocol_create_stream(self):
+        from webob.exc import HTTPException
+        from simplejson import loads
+        from mapfish.protocol import Protocol, EncodedFeatureStream
+        session, sqlite_engine = sqlite_session()
+        proto = Protocol(session, MappedClass, chunk_size=2, precision=1)
+        count = lambda: sqlite_engine.execute(
+                'SELECT count(*) FROM "table"').scalar()
+
+        feature = '{"type": "Feature", "properties": {"text": "foo%d"}, "geometry": {"type": "Point", "coordinates": [%d.04, 0]}}'
+        request = FakeRequest({})
+        request.body = '{"type": "FeatureCollection", "features": [%s]}' % \
+            ', '.join([feature % (i, i) for i in range(5)])
+        response = FakeResponse()
+        stream = proto.create(request, response, stream=True)
+        eq_(response.status, 201)
+        ok_(isinstance(stream, EncodedFeatureStream))
+        # the first batch is committed, the next ones as the stream is read
+        eq_(count(), 2)
+        features = [loads(f) for f in stream]
+        eq_([f["id"] for f in features], [1, 2, 3, 4, 5])
+        eq_(features[4]["properties"], {"text": "foo4"})
+        eq_(features[4]["geometry"]["coordinates"], [4.0, 0.0])
+        eq_(len(session.identity_map), 0)
+        eq_(count(), 5)
+
+        # an error past the first batch interrupts the stream, the
+        # complete batches are committed
+        request = FakeRequest({})
+        request.body = '{"type": "FeatureCollection", "features": [%s, ' % \
+            ', '.join([feature % (i, i) for i in range(5, 8)])
+        stream = proto.create(request, FakeResponse(), stream=True)
+        try:
+            list(stream)
+        except ValueError:
+            pass
+        else:
+            assert False
+        eq_(count(), 7)
+
+        request = FakeRequest({})
+        request.body = '{"type": "FeatureCollection", "features": [%s, ' % \
+            (feature % (5, 5))
+        try:
+            proto.create(request, FakeResponse(), stream=True)
+        except HTTPException, e:
+            eq_(e.wsgi_response.status_int, 400)
+        else:
+            assert False
+        session.remove()
+
+    def test_protocol_bulk_update(self):
+        from webob.exc import HTTPException
+        from shapely.geometry import Point
+        from mapfish.protocol import Protocol
+        statements = []
+        session, sqlite_engine = sqlite_session(statements)
+
+        feature = '{"type": "Feature", "id": %d, "properties": {"text": "%s"}, "geometry": {"type": "Point", "coordinates": [%d, 0]}}'
+        def request(*features):
+            request = FakeRequest({})
+            request.body = '{"type": "FeatureCollection", "features": [%s]}' \
+                % ', '.join([feature % f for f in features])
+            return request
+
+        calls = []
+        def before_update(request, feature, obj):
+            calls.append((feature.id, obj.fid))
+        for batch_update in (False, True):
+            sqlite_engine.execute('DELETE FROM "table"')
+            for i in range(1, 5):
+                sqlite_engine.execute('INSERT INTO "table" (id, text, geom) '
+                                      'VALUES (?, ?, ?)', i, 'foo%d' % i,
+                                      buffer(Point(i, i).wkb))
+            proto = Protocol(session, MappedClass, chunk_size=2,
+                             before_update=before_update,
+                             batch_update=batch_update)
+            del calls[:]
+            del statements[:]
+            response = FakeResponse()
+            collection = proto.bulk_update(
+                    request((3, 'bar3', 30), (1, 'bar1', 10), (2, 'bar2', 20)),
+                    response)
+            eq_(response.status, 201)
+            eq_(calls, [(3, 3), (1, 1), (2, 2)])
+            eq_([f.id for f in collection.features], [3, 1, 2])
+            eq_(collection.features[0].properties, {"text": "bar3"})
+            if batch_update:
+                # one statement per chunk_size objects
+                eq_(statements, ['SELECT', 'SELECT', 'UPDATE', 'UPDATE'])
+            else:
+                eq_(statements, ['SELECT', 'SELECT', 'UPDATE', 'UPDATE',
+                                 'UPDATE'])
+            rows = sqlite_engine.execute('SELECT id, text, geom FROM "table" '
+                                         'ORDER BY id').fetchall()
+            eq_([(r[0], r[1]) for r in rows],
+                [(1, "bar1"), (2, "bar2"), (3, "bar3"), (4, "foo4")])
+            eq_([wkb.loads(str(r[2])).x for r in rows], [10, 20, 30, 4])
+            session.remove()
+
+        # the identifiers are converted to the type of the primary key
+        feature = '{"type": "Feature", "id": %s, "properties": {"text": "%s"}, "geometry": {"type": "Point", "coordinates": [%d, 0]}}'
+        del calls[:]
+        collection = proto.bulk_update(
+                request(('1.0', 'baz1', 1), ('"01"', 'baz1', 1),
+                        ('" 2 "', 'baz2', 2)),
+                FakeResponse())
+        eq_([f.id for f in collection.features], [1, 1, 2])
+        eq_(calls, [(1.0, 1), ("01", 1), (" 2 ", 2)])
+        session.remove()
+
+        # an object does not exist
+        del calls[:]
+        try:
+            proto.bulk_update(request(('1', 'baz1', 1), ('5', 'baz5', 5)),
+                              FakeResponse())
+        except HTTPException, e:
+            eq_(e.wsgi_response.status_int, 404)
+        else:
+            assert False
+        eq_(calls, [])
+
+        # an identifier that is not an integer
+        for id in ('1.5', '"foo"'):
+            try:
+                proto.bulk_update(request((id, 'baz1', 1)), FakeResponse())
+            except HTTPException, e:
+                eq_(e.wsgi_response.status_int, 400)
+            else:
+                assert False
+        session.remove()
+
+    def test_update_from_values(self):
+        from mapfish.protocol import UpdateFromValues
+        table = MappedClass.__table__
+        update = UpdateFromValues(table, table.c.id, [table.c.text, table.c.geom],
+                                  [{"id": 1, "text": u"foo", "geom": buffer("1")},
+                                   {"id": 2, "text": u"bar", "geom": buffer("2")}])
+        compiled = update.compile(engine)
+        eq_(unicode(compiled),
+            'UPDATE "table" SET text = mf_values.text, geom = mf_values.geom '
+            'FROM (VALUES '
+            '(CAST(%(param_1)s AS INTEGER), CAST(%(param_2)s AS VARCHAR), GeomFromWKB(%(GeomFromWKB_1)s, %(GeomFromWKB_2)s)), '
+            '(CAST(%(param_3)s AS INTEGER), CAST(%(param_4)s AS VARCHAR), GeomFromWKB(%(GeomFromWKB_3)s, %(GeomFromWKB_4)s))) '
+            'AS mf_values (id, text, geom) WHERE "table".id = mf_values.id')
+        eq_(compiled.params["param_3"], 2)
+
+    def test_protocol_read_export(self):
+        import os, sqlite3, tempfile, zipfile
+        from webob.exc import HTTPException
+        from mapfish.protocol import Protocol
+        from mapfish.export import ExportStream
+        session, sqlite_engine = sqlite_session()
+        for i in range(1, 4):
+            sqlite_engine.execute('INSERT INTO "table" (id, text, geom) '
+                                  'VALUES (?, ?, ?)', i, u'foo%d' % i,
+                                  buffer(wkt.loads('POINT(%d 2)' % i).wkb))
+        proto = Protocol(session, MappedClass, chunk_size=2)
+
+        # format argument
+        ret = proto.read(FakeRequest({"sort": "id", "dir": "DESC"}),
+                         format='fgb')
+        ok_(isinstance(ret, ExportStream))
+        eq_(ret.content_type, 'application/flatgeobuf')
+        eq_(ret.filename, 'table.fgb')
+        data = ''.join(ret)
+        eq_(data[:8], 'fgb\x03fgb\x00')
+        ok_(data.index('foo3') < data.index('foo1'))
+
+        # format parameter, the query of the GeoJSON reads
+        ret = proto.read(FakeRequest({"format": "gpkg", "queryable": "text",
+                                      "text__ne": "foo2"}))
+        eq_(ret.filename, 'table.gpkg')
+        fd, path = tempfile.mkstemp()
+        os.write(fd, ''.join(ret))
+        os.close(fd)
+        db = sqlite3.connect(path)
+        rows = db.execute('SELECT fid, geom, text FROM "table" '
+                          'ORDER BY fid').fetchall()
+        db.close()
+        os.remove(path)
+        eq_([(r[0], r[2]) for r in rows], [(1, 'foo1'), (3, 'foo3')])
+        eq_(str(rows[1][1])[8:], wkt.loads('POINT(3 2)').wkb)
+
+        # Accept header, attrs and no_geom
+        request = FakeRequest({"attrs": "", "no_geom": "true"})
+        request.environ['HTTP_ACCEPT'] = 'application/zip;q=0.9, */*'
+        ret = proto.read(request)
+        eq_(ret.filename, 'table.zip')
+        fd, path = tempfile.mkstemp()
+        os.write(fd, ''.join(ret))
+        os.close(fd)
+        archive = zipfile.ZipFile(path)
+        eq_(sorted(archive.namelist()), ['table.cpg', 'table.dbf',
+                                         'table.prj', 'table.shp',
+                                         'table.shx'])
+        eq_(len(archive.read('table.shp')), 100 + 3 * 12)
+        archive.close()
+        os.remove(path)
+
+        # GeoJSON
+        request = FakeRequest({"format": "geojson"})
+        request.environ['HTTP_ACCEPT'] = 'application/json'
+        eq_(len(proto.read(request).features), 3)
+
+        # ids, in the given order, and the filter
+        ret = proto.read(FakeRequest({"format": "fgb", "ids": "3,9,1,2"}),
+                         filter=MappedClass.text != u'foo2')
+        data = ''.join(ret)
+        ok_('foo2' not in data)
+        ok_(data.index('foo3') < data.index('foo1'))
+
+        for params in ({"format": "kml"},
+                       {"format": "fgb", "cluster": "true",
+                        "resolution": "1"}):
+            try:
+                proto.read(FakeRequest(params))
+            except HTTPException, e:
+                eq_(e.wsgi_response.status_int, 400)
+            else:
+                assert False
+
+    def test_protocol_read_topojson(self):
+        from mapfish.protocol import Protocol
+        from mapfish.cache import LRUCache
+        session, sqlite_engine = sqlite_session()
+        for i in range(3):
+            square = 'POLYGON((%d 0, %d 0, %d 1, %d 1, %d 0))' % (
+                    i, i + 1, i + 1, i, i)
+            sqlite_engine.execute('INSERT INTO "table" (id, text, geom) '
+                                  'VALUES (?, ?, ?)', i + 1, u'foo%d' % i,
+                                  buffer(wkt.loads(square).wkb))
+        proto = Protocol(session, MappedClass, cache=LRUCache())
+
+        ret = proto.read(FakeRequest({"format": "topojson"}))
+        eq_(ret['type'], 'Topology')
+        eq_(ret['transform']['translate'], [0, 0])
+        geometries = ret['objects']['table']['geometries']
+        eq_([(g['id'], g['properties']) for g in geometries],
+            [(1, {'text': 'foo0'}), (2, {'text': 'foo1'}),
+             (3, {'text': 'foo2'})])
+        # two shared edges, and the boundary cut at their ends
+        eq_(len(ret['arcs']), 6)
+        ok_(max(c for a in ret['arcs'] for p in a for c in p) == 99999)
+
+        # the format argument, the GeoJSON read is cached apart
+        request = FakeRequest({"quantization": "0", "limit": "2",
+                               "sort": "id", "cursor": ""})
+        ret = proto.read(request, format='topojson')
+        ok_('transform' not in ret)
+        eq_(len(ret['objects']['table']['geometries']), 2)
+        ok_('cursor' in ret)
+        ret = proto.read(request)
+        eq_(len(ret.features), 2)
+        ret = proto.read(request, format='topojson')
+        eq_(ret['type'], 'Topology')
+
+    def test_protocol_bulk_delete(self):
+        from webob.exc import HTTPException
+        from mapfish.protocol import Protocol
+        statements = []
+        session, sqlite_engine = sqlite_session(statements)
+        def reset():
+            sqlite_engine.execute('DELETE FROM "table"')
+            for i in range(1, 8):
+                sqlite_engine.execute('INSERT INTO "table" (id, text) '
+                                      'VALUES (?, ?)', i, 'foo%d' % (i % 2))
+            del statements[:]
+        def remaining():
+            session.remove()
+            return [r[0] for r in sqlite_engine.execute(
+                    'SELECT id FROM "table" ORDER BY id')]
+
+        # no hook, one DELETE per chunk_size identifiers
+        reset()
+        proto = Protocol(session, MappedClass, chunk_size=2)
+        response = FakeResponse()
+        proto.bulk_delete(FakeRequest({"ids": "1, 2,3,9"}), response)
+        eq_(response.status, 204)
+        eq_(statements, ['DELETE', 'DELETE'])
+        eq_(remaining(), [4, 5, 6, 7])
+
+        # no hook, MapFish default filter
+        reset()
+        proto.bulk_delete(FakeRequest({"queryable": "text",
+                                       "text__eq": "foo1"}), FakeResponse())
+        eq_(statements, ['DELETE'])
+        eq_(remaining(), [2, 4, 6])
+
+        # custom filter
+        reset()
+        proto.bulk_delete(FakeRequest({}), FakeResponse(),
+                          filter=MappedClass.id > 5)
+        eq_(remaining(), [1, 2, 3, 4, 5])
+
+        # neither ids nor filter
+        reset()
+        try:
+            proto.bulk_delete(FakeRequest({}), FakeResponse())
+        except HTTPException, e:
+            eq_(e.wsgi_response.status_int, 400)
+        else:
+            assert False
+        eq_(remaining(), [1, 2, 3, 4, 5, 6, 7])
+
+        # with hook, the objects are loaded chunk_size at a time
+        calls = []
+        def before_delete(request, obj):
+            calls.append(obj.id)
+        proto = Protocol(session, MappedClass, chunk_size=2,
+                         before_delete=before_delete)
+        reset()
+        proto.bulk_delete(FakeRequest({"queryable": "text",
+                                       "text__eq": "foo1"}), FakeResponse())
+        eq_(calls, [1, 3, 5, 7])
+        eq_(statements.count('SELECT'), 3)
+        eq_(remaining(), [2, 4, 6])
+
+        del calls[:]
+        reset()
+        proto.bulk_delete(FakeRequest({"ids": "6,2,9"}), FakeResponse())
+        eq_(calls, [2, 6])
+        eq_(remaining(), [1, 3, 4, 5, 7])
+
+        # the identifiers are converted to the type of the primary key
+        proto = Protocol(session, MappedClass, chunk_size=2)
+        reset()
+        proto.bulk_delete(FakeRequest({"ids": "02,3.0, 2,9"}), FakeResponse())
+        eq_(statements, ['DELETE', 'DELETE'])
+        eq_(remaining(), [1, 4, 5, 6, 7])
+        for ids in ("1,foo", "1.5"):
+            reset()
+            try:
+                proto.bulk_delete(FakeRequest({"ids": ids}), FakeResponse())
+            except HTTPException, e:
+                eq_(e.wsgi_response.status_int, 400)
+            else:
+                assert False
+            eq_(statements, [])
+            eq_(remaining(), [1, 2, 3, 4, 5, 6, 7])
@@ -0,0 +1,150 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import unittest
+from nose.tools import eq_, ok_, raises
+
+from geojson import Feature, Point, LineString, Polygon, MultiPolygon
+
+from mapfish.topojson import topology
+
+def _decode(topo):
+    """Return the arcs of a topology as lists of positions."""
+    transform = topo.get('transform')
+    arcs = []
+    for arc in topo['arcs']:
+        positions, x, y = [], 0, 0
+        for p in arc:
+            if transform is None:
+                positions.append(tuple(p))
+            else:
+                x, y = x + p[0], y + p[1]
+                positions.append((x * transform['scale'][0] +
+                                  transform['translate'][0],
+                                  y * transform['scale'][1] +
+                                  transform['translate'][1]))
+        arcs.append(positions)
+    return arcs
+
+def _line(arcs, indexes):
+    """Return the positions of a line made of arcs."""
+    positions = []
+    for i in indexes:
+        arc = arcs[i] if i >= 0 else arcs[~i][::-1]
+        positions.extend(arc if len(positions) == 0 else arc[1:])
+    return positions
+
+def _squares():
+    # two squares sharing the edge (1, 0)-(1, 1), the rings go in
+    # opposite directions and start at different points
+    return [
+        Feature(id=1, geometry=Polygon([[[0, 0], [1, 0], [1, 1], [0, 1],
+                                         [0, 0]]]), properties={'a': 1}),
+        Feature(id=2, geometry=Polygon([[[2, 1], [2, 0], [1, 0], [1, 1],
+                                         [2, 1]]]), properties={'a': 2}),
+    ]
+
+class Test(unittest.TestCase):
+
+    def test_shared_arc(self):
+        topo = topology(_squares(), name='layer')
+        eq_(topo['type'], 'Topology')
+        eq_(topo['bbox'], [0, 0, 2, 1])
+        ok_('transform' not in topo)
+        geometries = topo['objects']['layer']['geometries']
+        eq_([(g['type'], g['id'], g['properties']) for g in geometries],
+            [('Polygon', 1, {'a': 1}), ('Polygon', 2, {'a': 2})])
+        # the shared edge and the two outer boundaries
+        eq_(len(topo['arcs']), 3)
+        ring1, ring2 = geometries[0]['arcs'][0], geometries[1]['arcs'][0]
+        eq_(len(ring1), 2)
+        eq_(len(ring2), 2)
+        shared = set(i if i >= 0 else ~i for i in ring1) & \
+                 set(i if i >= 0 else ~i for i in ring2)
+        eq_(len(shared), 1)
+        eq_(sorted(topo['arcs'][shared.pop()]), [[1, 0], [1, 1]])
+
+        arcs = _decode(topo)
+        ring = _line(arcs, ring1)
+        eq_(ring[0], ring[-1])
+        eq_(sorted(set(ring)), [(0, 0), (0, 1), (1, 0), (1, 1)])
+        ring = _line(arcs, ring2)
+        eq_(ring[0], ring[-1])
+        eq_(sorted(set(ring)), [(1, 0), (1, 1), (2, 0), (2, 1)])
+
+    def test_quantization(self):
+        topo = topology(_squares(), quantization=3)
+        eq_(topo['transform'], {'scale': [1.0, 0.5], 'translate': [0, 0]})
+        for arc in topo['arcs']:
+            ok_(all(isinstance(c, int) for p in arc for c in p))
+        # delta-encoded
+        arcs = _decode(topo)
+        eq_(sorted(set(p for a in arcs for p in a)),
+            [(0, 0), (0, 1), (1, 0), (1, 1), (2, 0), (2, 1)])
+
+        # the points collapsing to the same position are merged
+        features = [Feature(geometry=LineString([[0, 0], [0.1, 0.1],
+                                                 [10, 10]]))]
+        topo = topology(features, quantization=2)
+        eq_(topo['arcs'], [[[0, 0], [1, 1]]])
+
+    def test_rings(self):
+        # a hole filled by another polygon, the ring has no junction
+        hole = [[1, 1], [1, 2], [2, 2], [2, 1], [1, 1]]
+        features = [
+            Feature(geometry=Polygon([[[0, 0], [3, 0], [3, 3], [0, 3],
+                                       [0, 0]], hole])),
+            Feature(geometry=Polygon([hole[::-1]])),
+        ]
+        topo = topology(features)
+        eq_(len(topo['arcs']), 2)
+        geometries = topo['objects']['features']['geometries']
+        eq_(geometries[1]['arcs'], [[~geometries[0]['arcs'][1][0]]])
+
+    def test_types(self):
+        features = [
+            Feature(geometry=Point([1, 2])),
+            Feature(geometry=None),
+            Feature(geometry=LineString([[0, 0], [1, 1], [2, 0]])),
+            Feature(geometry=MultiPolygon([
+                [[[3, 3], [4, 3], [4, 4], [3, 3]]],
+                [[[5, 5], [6, 5], [6, 6], [5, 5]]]])),
+        ]
+        topo = topology(features)
+        geometries = topo['objects']['features']['geometries']
+        eq_(geometries[0], {'type': 'Point', 'coordinates': [1, 2]})
+        eq_(geometries[1], {'type': None})
+        eq_(geometries[2]['type'], 'LineString')
+        eq_(len(geometries[2]['arcs']), 1)
+        eq_(geometries[3]['type'], 'MultiPolygon')
+        eq_(len(geometries[3]['arcs']), 2)
+        eq_(len(topo['arcs']), 3)
+
+    @raises(ValueError)
+    def test_bad_quantization(self):
+        topology(_squares(), quantization=1)
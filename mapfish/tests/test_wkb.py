@@ -0,0 +1,127 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import unittest
+from nose.tools import eq_, ok_, raises
+
+import geojson
+from shapely import wkt
+from shapely import wkb as shapely_wkb
+from shapely.geometry import asShape
+
+from mapfish import wkb
+
+GEOMETRIES = [
+    'POINT (1 2)',
+    'POINT Z (1 2 3)',
+    'LINESTRING (1 2, 3 4.5, 5 6)',
+    'LINESTRING Z (1 2 10, 3 4.5 11)',
+    'POLYGON ((0 0, 0 10, 10 10, 10 0, 0 0), (1 1, 1 2, 2 2, 1 1))',
+    'MULTIPOINT (1 2, 3 4)',
+    'MULTILINESTRING ((1 2, 3 4), (5 6, 7 8, 9 10))',
+    'MULTIPOLYGON (((0 0, 0 1, 1 1, 0 0)), ((2 2, 2 3, 3 3, 2 2)))',
+    'GEOMETRYCOLLECTION (POINT (1 2), LINESTRING (1 2, 3 4))',
+]
+
+class Test(unittest.TestCase):
+
+    def test_dumps(self):
+        # the same WKB as GEOS
+        for w in GEOMETRIES:
+            geometry = wkt.loads(w)
+            data = wkb.dumps(geometry.__geo_interface__)
+            eq_(data, geometry.wkb, w)
+
+        # geojson objects
+        data = wkb.dumps(geojson.LineString([[1, 2], [3, 4]]))
+        eq_(data, wkt.loads('LINESTRING (1 2, 3 4)').wkb)
+
+        # the dimension of the first position is used
+        data = wkb.dumps({"type": "LineString",
+                          "coordinates": [[1, 2], [3, 4, 5]]})
+        eq_(data, wkt.loads('LINESTRING (1 2, 3 4)').wkb)
+
+    def test_dumps_invalid(self):
+        for geometry in (None, {"type": "Foo", "coordinates": [1, 2]},
+                         {"type": "Point"},
+                         {"type": "Point", "coordinates": ["a", "b"]},
+                         {"type": "LineString", "coordinates": [1, 2]},
+                         {"type": "LineString",
+                          "coordinates": [[1, 2, 3], [4, 5]]}):
+            try:
+                wkb.dumps(geometry)
+            except ValueError:
+                pass
+            else:
+                assert False, geometry
+
+    def test_loads(self):
+        for w in GEOMETRIES:
+            geometry = wkt.loads(w)
+            for data in (geometry.wkb,
+                         shapely_wkb.dumps(geometry, big_endian=True),
+                         shapely_wkb.dumps(geometry, srid=4326)):
+                loaded = wkb.loads(data)
+                ok_(isinstance(loaded, geojson.GeoJSON))
+                eq_(asShape(loaded).wkb, geometry.wkb, w)
+        # the coordinates are those of Shapely's __geo_interface__
+        for w in ('POINT (1 2)', 'LINESTRING (1 2, 3 4)',
+                  'POLYGON ((0 0, 0 1, 1 1, 0 0))', 'MULTIPOINT (1 2, 3 4)'):
+            geometry = wkt.loads(w)
+            eq_(wkb.loads(buffer(geometry.wkb)).coordinates,
+                geometry.__geo_interface__['coordinates'], w)
+        eq_(wkb.loads(buffer(wkt.loads('POINT (1 2)').wkb)).coordinates,
+            (1.0, 2.0))
+
+        # ISO WKB, the M coordinates are dropped
+        data = '\x01\xd1\x07\x00\x00' + '\x00' * 24
+        eq_(wkb.loads(data).coordinates, (0, 0))
+        data = '\x01\xb9\x0b\x00\x00' + '\x00' * 32
+        eq_(wkb.loads(data).coordinates, (0, 0, 0))
+
+    @raises(ValueError)
+    def test_loads_invalid(self):
+        wkb.loads(wkt.loads('LINESTRING (1 2, 3 4)').wkb[:-4])
+
+    def test_loads_bounds(self):
+        for w in GEOMETRIES:
+            geometry = wkt.loads(w)
+            loaded, bounds = wkb.loads_bounds(geometry.wkb)
+            eq_(asShape(loaded).wkb, geometry.wkb, w)
+            eq_(bounds, geometry.bounds, w)
+        loaded, bounds = wkb.loads_bounds(
+                wkb.dumps({"type": "Point", "coordinates": []}))
+        eq_(loaded.coordinates, [])
+        eq_(bounds, None)
+
+    def test_bounds(self):
+        for w in GEOMETRIES:
+            geometry = wkt.loads(w)
+            eq_(wkb.bounds(geometry.__geo_interface__), geometry.bounds, w)
+        eq_(wkb.bounds({"type": "Point", "coordinates": []}), None)
+        eq_(wkb.bounds({"type": "MultiPolygon", "coordinates": []}), None)
@@ -0,0 +1,256 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+
+""" Encoding of features to TopoJSON.
+
+The lines and the rings of the geometries are cut at the points where
+they meet, the junctions, and the resulting arcs are stored once in the
+topology, the boundary shared by two adjacent polygons being a single
+arc referred to by both polygons, see
+<https://github.com/topojson/topojson-specification>. If ``quantization``
+is given, the coordinates are quantized to integers on a grid of
+``quantization`` by ``quantization`` cells covering the features, and the
+arcs are delta-encoded. The third coordinates are dropped.
+
+Example::
+
+    from mapfish.topojson import topology
+
+    data = topology(features, quantization=1e5)
+"""
+
+from mapfish.wkb import bounds as geojson_bounds
+
+def topology(features, quantization=None, name='features'):
+    """ Return the TopoJSON topology of ``features``, ``geojson.Feature``
+    objects, as a dict. The features are the geometries of the
+    ``GeometryCollection`` object named ``name``, with their identifiers
+    and properties. """
+    geometries = []
+    for feature in features:
+        geometry = feature.geometry
+        if getattr(geometry, 'type', None) is None:
+            # no geometry, or geojson.geometry.Default
+            geometry = None
+        geometries.append(geometry)
+
+    extent = None
+    for geometry in geometries:
+        if geometry is not None:
+            b = geojson_bounds(geometry)
+            if b is not None:
+                extent = b if extent is None else (
+                    min(extent[0], b[0]), min(extent[1], b[1]),
+                    max(extent[2], b[2]), max(extent[3], b[3]))
+
+    ret = {'type': 'Topology', 'objects': {}, 'arcs': []}
+    position = _position
+    if quantization and extent is not None:
+        n = int(quantization)
+        if n < 2:
+            raise ValueError('quantization must be 2 or greater')
+        x0, y0, x1, y1 = extent
+        kx = float(x1 - x0) / (n - 1) if x1 > x0 else 1.0
+        ky = float(y1 - y0) / (n - 1) if y1 > y0 else 1.0
+        def position(p):
+            return (int(round((p[0] - x0) / kx)),
+                    int(round((p[1] - y0) / ky)))
+        ret['transform'] = {'scale': [kx, ky], 'translate': [x0, y0]}
+    if extent is not None:
+        ret['bbox'] = list(extent)
+
+    topology = _Topology(position)
+    geometries = [topology.add(g) for g in geometries]
+    arcs = topology.arcs(delta='transform' in ret)
+
+    objects = []
+    for feature, geometry in zip(features, geometries):
+        o = topology.object(geometry)
+        if feature.id is not None:
+            o['id'] = feature.id
+        if feature.properties:
+            o['properties'] = feature.properties
+        objects.append(o)
+    ret['objects'][name] = {'type': 'GeometryCollection',
+                            'geometries': objects}
+    ret['arcs'] = arcs
+    return ret
+
+def _position(p):
+    return (p[0], p[1])
+
+def _dedupe(points, minimum):
+    # Remove the consecutive duplicates of points, unless fewer than
+    # minimum points would be left.
+    ret = points[:1]
+    for p in points[1:]:
+        if p != ret[-1]:
+            ret.append(p)
+    return ret if len(ret) >= minimum else points
+
+class _Topology(object):
+    """ The lines and the rings of the geometries added, then cut into
+    arcs. """
+
+    def __init__(self, position):
+        self.position = position
+        # lists of positions, and whether they are rings
+        self.lines = []
+
+    def _line(self, coordinates, ring):
+        points = [self.position(p) for p in coordinates]
+        if ring:
+            if len(points) > 0 and points[0] != points[-1]:
+                points.append(points[0])
+            points = _dedupe(points, 4)
+        else:
+            points = _dedupe(points, 2)
+        self.lines.append((points, ring))
+        return len(self.lines) - 1
+
+    def add(self, geometry):
+        """ Register the lines and the rings of ``geometry``, return the
+        geometry with line indexes in place of its lines and rings. """
+        if geometry is None:
+            return None
+        type = geometry.type
+        if type == 'GeometryCollection':
+            return (type, [self.add(g) for g in geometry.geometries])
+        coordinates = geometry.coordinates
+        if type == 'Point':
+            if len(coordinates) == 0:
+                return None
+            return (type, list(self.position(coordinates)))
+        if type == 'MultiPoint':
+            return (type, [list(self.position(p)) for p in coordinates])
+        if type == 'LineString':
+            return (type, self._line(coordinates, False))
+        if type == 'MultiLineString':
+            return (type, [self._line(c, False) for c in coordinates])
+        if type == 'Polygon':
+            return (type, [self._line(c, True) for c in coordinates])
+        if type == 'MultiPolygon':
+            return (type, [[self._line(c, True) for c in p]
+                           for p in coordinates])
+        raise ValueError('Unsupported geometry type: %s' % type)
+
+    def _junctions(self):
+        # The points where the lines and rings meet: the ends of the lines,
+        # and the points whose neighbours differ from one line to
+        # another.
+        neighbours, junctions = {}, set()
+        def visit(p, previous, next):
+            if p in junctions:
+                return
+            seen = neighbours.get(p)
+            if seen is None:
+                neighbours[p] = (previous, next)
+            elif seen != (previous, next) and seen != (next, previous):
+                junctions.add(p)
+        for points, ring in self.lines:
+            if ring:
+                points = points[:-1]
+                n = len(points)
+                for i in range(n):
+                    visit(points[i], points[i - 1], points[(i + 1) % n])
+            elif len(points) > 0:
+                junctions.add(points[0])
+                junctions.add(points[-1])
+                for i in range(1, len(points) - 1):
+                    visit(points[i], points[i - 1], points[i + 1])
+        return junctions
+
+    def arcs(self, delta=False):
+        """ Cut the lines and rings into arcs and return the arcs, the
+        lines are then lists of arc indexes, see ``object()``. """
+        junctions = self._junctions()
+        arcs, index = [], {}
+        def arc(points):
+            key = tuple(points)
+            if key in index:
+                return index[key]
+            reverse = key[::-1]
+            if reverse in index:
+                return ~index[reverse]
+            index[key] = len(arcs)
+            arcs.append(points)
+            return index[key]
+
+        for i, (points, ring) in enumerate(self.lines):
+            if ring:
+                points = points[:-1]
+                starts = [j for j, p in enumerate(points) if p in junctions]
+                if len(starts) == 0:
+                    # the ring is an arc on its own, starting at its
+                    # smallest point so that a ring shared by two polygons
+                    # is the same arc
+                    starts = [points.index(min(points))]
+                points = points[starts[0]:] + points[:starts[0]] + \
+                         points[starts[0]:starts[0] + 1]
+                cuts = [j - starts[0] for j in starts[1:]]
+            else:
+                cuts = [j for j in range(1, len(points) - 1)
+                        if points[j] in junctions]
+            pieces, start = [], 0
+            for j in cuts:
+                pieces.append(arc(points[start:j + 1]))
+                start = j
+            pieces.append(arc(points[start:]))
+            self.lines[i] = pieces
+
+        if delta:
+            ret = []
+            for points in arcs:
+                encoded, x, y = [], 0, 0
+                for px, py in points:
+                    encoded.append([px - x, py - y])
+                    x, y = px, py
+                ret.append(encoded)
+            return ret
+        return [[list(p) for p in points] for points in arcs]
+
+    def object(self, geometry):
+        """ Return the TopoJSON object of a geometry returned by
+        ``add()``, once the lines are cut into arcs. """
+        if geometry is None:
+            return {'type': None}
+        type, value = geometry
+        if type == 'GeometryCollection':
+            return {'type': type,
+                    'geometries': [self.object(g) for g in value]}
+        if type in ('Point', 'MultiPoint'):
+            return {'type': type, 'coordinates': value}
+        if type == 'LineString':
+            arcs = self.lines[value]
+        elif type in ('MultiLineString', 'Polygon'):
+            arcs = [self.lines[i] for i in value]
+        else:
+            arcs = [[self.lines[i] for i in p] for p in value]
+        return {'type': type, 'arcs': arcs}
@@ -0,0 +1,262 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+
+""" Conversion of GeoJSON geometries to and from WKB.
+
+The geometries are converted directly from and to their GeoJSON
+coordinates, no Shapely geometry is built, which is cheaper when the
+geometries are only written to or read from the database.
+
+Example::
+
+    from mapfish import wkb
+
+    data = wkb.dumps(feature.geometry)
+    geometry = wkb.loads(data)
+
+The WKB written is little-endian, geometries with a third coordinate are
+flagged with the extended WKB bit, as done by GEOS. ``loads()`` also
+reads big-endian WKB, the ISO flavour of 3D types, and skips the SRID of
+extended WKB.
+"""
+
+import struct
+from itertools import chain
+
+import geojson
+
+# geometry types
+TYPES = {'Point': 1, 'LineString': 2, 'Polygon': 3, 'MultiPoint': 4,
+         'MultiLineString': 5, 'MultiPolygon': 6, 'GeometryCollection': 7}
+
+# the depth of the positions in the coordinates of each type
+_DEPTHS = {'Point': 0, 'LineString': 1, 'MultiPoint': 1, 'Polygon': 2,
+           'MultiLineString': 2, 'MultiPolygon': 3}
+
+_NAMES = dict((v, k) for k, v in TYPES.items())
+
+# extended WKB flags
+WKBZ = 0x80000000
+WKBM = 0x40000000
+WKBSRID = 0x20000000
+
+_HEADER = struct.Struct('<BI')
+_UINT = struct.Struct('<I')
+
+def _get(geometry, key):
+    # geojson objects and mappings are accepted
+    if isinstance(geometry, dict):
+        return geometry[key]
+    return getattr(geometry, key)
+
+def dumps(geometry):
+    """ Return the WKB of ``geometry``, a ``geojson`` geometry or a GeoJSON
+    mapping, as a string. Raise ``ValueError`` if the geometry is not
+    valid GeoJSON. """
+    parts = []
+    try:
+        _dump(geometry, parts)
+    except (KeyError, AttributeError, TypeError, IndexError, struct.error):
+        raise ValueError('invalid GeoJSON geometry: %r' % (geometry,))
+    return ''.join(parts)
+
+def _dims(coordinates, depth):
+    # The number of dimensions of the first position of the coordinates.
+    for i in range(depth):
+        if len(coordinates) == 0:
+            return 2
+        coordinates = coordinates[0]
+    return 3 if len(coordinates) > 2 else 2
+
+def _dump(geometry, parts):
+    type = _get(geometry, 'type')
+    if type == 'GeometryCollection':
+        geometries = _get(geometry, 'geometries')
+        parts.append(_HEADER.pack(1, TYPES[type]))
+        parts.append(_UINT.pack(len(geometries)))
+        for g in geometries:
+            _dump(g, parts)
+        return
+    depth = _DEPTHS[type]
+    coordinates = _get(geometry, 'coordinates')
+    _dump_coordinates(TYPES[type], coordinates, depth,
+                      _dims(coordinates, depth), parts)
+
+def _dump_coordinates(code, coordinates, depth, dims, parts):
+    flag = WKBZ if dims == 3 else 0
+    parts.append(_HEADER.pack(1, code | flag))
+    if depth == 0:
+        if len(coordinates) == 0:
+            # the empty point
+            coordinates = [float('nan')] * dims
+        parts.append(_pack_positions([coordinates], dims))
+    elif depth == 1 and code == TYPES['LineString']:
+        parts.append(_UINT.pack(len(coordinates)))
+        parts.append(_pack_positions(coordinates, dims))
+    elif depth == 2 and code == TYPES['Polygon']:
+        parts.append(_UINT.pack(len(coordinates)))
+        for ring in coordinates:
+            parts.append(_UINT.pack(len(ring)))
+            parts.append(_pack_positions(ring, dims))
+    else:
+        # the parts of a multi geometry are geometries of their own
+        parts.append(_UINT.pack(len(coordinates)))
+        for c in coordinates:
+            _dump_coordinates(code - 3, c, depth - 1, dims, parts)
+
+def _pack_positions(positions, dims):
+    # The positions as doubles, the extra coordinates are dropped.
+    values = list(chain.from_iterable(positions))
+    if len(values) != len(positions) * dims:
+        values = list(chain.from_iterable(p[:dims] for p in positions))
+        if len(values) != len(positions) * dims:
+            raise TypeError('positions of different dimensions')
+    return struct.pack('<%dd' % len(values), *values)
+
+def loads(data):
+    """ Return the ``geojson`` geometry of the WKB ``data``, whose
+    coordinates are tuples of floats, as in the ``__geo_interface__`` of
+    Shapely geometries. Raise ``ValueError`` if the WKB is not valid. """
+    return _loads(data, None)
+
+def loads_bounds(data):
+    """ Return the ``geojson`` geometry of the WKB ``data`` and its bounds,
+    see ``bounds()``, computed while the WKB is read. Raise ``ValueError``
+    if the WKB is not valid. """
+    extent = []
+    geometry = _loads(data, extent)
+    return geometry, tuple(extent) if len(extent) > 0 else None
+
+def _loads(data, extent):
+    try:
+        geometry, offset = _load(str(data), 0, extent)
+    except (struct.error, KeyError, IndexError):
+        raise ValueError('invalid WKB')
+    return geometry
+
+def _load(data, offset, extent):
+    # Return the geometry at offset and the offset of its end, and extend
+    # extent, a (possibly empty) [minx, miny, maxx, maxy] list, unless it
+    # is None.
+    prefix = '<' if data[offset] == '\x01' else '>'
+    code, = struct.unpack_from(prefix + 'I', data, offset + 1)
+    offset += 5
+    if code & WKBSRID:
+        offset += 4
+    z, m = code & WKBZ, code & WKBM
+    code &= 0xffff
+    if code > 1000:
+        # ISO WKB, 1000 for Z, 2000 for M, 3000 for ZM
+        z, m = code // 1000 in (1, 3), code // 1000 in (2, 3)
+        code %= 1000
+    dims = 2 + bool(z) + bool(m)
+    # the M coordinates are dropped
+    keep = 2 + bool(z)
+    name = _NAMES[code]
+    if code == 1:
+        coordinates = _unpack_positions(data, offset, 1, dims, keep,
+                                        prefix, None)[0]
+        offset += 8 * dims
+        if coordinates[0] != coordinates[0]:
+            # the empty point, NaN coordinates
+            coordinates = []
+        elif extent is not None:
+            _extend(extent, coordinates[0:1], coordinates[1:2])
+        return getattr(geojson, name)(coordinates), offset
+    count, = struct.unpack_from(prefix + 'I', data, offset)
+    offset += 4
+    if code == 2:
+        coordinates = _unpack_positions(data, offset, count, dims, keep,
+                                        prefix, extent)
+        offset += 8 * dims * count
+    elif code == 3:
+        coordinates = []
+        for i in range(count):
+            n, = struct.unpack_from(prefix + 'I', data, offset)
+            offset += 4
+            coordinates.append(_unpack_positions(data, offset, n, dims, keep,
+                                                 prefix, extent))
+            offset += 8 * dims * n
+        coordinates = tuple(coordinates)
+    else:
+        geometries = []
+        for i in range(count):
+            geometry, offset = _load(data, offset, extent)
+            geometries.append(geometry)
+        if code == 7:
+            return geojson.GeometryCollection(geometries), offset
+        coordinates = tuple(g.coordinates for g in geometries)
+    return getattr(geojson, name)(coordinates), offset
+
+def _unpack_positions(data, offset, count, dims, keep, prefix, extent):
+    # The count positions of dims coordinates at offset, as tuples of their
+    # keep first coordinates.
+    values = struct.unpack_from('%s%dd' % (prefix, count * dims), data,
+                                offset)
+    xs, ys = values[0::dims], values[1::dims]
+    if extent is not None and count > 0:
+        _extend(extent, xs, ys)
+    if keep == 2:
+        return tuple(zip(xs, ys))
+    return tuple(zip(xs, ys, values[2::dims]))
+
+def _extend(extent, xs, ys):
+    # Extend the extent with the x and y coordinates.
+    if len(extent) == 0:
+        extent.extend((min(xs), min(ys), max(xs), max(ys)))
+    else:
+        extent[0] = min(extent[0], min(xs))
+        extent[1] = min(extent[1], min(ys))
+        extent[2] = max(extent[2], max(xs))
+        extent[3] = max(extent[3], max(ys))
+
+def bounds(geometry):
+    """ Return the bounds of ``geometry``, a ``geojson`` geometry or a
+    GeoJSON mapping, as a ``(minx, miny, maxx, maxy)`` tuple, or ``None``
+    if the geometry is empty. """
+    xs, ys = [], []
+    _collect(geometry, xs, ys)
+    if len(xs) == 0:
+        return None
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def _collect(geometry, xs, ys):
+    type = _get(geometry, 'type')
+    if type == 'GeometryCollection':
+        for g in _get(geometry, 'geometries'):
+            _collect(g, xs, ys)
+        return
+    positions = _get(geometry, 'coordinates')
+    if _DEPTHS[type] == 0:
+        positions = [positions] if len(positions) > 0 else []
+    for i in range(_DEPTHS[type] - 1):
+        positions = list(chain.from_iterable(positions))
+    xs.extend([p[0] for p in positions])
+    ys.extend([p[1] for p in positions])
@@ -0,0 +1,119 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Benchmark the export formats of mapfish.protocol.Protocol.read.
+
+The features of a table of random polygons with a few attributes, as
+read from the database (fid, WKB geometry and properties), are written as
+GeoJSON with the MapFishEncoder, as done by the JSON reads, and with the
+FlatGeobuf, GeoPackage and Shapefile writers of mapfish.export. The time
+to write and the size of each file is reported, along with the time to
+parse the GeoJSON file, for reference. No database is needed.
+
+Usage:
+
+    python bench_export.py
+    python bench_export.py --features=20000 --vertices=50
+"""
+import time
+import random
+import datetime
+from optparse import OptionParser
+
+import simplejson
+from geojson import Feature
+
+from mapfish import wkb, export
+from mapfish.decorators import MapFishEncoder
+from mapfish.protocol import FeatureStream
+
+
+FIELDS = [('name', 'str', 40), ('population', 'int', None),
+          ('area', 'float', None), ('updated', 'date', None)]
+
+def features(count, vertices):
+    """Return the rows of the benchmark as (fid, wkb, properties)."""
+    rows = []
+    for i in range(count):
+        x, y = random.uniform(5, 10), random.uniform(45, 48)
+        ring = [[x + random.uniform(-0.01, 0.01),
+                 y + random.uniform(-0.01, 0.01)] for j in range(vertices)]
+        geometry = {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}
+        rows.append((i + 1, wkb.dumps(geometry), {
+            'name': u'feature %d' % i,
+            'population': random.randint(0, 100000),
+            'area': random.uniform(0, 1000),
+            'updated': datetime.date(2011, 1, 1) +
+                       datetime.timedelta(days=i % 365)}))
+    return rows
+
+def geojson(rows):
+    encoder = MapFishEncoder()
+    def to_features():
+        for fid, data, properties in rows:
+            geometry, bounds = wkb.loads_bounds(data)
+            yield Feature(id=fid, geometry=geometry, properties=properties,
+                          bbox=bounds)
+    return FeatureStream(to_features()).iterencode(encoder)
+
+def writer(cls):
+    def write(rows):
+        return cls('layer', FIELDS, 'Polygon', 4326).write(iter(rows))
+    return write
+
+def bench(name, func, rows, repeat):
+    best, size = None, 0
+    for i in range(repeat):
+        t = time.time()
+        size = sum(len(chunk) for chunk in func(rows))
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    print '  %-10s %8.1f ms %10.1f kB' % (name, best * 1000, size / 1024.)
+    return best
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--features', type='int', default=5000)
+    parser.add_option('--vertices', type='int', default=50,
+                      help='number of vertices of the polygons')
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+
+    rows = features(options.features, options.vertices)
+    print '%d polygons of %d vertices' % (len(rows), options.vertices)
+    bench('geojson', geojson, rows, options.repeat)
+    for name in ('fgb', 'gpkg', 'shp'):
+        bench(name, writer(export.FORMATS[name]), rows, options.repeat)
+
+    data = ''.join(geojson(rows))
+    t = time.time()
+    simplejson.loads(data)
+    print '  parsing the GeoJSON file: %.1f ms' % ((time.time() - t) * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Benchmark the JSON encoding of the features returned by geojsonify.
+
+Feature collections of a typical layer, points or lines with a few
+attributes including float and date values, are encoded with
+mapfish.decorators.MapFishEncoder, through its simplejson fast paths,
+through the ujson backend if ujson is installed, and through the geojson
+encoder alone, the encoding path used before the fast paths. Decimal values
+are left out, the features holding them are encoded by simplejson.
+
+Usage:
+
+    python bench_json.py
+    python bench_json.py --features=100000 --vertices=50
+"""
+import time
+import random
+import decimal
+import datetime
+from optparse import OptionParser
+
+import simplejson
+import geojson
+from geojson import Feature, FeatureCollection
+from geojson.codec import PyGFPEncoder
+
+from mapfish.decorators import MapFishEncoder, ujson, ujson_dumps
+
+
+class GeoJSONEncoder(PyGFPEncoder):
+    """The encoding path of MapFishEncoder before the fast paths."""
+    def default(self, obj):
+        if isinstance(obj, (decimal.Decimal, datetime.date, datetime.datetime)):
+            return str(obj)
+        return PyGFPEncoder.default(self, obj)
+
+def properties(i):
+    return {'name': u'feature %d' % i, 'kind': random.choice(['a', 'b']),
+            'height': round(random.uniform(0, 1000), 2),
+            'surveyed': datetime.date(2011, 1, 1) + datetime.timedelta(i % 365),
+            'count': i}
+
+def position():
+    return [random.uniform(5, 10), random.uniform(45, 48)]
+
+def collections(features, vertices):
+    """Return the feature collections of the benchmark, by name."""
+    points = [Feature(id=i, geometry=geojson.Point(position()),
+                      properties=properties(i))
+              for i in range(features)]
+    lines = [Feature(id=i, geometry=geojson.LineString(
+                         [position() for j in range(vertices)]),
+                     properties=properties(i))
+             for i in range(features // 10)]
+    return [('points', FeatureCollection(points)),
+            ('lines', FeatureCollection(lines))]
+
+def bench(name, cls, collection, repeat, backend=None):
+    MapFishEncoder.backend = None if backend is None else \
+                             staticmethod(backend)
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        simplejson.dumps(collection, cls=cls)
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    print '  %-26s %8.1f ms %10d features/s' % (
+        name, best * 1000, len(collection.features) / best)
+    return best
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--features', type='int', default=10000,
+                      help='number of points, ten times less lines')
+    parser.add_option('--vertices', type='int', default=100,
+                      help='number of vertices of the lines')
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+
+    backend = ujson_dumps if ujson is not None else None
+    for name, collection in collections(options.features, options.vertices):
+        print '%s (%d features)' % (name, len(collection.features))
+        bench('geojson encoder', GeoJSONEncoder, collection, options.repeat)
+        bench('MapFishEncoder, simplejson', MapFishEncoder, collection,
+              options.repeat)
+        if backend is not None:
+            bench('MapFishEncoder, ujson', MapFishEncoder, collection,
+                  options.repeat, backend)
+
+if __name__ == '__main__':
+    main()
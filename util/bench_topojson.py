@@ -0,0 +1,132 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Benchmark the TopoJSON reads of mapfish.protocol.Protocol against the
+GeoJSON reads.
+
+The features are the cells of a grid of adjacent polygons, like the
+municipalities of a district, whose boundaries have a given number of
+vertices per side, each boundary being shared by two cells. The features
+are encoded with the MapFishEncoder as a GeoJSON feature collection, with
+all decimals and rounded to 6 decimals, and as a TopoJSON topology, with
+the default quantization of the protocol. The time to encode and the
+size of each response is reported. No database is needed.
+
+Usage:
+
+    python bench_topojson.py
+    python bench_topojson.py --size=50 --vertices=100
+"""
+import time
+import random
+from optparse import OptionParser
+
+from geojson import Feature, FeatureCollection, Polygon
+
+from mapfish.decorators import MapFishEncoder
+from mapfish.topojson import topology
+
+
+def boundary(a, b, vertices):
+    """Return a random line from a to b."""
+    line = [a]
+    for i in range(1, vertices):
+        t = float(i) / vertices
+        line.append((a[0] + (b[0] - a[0]) * t + random.uniform(-0.002, 0.002),
+                     a[1] + (b[1] - a[1]) * t + random.uniform(-0.002, 0.002)))
+    line.append(b)
+    return line
+
+def cells(size, vertices):
+    """Return the features of a grid of size by size cells."""
+    corners = {}
+    for i in range(size + 1):
+        for j in range(size + 1):
+            corners[i, j] = (6 + i * 0.05 + random.uniform(-0.01, 0.01),
+                             46 + j * 0.05 + random.uniform(-0.01, 0.01))
+    boundaries = {}
+    def side(a, b):
+        if (b, a) in boundaries:
+            return boundaries[b, a][::-1]
+        if (a, b) not in boundaries:
+            boundaries[a, b] = boundary(corners[a], corners[b], vertices)
+        return boundaries[a, b]
+    features = []
+    for i in range(size):
+        for j in range(size):
+            square = [(i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1), (i, j)]
+            ring = []
+            for k in range(4):
+                ring.extend(side(square[k], square[k + 1])[:-1])
+            ring.append(ring[0])
+            features.append(Feature(id=len(features) + 1,
+                                    geometry=Polygon([ring]),
+                                    properties={'name': 'cell %d' % i}))
+    return features
+
+def geojson(features, precision):
+    encoder = MapFishEncoder(precision=precision)
+    return encoder.encode(FeatureCollection(features))
+
+def topojson(features, quantization):
+    encoder = MapFishEncoder()
+    return encoder.encode(topology(features, quantization))
+
+def bench(name, func, features, arg, repeat):
+    best, size = None, 0
+    for i in range(repeat):
+        t = time.time()
+        size = len(func(features, arg))
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    print '  %-22s %8.1f ms %10.1f kB' % (name, best * 1000, size / 1024.)
+    return size
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--size', type='int', default=30,
+                      help='number of cells per side of the grid')
+    parser.add_option('--vertices', type='int', default=50,
+                      help='number of vertices per side of the cells')
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+
+    features = cells(options.size, options.vertices)
+    print '%d polygons of %d vertices' % (len(features),
+                                          4 * options.vertices + 1)
+    full = bench('geojson', geojson, features, None, options.repeat)
+    rounded = bench('geojson, 6 decimals', geojson, features, 6,
+                    options.repeat)
+    size = bench('topojson, 1e5', topojson, features, 100000,
+                 options.repeat)
+    print '  topojson/geojson        %5.0f%% %5.0f%% (6 decimals)' % (
+        100. * size / full, 100. * size / rounded)
+    bench('topojson, unquantized', topojson, features, None, options.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# 
+# Copyright (c) 2008-2011 Camptocamp.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of Camptocamp nor the names of its contributors may 
+#    be used to endorse or promote products derived from this software 
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Benchmark the conversion of the GeoJSON geometries written and read
+through mapfish.protocol.Protocol to and from WKB.
+
+The geometries of a payload of random points, lines (GPS tracks) or
+polygons are converted to WKB, and converted back to GeoJSON for the
+response, through Shapely (asShape, .wkb, .bounds and the encoding of the
+Shapely geometry), and directly from the GeoJSON coordinates with
+mapfish.wkb. Then their WKB, as read from the database, is decoded and
+encoded to GeoJSON with the bounds, through Shapely (shapely.wkb.loads)
+and with mapfish.wkb.loads_bounds. No database is needed.
+
+Usage:
+
+    python bench_wkb.py
+    python bench_wkb.py --features=2000 --vertices=500
+"""
+import time
+import random
+from optparse import OptionParser
+
+import simplejson
+from geojson import loads, GeoJSON
+from shapely import wkb as shapely_wkb
+from shapely.geometry import asShape
+
+from mapfish import wkb
+from mapfish.decorators import MapFishEncoder
+
+
+def position():
+    return [random.uniform(5, 10), random.uniform(45, 48)]
+
+def track(vertices):
+    x, y = position()
+    coordinates = []
+    for i in range(vertices):
+        x += random.uniform(-0.001, 0.001)
+        y += random.uniform(-0.001, 0.001)
+        coordinates.append([x, y, random.uniform(400, 500)])
+    return coordinates
+
+def payloads(features, vertices):
+    """Return the GeoJSON feature collections of the benchmark, by name."""
+    def collection(geometries):
+        return simplejson.dumps({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {}, "geometry": g}
+            for g in geometries]})
+    points = [{"type": "Point", "coordinates": position()}
+              for i in range(features * 10)]
+    lines = [{"type": "LineString", "coordinates": track(vertices)}
+             for i in range(features)]
+    polygons = []
+    for i in range(features):
+        ring = [[x, y] for x, y, z in track(vertices)]
+        polygons.append({"type": "Polygon",
+                         "coordinates": [ring + ring[:1]]})
+    return [('points', collection(points)), ('lines', collection(lines)),
+            ('polygons', collection(polygons))]
+
+def through_shapely(geometries, encoder):
+    for g in geometries:
+        shape = asShape(g)
+        buffer(shape.wkb)
+        shape.bounds
+        encoder.encode(shape)
+
+def direct(geometries, encoder):
+    for g in geometries:
+        buffer(wkb.dumps(g))
+        wkb.bounds(g)
+        encoder.encode(g)
+
+def read_shapely(data, encoder):
+    for d in data:
+        shape = shapely_wkb.loads(str(d))
+        encoder.encode(shape)
+        shape.bounds
+
+def read_direct(data, encoder):
+    for d in data:
+        geometry, bounds = wkb.loads_bounds(d)
+        encoder.encode(geometry)
+
+def bench(name, func, geometries, encoder, repeat):
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        func(geometries, encoder)
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    print '  %-16s %8.1f ms' % (name, best * 1000)
+    return best
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--features', type='int', default=1000,
+                      help='number of lines and polygons, ten times more '
+                           'points')
+    parser.add_option('--vertices', type='int', default=200,
+                      help='number of vertices of the lines and polygons')
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+
+    encoder = MapFishEncoder()
+    for name, payload in payloads(options.features, options.vertices):
+        collection = loads(payload, object_hook=GeoJSON.to_instance)
+        geometries = [f.geometry for f in collection.features]
+        print '%s (%d geometries)' % (name, len(geometries))
+        shapely = bench('shapely', through_shapely, geometries, encoder,
+                        options.repeat)
+        mapfish = bench('mapfish.wkb', direct, geometries, encoder,
+                        options.repeat)
+        print '  speedup          %8.1fx' % (shapely / mapfish)
+        data = [buffer(wkb.dumps(g)) for g in geometries]
+        print '%s read (%d geometries)' % (name, len(data))
+        shapely = bench('shapely', read_shapely, data, encoder,
+                        options.repeat)
+        mapfish = bench('mapfish.wkb', read_direct, data, encoder,
+                        options.repeat)
+        print '  speedup          %8.1fx' % (shapely / mapfish)
+
+if __name__ == '__main__':
+    main()